@@ -0,0 +1,159 @@
+import datetime
+import json
+import timeit
+
+import click
+import pytz
+
+from lib.util_json import ENCODERS
+from vidme.blueprints.admin.schemas import user_detail_schema, users_schema
+from vidme.blueprints.billing.models.credit_card import CreditCard
+from vidme.blueprints.billing.models.invoice import Invoice
+from vidme.blueprints.billing.models.subscription import Subscription
+from vidme.blueprints.billing.schemas import invoices_schema
+from vidme.blueprints.user.models import User
+
+
+def _users(count=30):
+    now = datetime.datetime(2019, 6, 1, tzinfo=pytz.utc)
+
+    return [User(id=i, username='user{0}'.format(i),
+                 email='user{0}@local.host'.format(i), role='member',
+                 name='User {0}'.format(i), sign_in_count=i,
+                 payment_id='cus_{0:06d}'.format(i), created_on=now,
+                 updated_on=now, current_sign_in_on=now, last_sign_in_on=now)
+            for i in range(count)]
+
+
+def _invoices(count=12):
+    now = datetime.datetime(2019, 6, 1, tzinfo=pytz.utc)
+
+    return [Invoice(id=i, created_on=now, plan='Gold',
+                    receipt_number='{0:07d}'.format(i),
+                    description='VIDME GOLD',
+                    period_start_on=datetime.date(2019, 5, 1),
+                    period_end_on=datetime.date(2019, 6, 1),
+                    currency='usd', tax=None, tax_percent=None, total=999,
+                    brand='Visa', last4='4242',
+                    exp_date=datetime.date(2021, 6, 1))
+            for i in range(count)]
+
+
+def users_payload(count=30):
+    """
+    Build the response of AdminView:users, for a full page of users.
+
+    :param count: Number of users
+    :type count: int
+    :return: dict
+    """
+    return {'data': {
+        'users': users_schema.dump(_users(count)),
+        'has_next': True,
+        'has_prev': False,
+        'next_cursor': 'eyJ2IjogWyJtZW1iZXIiXSwgImQiOiAibmV4dCJ9',
+        'prev_cursor': None
+    }}
+
+
+def billing_history_payload(count=12):
+    """
+    Build the response of InvoicesView:index, for a page of invoices and an
+    upcoming invoice.
+
+    :param count: Number of invoices
+    :type count: int
+    :return: dict
+    """
+    now = datetime.datetime(2019, 6, 1, tzinfo=pytz.utc)
+
+    return {'data': {
+        'invoices': invoices_schema.dump(_invoices(count)),
+        'has_next': True,
+        'has_prev': False,
+        'next_cursor': 'eyJ2IjogWyIyMDE5LTA2LTAxIl0sICJkIjogIm5leHQifQ==',
+        'prev_cursor': None,
+        'upcoming_invoice': {
+            'plan': 'Gold',
+            'description': 'VIDME GOLD',
+            'next_bill_on': datetime.datetime(2019, 7, 1),
+            'amount_due': 999,
+            'interval': 'month'
+        },
+        'upcoming_invoice_refreshed_on': now
+    }}
+
+
+@click.group()
+def cli():
+    """ Benchmark parts of the API """
+    pass
+
+
+@click.command(name='json')
+@click.option('--iterations', default=2000, help='Encodes per payload')
+def json_encoders(iterations):
+    """
+    Compare the cost of serializing API responses with each JSON encoder
+    that is installed, and with the json.dumps(data, default=str) it
+    replaced.
+
+    :return: None
+    """
+    encoders = dict(ENCODERS)
+    encoders['json (default=str)'] = \
+        lambda data: json.dumps(data, default=str).encode('utf-8')
+
+    payloads = {
+        'users list': users_payload(),
+        'billing history': billing_history_payload()
+    }
+
+    for payload_name, payload in payloads.items():
+        click.echo('{0}:'.format(payload_name))
+
+        for name, encoder in sorted(encoders.items()):
+            seconds = timeit.timeit(lambda: encoder(payload),
+                                    number=iterations)
+            click.echo('  {0:<20} {1:>8.1f} us  {2:>6} bytes'.format(
+                name, seconds / iterations * 1000000, len(encoder(payload))))
+
+    return None
+
+
+@click.command()
+@click.option('--iterations', default=2000, help='Dumps per schema')
+def serializers(iterations):
+    """
+    Compare the cost of dumping API resources with the compiled schemas and
+    with the marshmallow schemas they wrap.
+
+    :return: None
+    """
+    now = datetime.datetime(2019, 6, 1, tzinfo=pytz.utc)
+    user = _users(1)[0]
+    user.credit_card = CreditCard(id=1, brand='Visa', last4='4242',
+                                  exp_date=datetime.date(2021, 6, 1))
+    user.subscription = Subscription(id=1, plan='gold', created_on=now,
+                                     updated_on=now)
+
+    cases = [
+        ('users list', users_schema, _users()),
+        ('user detail', user_detail_schema, user),
+        ('billing history', invoices_schema, _invoices())
+    ]
+
+    for case_name, compiled, obj in cases:
+        click.echo('{0}:'.format(case_name))
+
+        for name, dump in (('marshmallow', compiled.schema.dump),
+                           ('compiled', compiled.dump)):
+            seconds = timeit.timeit(lambda: dump(obj), number=iterations)
+            click.echo('  {0:<20} {1:>8.1f} us'.format(
+                name, seconds / iterations * 1000000))
+
+    return None
+
+
+cli.add_command(json_encoders)
+cli.add_command(serializers)
@@ -1,8 +1,20 @@
+import calendar
+import json
+import os
+import time
+
 import click
 
 from vidme.app import create_app
 from vidme.extensions import db
-from vidme.blueprints.billing.gateways.stripecom import Plan as PaymentPlan
+from vidme.blueprints.user.models import User
+from vidme.blueprints.billing.models.invoice import Invoice
+from vidme.blueprints.billing.models.subscription import Subscription
+from vidme.blueprints.billing.gateways.stripecom import (
+    Plan as PaymentPlan,
+    Product as PaymentProduct,
+    Subscription as PaymentSubscription
+)
 
 # create an app context for the database connection
 app = create_app()
@@ -38,6 +50,9 @@ def sync_plans():
         else:
             PaymentPlan.create(**value)
 
+    # Invoices look up the product of their plan, cache them all up front
+    PaymentProduct.warm_cache()
+
     return None
 
 
@@ -65,6 +80,166 @@ def list_plans():
     click.echo(PaymentPlan.list())
 
 
+@click.command()
+@click.option('--batch-size', default=100, help='Subscriptions per commit')
+def backfill_subscriptions(batch_size):
+    """
+    Store the Stripe subscription and subscription item ids of subscriptions
+    that were created before they were saved locally.
+
+    :return: None
+    """
+    query = db.session.query(Subscription, User.payment_id) \
+        .join(User, User.id == Subscription.user_id) \
+        .filter(Subscription.payment_id.is_(None),
+                User.payment_id.isnot(None)) \
+        .order_by(Subscription.id)
+
+    last_id = 0
+    count = 0
+
+    while True:
+        batch = query.filter(Subscription.id > last_id).limit(batch_size).all()
+        if not batch:
+            break
+
+        for subscription, customer_id in batch:
+            payment_subscription = PaymentSubscription.retrieve_for_customer(
+                customer_id)
+
+            if payment_subscription:
+                for key, value in Subscription.extract_subscription_params(
+                        payment_subscription).items():
+                    setattr(subscription, key, value)
+                count += 1
+
+        db.session.commit()
+        last_id = batch[-1][0].id
+
+    click.echo('Backfilled {0} subscription(s).'.format(count))
+
+    return None
+
+
+@click.command()
+@click.option('--since', type=click.DateTime(formats=['%Y-%m-%d']),
+              help='Only invoices created on or after this date (UTC)')
+@click.option('--until', type=click.DateTime(formats=['%Y-%m-%d']),
+              help='Only invoices created before this date (UTC)')
+@click.option('--workers', default=8, help='Customers synced concurrently')
+@click.option('--batch-size', default=100, help='Invoices per upsert')
+@click.option('--chunk-size', default=500, help='Customers per checkpoint')
+@click.option('--checkpoint', default='.sync_invoices.json',
+              type=click.Path(dir_okay=False),
+              help='File where progress is saved')
+@click.option('--restart', is_flag=True,
+              help='Ignore the progress of an interrupted run')
+def sync_invoices(since, until, workers, batch_size, chunk_size, checkpoint,
+                  restart):
+    """
+    Sync (upsert) the invoices of every customer from Stripe, to rebuild the
+    billing history of invoices whose webhook never arrived.
+
+    Progress is saved after every chunk of customers, running the command
+    again resumes an interrupted run. Customers which failed are retried
+    first.
+
+    Only customers who are still a user's payment_id are synced. Cancelling
+    a subscription clears it along with the credit card, so the history of
+    cancelled customers isn't backfilled.
+
+    :return: None
+    """
+    created = {}
+    if since:
+        created['gte'] = calendar.timegm(since.timetuple())
+    if until:
+        created['lt'] = calendar.timegm(until.timetuple())
+
+    state = {'created': created, 'last_user_id': 0, 'failed': []}
+
+    if not restart and os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            saved = json.load(f)
+
+        if saved.get('created') == created:
+            state = saved
+            click.echo('Resuming after user {0}.'.format(
+                state['last_user_id']))
+        else:
+            click.echo('Checkpoint is for other dates, starting over.')
+
+    totals = {'customers': 0, 'invoices': 0}
+    started = time.monotonic()
+
+    def sync(customer_ids):
+        result = Invoice.sync(customer_ids, created=created or None,
+                              workers=workers, batch_size=batch_size)
+
+        totals['customers'] += result['customers']
+        totals['invoices'] += result['invoices']
+        state['failed'].extend(result['failed'])
+
+        for customer_id, error in result['failed'].items():
+            click.echo('Failed {0}: {1}'.format(customer_id, error))
+
+        elapsed = time.monotonic() - started
+        click.echo('Synced {0} invoice(s) of {1} customer(s) in {2:.1f}s '
+                   '({3:.1f} invoices/s).'.format(
+                       totals['invoices'], totals['customers'], elapsed,
+                       totals['invoices'] / elapsed if elapsed else 0))
+
+        _save_checkpoint(checkpoint, state)
+
+    # Customers which failed last time go first
+    failed = state['failed']
+    state['failed'] = []
+    if failed:
+        sync(failed)
+
+    query = db.session.query(User.id, User.payment_id) \
+        .filter(User.payment_id.isnot(None)) \
+        .order_by(User.id)
+
+    while True:
+        chunk = query.filter(User.id > state['last_user_id']) \
+            .limit(chunk_size).all()
+        if not chunk:
+            break
+
+        state['last_user_id'] = chunk[-1].id
+        sync([customer.payment_id for customer in chunk])
+
+    if state['failed']:
+        click.echo('{0} customer(s) failed, run the command again to retry '
+                   'them.'.format(len(state['failed'])))
+    elif os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+    return None
+
+
+def _save_checkpoint(path, state):
+    """
+    Save the progress of sync_invoices, replacing the file in 1 step so an
+    interrupted write doesn't corrupt it.
+
+    :param path: Checkpoint file
+    :type path: str
+    :param state: Progress
+    :type state: dict
+    :return: None
+    """
+    tmp_path = '{0}.tmp'.format(path)
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+    return None
+
+
 cli.add_command(sync_plans)
 cli.add_command(delete_plans)
 cli.add_command(list_plans)
+cli.add_command(backfill_subscriptions)
+cli.add_command(sync_invoices)
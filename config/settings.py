@@ -13,6 +13,20 @@ SERVER_NAME = os.getenv('SERVER_NAME',
                         'localhost:{0}'.format(os.getenv('DOCKER_WEB_PORT',
                                                           '8000')))
 
+# API responses are serialized with orjson when it's installed, set this to
+# "json" to always use the standard library (or "orjson" to require it).
+JSON_ENCODER = os.getenv('JSON_ENCODER', 'auto')
+
+# Responses get a Server-Timing header with the number of SQL queries and
+# Stripe calls made for them, and the time they took. Every client can read
+# it, so only enable it where that's fine (such as development). Set
+# REQUEST_METRICS_LOG to true to also log them for every request, along with
+# the endpoint.
+REQUEST_METRICS_ENABLED = bool(
+    strtobool(os.getenv('REQUEST_METRICS_ENABLED', 'false')))
+REQUEST_METRICS_LOG = bool(strtobool(os.getenv('REQUEST_METRICS_LOG',
+                                               'false')))
+
 # SQLALchemy
 pg_user = os.getenv('POSTGRES_USER', 'vidme')
 pg_pass = os.getenv('POSTGRES_PASSWORD', 'password')
@@ -47,10 +61,65 @@ CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELEREY_REDIS_MAX_CONNECTIONS = 5
+
+# Sign ins are pushed onto a Redis list and written to the users table in bulk
+# by the flush-activity-tracking task instead of committing on every login.
+# Without a Redis URL every login commits. A batch that hasn't been written
+# after PROCESSING_TIMEOUT seconds (its worker died) goes back in the buffer.
+ACTIVITY_BUFFER_ENABLED = bool(strtobool(os.getenv('ACTIVITY_BUFFER_ENABLED',
+                                                   'true')))
+ACTIVITY_BUFFER_REDIS_URL = os.getenv('ACTIVITY_BUFFER_REDIS_URL',
+                                      'redis://redis:6379/1')
+ACTIVITY_BUFFER_BATCH_SIZE = int(os.getenv('ACTIVITY_BUFFER_BATCH_SIZE', 500))
+ACTIVITY_BUFFER_PROCESSING_TIMEOUT = int(
+    os.getenv('ACTIVITY_BUFFER_PROCESSING_TIMEOUT', 300))
+ACTIVITY_BUFFER_FLUSH_INTERVAL = int(
+    os.getenv('ACTIVITY_BUFFER_FLUSH_INTERVAL', 30))
+
+# The admin dashboard reads user and plan counts from Redis hashes which are
+# updated on commit, they're rebuilt from the database every hour to fix drift
+DASHBOARD_COUNTERS_ENABLED = bool(
+    strtobool(os.getenv('DASHBOARD_COUNTERS_ENABLED', 'true')))
+DASHBOARD_COUNTERS_REDIS_URL = os.getenv('DASHBOARD_COUNTERS_REDIS_URL',
+                                         'redis://redis:6379/1')
+
+# Stripe webhooks are stored and acknowledged straight away, then applied in
+# batches by the process-stripe-events task. Set STRIPE_WEBHOOK_ASYNC to false
+# to apply them while stripe waits for a response instead.
+STRIPE_WEBHOOK_ASYNC = bool(strtobool(os.getenv('STRIPE_WEBHOOK_ASYNC',
+                                                'true')))
+STRIPE_WEBHOOK_BATCH_SIZE = int(os.getenv('STRIPE_WEBHOOK_BATCH_SIZE', 100))
+STRIPE_WEBHOOK_MAX_ATTEMPTS = int(os.getenv('STRIPE_WEBHOOK_MAX_ATTEMPTS', 10))
+STRIPE_WEBHOOK_INTERVAL = int(os.getenv('STRIPE_WEBHOOK_INTERVAL', 60))
+# With a signing secret (whsec_...) events are verified from their
+# Stripe-Signature header rather than by retrieving them from stripe.
+# Signatures are valid for TOLERANCE seconds, an event id is only accepted
+# once in that window.
+STRIPE_WEBHOOK_SECRET = os.getenv('STRIPE_WEBHOOK_SECRET')
+STRIPE_WEBHOOK_TOLERANCE = int(os.getenv('STRIPE_WEBHOOK_TOLERANCE', 300))
+STRIPE_WEBHOOK_REPLAY_CACHE_ENABLED = bool(
+    strtobool(os.getenv('STRIPE_WEBHOOK_REPLAY_CACHE_ENABLED', 'true')))
+STRIPE_WEBHOOK_REPLAY_CACHE_TTL = STRIPE_WEBHOOK_TOLERANCE
+STRIPE_WEBHOOK_REPLAY_CACHE_REDIS_URL = os.getenv(
+    'STRIPE_WEBHOOK_REPLAY_CACHE_REDIS_URL', 'redis://redis:6379/1')
+STRIPE_WEBHOOK_REPLAY_CACHE_REDIS_TTL = STRIPE_WEBHOOK_TOLERANCE
+
 CELERYBEAT_SCHEDULE = {
     'mark-soon-to-expire-credit-cards': {
         'task': 'vidme.blueprints.billing.tasks.mark_old_credit_cards',
         'schedule': crontab(hour=0, minute=0)
+    },
+    'flush-activity-tracking': {
+        'task': 'vidme.blueprints.user.tasks.flush_activity_tracking',
+        'schedule': ACTIVITY_BUFFER_FLUSH_INTERVAL
+    },
+    'reconcile-dashboard-counters': {
+        'task': 'vidme.blueprints.admin.tasks.reconcile_dashboard_counters',
+        'schedule': crontab(minute=0)
+    },
+    'process-stripe-events': {
+        'task': 'vidme.blueprints.billing.tasks.process_stripe_events',
+        'schedule': STRIPE_WEBHOOK_INTERVAL
     }
 }
 
@@ -77,8 +146,101 @@ JWT_ACCESS_COOKIE_PATH = '/'
 # Enable CSRF double submit protection (http://www.redotheweb.com/2015/11/09/api-security.html)
 JWT_COOKIE_CSRF_PROTECT = True
 
+# Password hashing, the method is passed to werkzeug's generate_password_hash
+# and existing hashes made with another method are replaced on the next login
+PASSWORD_HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD',
+                                 'pbkdf2:sha256:150000')
+PASSWORD_HASH_SALT_LENGTH = int(os.getenv('PASSWORD_HASH_SALT_LENGTH', 8))
+# Hash in a pool of processes per gunicorn worker (0 hashes on the request
+# thread).
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', 1))
+# Once CONCURRENCY hashes are running (across every gunicorn worker sharing
+# the Redis URL) logins and sign ups are turned away with a 429. Without a
+# Redis URL the limit is per worker, which only does anything with more than
+# 1 thread per worker. 0 disables the limit.
+PASSWORD_HASH_CONCURRENCY = int(os.getenv('PASSWORD_HASH_CONCURRENCY', 8))
+PASSWORD_HASH_REDIS_URL = os.getenv('PASSWORD_HASH_REDIS_URL',
+                                    'redis://redis:6379/1')
+PASSWORD_HASH_SLOT_TIMEOUT = int(os.getenv('PASSWORD_HASH_SLOT_TIMEOUT', 30))
+
+# Snapshots of the authenticated user (with their subscription and credit
+# card) so protected endpoints don't need to hit the DB to load current_user.
+# Every write changes the user's version in Redis and each hit (in the per
+# worker LRU too) is checked against it, so a write in any worker is seen
+# right away. Password hashes are never cached. Without a Redis URL versions
+# are per worker and only its own writes are seen, so keep the LRU's TTL short.
+IDENTITY_CACHE_ENABLED = bool(strtobool(os.getenv('IDENTITY_CACHE_ENABLED',
+                                                  'true')))
+IDENTITY_CACHE_SIZE = int(os.getenv('IDENTITY_CACHE_SIZE', 1024))
+IDENTITY_CACHE_TTL = int(os.getenv('IDENTITY_CACHE_TTL', 5))
+IDENTITY_CACHE_REDIS_URL = os.getenv('IDENTITY_CACHE_REDIS_URL',
+                                     'redis://redis:6379/1')
+IDENTITY_CACHE_REDIS_TTL = int(os.getenv('IDENTITY_CACHE_REDIS_TTL', 300))
+
+# Users are bulk deleted in batches, the subscriptions of each batch are
+# cancelled on stripe with a pool of threads. Each request is already retried
+# by the stripe HTTP client (STRIPE_MAX_NETWORK_RETRIES), a whole
+# cancellation is retried RETRIES more times on top of that.
+USER_DELETE_BATCH_SIZE = int(os.getenv('USER_DELETE_BATCH_SIZE', 500))
+USER_DELETE_STRIPE_WORKERS = int(os.getenv('USER_DELETE_STRIPE_WORKERS', 8))
+USER_DELETE_STRIPE_RETRIES = int(os.getenv('USER_DELETE_STRIPE_RETRIES', 1))
+
+# Add the subscription plan/status and the user's auth version to access
+# token claims so that lib.decorators can authorize requests from the claims.
+# The version is checked against current_user (usually from the identity
+# cache), its role and subscription are only used when the token is outdated.
+# current_user is always loaded first, so the claims don't save a DB lookup.
+JWT_CLAIMS_AUTHORIZATION = bool(strtobool(os.getenv('JWT_CLAIMS_AUTHORIZATION',
+                                                    'true')))
+
+# Stripe products (used to parse invoices) are cached per gunicorn worker and
+# in Redis. They're evicted when a plan is updated or deleted, other workers'
+# local copies expire after STRIPE_PRODUCT_CACHE_TTL seconds.
+STRIPE_PRODUCT_CACHE_ENABLED = bool(
+    strtobool(os.getenv('STRIPE_PRODUCT_CACHE_ENABLED', 'true')))
+STRIPE_PRODUCT_CACHE_SIZE = int(os.getenv('STRIPE_PRODUCT_CACHE_SIZE', 64))
+STRIPE_PRODUCT_CACHE_TTL = int(os.getenv('STRIPE_PRODUCT_CACHE_TTL', 300))
+STRIPE_PRODUCT_CACHE_REDIS_URL = os.getenv('STRIPE_PRODUCT_CACHE_REDIS_URL',
+                                           'redis://redis:6379/1')
+STRIPE_PRODUCT_CACHE_REDIS_TTL = int(
+    os.getenv('STRIPE_PRODUCT_CACHE_REDIS_TTL', 86400))
+
+# Upcoming invoices are cached per customer and served stale while they're
+# refreshed in the background once they're older than the FRESH_TTL. They're
+# evicted when a subscription changes and refreshed by stripe's webhooks.
+UPCOMING_INVOICE_CACHE_ENABLED = bool(
+    strtobool(os.getenv('UPCOMING_INVOICE_CACHE_ENABLED', 'true')))
+UPCOMING_INVOICE_CACHE_SIZE = int(os.getenv('UPCOMING_INVOICE_CACHE_SIZE',
+                                            1024))
+UPCOMING_INVOICE_CACHE_TTL = int(os.getenv('UPCOMING_INVOICE_CACHE_TTL', 30))
+UPCOMING_INVOICE_CACHE_REDIS_URL = os.getenv(
+    'UPCOMING_INVOICE_CACHE_REDIS_URL', 'redis://redis:6379/1')
+UPCOMING_INVOICE_CACHE_REDIS_TTL = int(
+    os.getenv('UPCOMING_INVOICE_CACHE_REDIS_TTL', 86400))
+UPCOMING_INVOICE_CACHE_FRESH_TTL = int(
+    os.getenv('UPCOMING_INVOICE_CACHE_FRESH_TTL', 300))
+
 # Stripe(publishable and secret key should go in instance.settings)
 STRIPE_API_VERSION = '2018-02-28' # tell the stripe python project which version to use
+# Point the stripe library at another server, such as lib.fake_stripe
+STRIPE_API_BASE = os.getenv('STRIPE_API_BASE')
+# Every Stripe call goes through a pooled HTTP client (see
+# vidme.blueprints.billing.gateways.http_client). Timeouts are in seconds,
+# reads are GETs and writes are POSTs/DELETEs.
+STRIPE_CONNECT_TIMEOUT = float(os.getenv('STRIPE_CONNECT_TIMEOUT', 2))
+STRIPE_READ_TIMEOUT = float(os.getenv('STRIPE_READ_TIMEOUT', 10))
+STRIPE_WRITE_TIMEOUT = float(os.getenv('STRIPE_WRITE_TIMEOUT', 20))
+STRIPE_POOL_SIZE = int(os.getenv('STRIPE_POOL_SIZE', 10))
+STRIPE_MAX_NETWORK_RETRIES = int(os.getenv('STRIPE_MAX_NETWORK_RETRIES', 2))
+STRIPE_RETRY_DELAY = float(os.getenv('STRIPE_RETRY_DELAY', 0.5))
+# Fail fast for RESET_TIMEOUT seconds after THRESHOLD failed calls in a row
+STRIPE_CIRCUIT_BREAKER_THRESHOLD = int(
+    os.getenv('STRIPE_CIRCUIT_BREAKER_THRESHOLD', 5))
+STRIPE_CIRCUIT_BREAKER_RESET_TIMEOUT = int(
+    os.getenv('STRIPE_CIRCUIT_BREAKER_RESET_TIMEOUT', 30))
+# How long clients and CDNs may cache the list of plans (PlansView:index)
+# before revalidating it.
+PLANS_CACHE_MAX_AGE = int(os.getenv('PLANS_CACHE_MAX_AGE', 300))
 STRIPE_PLANS = {
   '0': {
     'id': 'bronze',
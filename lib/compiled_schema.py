@@ -0,0 +1,165 @@
+import datetime
+
+from marshmallow import fields as ma_fields, missing
+from marshmallow.decorators import POST_DUMP, PRE_DUMP
+
+# Inferred fields return values of these types as they are
+_PASSTHROUGH_TYPES = frozenset([str, int, float, bool, type(None), list,
+                                tuple, set])
+
+
+def _inferred_serializer(schema, name, field):
+    """
+    Serialize a field inferred from Meta.fields the way marshmallow would,
+    without creating and binding a field for the value's type every time.
+    Types marshmallow does more work for are handed to the field itself.
+
+    :param schema: Schema the field belongs to
+    :param name: Attribute name
+    :type name: str
+    :param field: Bound marshmallow field
+    :return: Function of (value, obj)
+    """
+    converters = {}
+    if schema.opts.datetimeformat is None:
+        converters[datetime.datetime] = datetime.datetime.isoformat
+    if schema.opts.dateformat is None:
+        converters[datetime.date] = datetime.date.isoformat
+
+    fallback = field._serialize
+    get_converter = converters.get
+
+    def serialize(value, obj):
+        cls = value.__class__
+        if cls in _PASSTHROUGH_TYPES:
+            return value
+
+        convert = get_converter(cls)
+        if convert is not None:
+            return convert(value)
+
+        return fallback(value, name, obj)
+
+    return serialize
+
+
+def _nested_serializer(field):
+    """
+    Inline the compiled dump function of a nested schema.
+
+    :param field: Bound marshmallow Nested field
+    :return: Function of (value, obj)
+    """
+    dump_one = _compile(field.schema)
+    many = field.many or field.schema.many
+
+    def serialize(value, obj):
+        if value is None:
+            return None
+
+        if many:
+            return [dump_one(item) for item in value]
+
+        return dump_one(value)
+
+    return serialize
+
+
+def _field_serializer(schema, name, field):
+    """
+    Serialize any other field with marshmallow.
+
+    :param schema: Schema the field belongs to
+    :param name: Attribute name
+    :type name: str
+    :param field: Bound marshmallow field
+    :return: Function of (value, obj)
+    """
+    def serialize(value, obj):
+        return field.serialize(name, obj, accessor=schema.get_attribute)
+
+    return serialize
+
+
+def _compile(schema):
+    """
+    Generate a function which dumps 1 object with a schema. Attributes are
+    read directly and every field's serializer is resolved up front, so
+    nothing is looked up per object.
+
+    :param schema: marshmallow Schema instance
+    :return: Function
+    """
+    if schema._has_processors(PRE_DUMP) or schema._has_processors(POST_DUMP):
+        raise ValueError('{0} has dump hooks, it can\'t be compiled.'.format(
+            type(schema).__name__))
+
+    namespace = {'missing': missing}
+    items = []
+    filter_missing = False
+
+    for i, (name, field) in enumerate(schema.dump_fields.items()):
+        key = field.data_key or name
+        # Attributes the generated code can't read directly go through
+        # marshmallow, it also handles missing values
+        direct = name.isidentifier() and field.attribute is None
+
+        if isinstance(field, ma_fields.Inferred) and direct:
+            serializer = _inferred_serializer(schema, name, field)
+        elif isinstance(field, ma_fields.Nested) and direct:
+            serializer = _nested_serializer(field)
+        else:
+            serializer = _field_serializer(schema, name, field)
+            direct = False
+            filter_missing = True
+
+        namespace['s{0}'.format(i)] = serializer
+        value = 'obj.{0}'.format(name) if direct else 'None'
+        items.append('{0!r}: s{1}({2}, obj)'.format(key, i, value))
+
+    body = '{{{0}}}'.format(', '.join(items))
+    if filter_missing:
+        # Like marshmallow, leave out fields without a value
+        body = '{{key: value for key, value in {0}.items() ' \
+            'if value is not missing}}'.format(body)
+
+    source = 'def dump(obj):\n    return {0}\n'.format(body)
+    exec(compile(source, '<compiled {0}>'.format(type(schema).__name__),
+                 'exec'), namespace)
+
+    return namespace['dump']
+
+
+class CompiledSchema(object):
+    """
+    Wrap a marshmallow schema with a dump function generated for it, for
+    schemas which dump a lot of objects. The output is the same as the
+    schema's own dump, schemas with pre/post dump hooks can't be compiled.
+    Everything other than dump is passed on to the schema.
+
+    Objects are expected to have every field as an attribute, such as model
+    instances.
+    """
+    def __init__(self, schema):
+        self.schema = schema
+        self._dump_one = _compile(schema)
+
+    def __getattr__(self, name):
+        return getattr(self.schema, name)
+
+    def dump(self, obj, many=None):
+        """
+        Serialize an object, or a list of objects.
+
+        :param obj: Object(s) to serialize
+        :param many: Defaults to the schema's many
+        :type many: bool
+        :return: dict or list
+        """
+        many = self.schema.many if many is None else many
+
+        if many:
+            dump_one = self._dump_one
+            return [dump_one(item) for item in obj]
+
+        return self._dump_one(obj)
@@ -0,0 +1,157 @@
+import threading
+from collections import defaultdict
+
+import redis
+
+
+class CounterStore(object):
+    """
+    A Flask extension for keeping groups of counters (such as users per role)
+    that can be read in O(1). Counters live in Redis hashes shared by every
+    worker, or in-process without a Redis URL.
+
+    Settings are read from the app config using a prefix, for example with a
+    prefix of "DASHBOARD_COUNTERS":
+
+        DASHBOARD_COUNTERS_ENABLED, DASHBOARD_COUNTERS_REDIS_URL
+    """
+    # Increment counters (ARGV holds counter, amount pairs) only if the group
+    # exists, checking and incrementing in a single step so that a group
+    # which is replaced or removed in between isn't left with partial counts
+    INCR_IF_EXISTS = """
+        if redis.call('EXISTS', KEYS[1]) == 0 then
+            return 0
+        end
+        for i = 1, #ARGV, 2 do
+            redis.call('HINCRBY', KEYS[1], ARGV[i], ARGV[i + 1])
+        end
+        return 1
+    """
+
+    def __init__(self, config_prefix):
+        self.config_prefix = config_prefix
+        self.prefix = config_prefix.lower()
+        self.enabled = False
+        self.client = None
+        self._incr_if_exists = None
+        self._groups = {}
+        self._lock = threading.Lock()
+
+    def _config(self, app, name, default=None):
+        return app.config.get('{0}_{1}'.format(self.config_prefix, name),
+                              default)
+
+    def _key(self, group):
+        return '{0}:{1}'.format(self.prefix, group)
+
+    def init_app(self, app):
+        """
+        Configure the store from the Flask app's config.
+
+        :param app: Flask application instance
+        :return: None
+        """
+        self.enabled = self._config(app, 'ENABLED', True)
+
+        redis_url = self._config(app, 'REDIS_URL')
+        if redis_url:
+            self.client = redis.StrictRedis.from_url(redis_url)
+            self._incr_if_exists = self.client.register_script(
+                CounterStore.INCR_IF_EXISTS)
+        else:
+            self.client = None
+
+        return None
+
+    def get(self, group):
+        """
+        Return every counter in a group, or None if the group has never been
+        set (or can't be read) and needs to be rebuilt with replace().
+
+        :param group: Group name
+        :type group: str
+        :return: dict or None
+        """
+        if not self.enabled:
+            return None
+
+        if self.client is None:
+            with self._lock:
+                counts = self._groups.get(group)
+                return dict(counts) if counts is not None else None
+
+        try:
+            counts = self.client.hgetall(self._key(group))
+        except redis.exceptions.RedisError:
+            return None
+
+        if not counts:
+            return None
+
+        return {key.decode('utf-8'): int(value)
+                for key, value in counts.items()}
+
+    def incr(self, group, deltas):
+        """
+        Add to 1 or more counters of a group. Groups which were never set are
+        left alone, incrementing them would only give partial counts.
+
+        :param group: Group name
+        :type group: str
+        :param deltas: Amount to add to each counter
+        :type deltas: dict
+        :return: None
+        """
+        if not self.enabled or not deltas:
+            return None
+
+        if self.client is None:
+            with self._lock:
+                counts = self._groups.get(group)
+                if counts is not None:
+                    for key, amount in deltas.items():
+                        counts[key] += amount
+            return None
+
+        args = []
+        for counter, amount in deltas.items():
+            args.extend([counter, amount])
+
+        try:
+            self._incr_if_exists(keys=[self._key(group)], args=args)
+        except redis.exceptions.RedisError:
+            pass
+
+        return None
+
+    def replace(self, group, counts):
+        """
+        Replace every counter of a group.
+
+        :param group: Group name
+        :type group: str
+        :param counts: Counters
+        :type counts: dict
+        :return: None
+        """
+        if not self.enabled:
+            return None
+
+        if self.client is None:
+            with self._lock:
+                self._groups[group] = defaultdict(int, counts)
+            return None
+
+        key = self._key(group)
+        try:
+            pipeline = self.client.pipeline()
+            pipeline.delete(key)
+            # An empty group still needs to exist so it isn't rebuilt again
+            pipeline.hset(key, '', 0)
+            for counter, count in counts.items():
+                pipeline.hset(key, counter, count)
+            pipeline.execute()
+        except redis.exceptions.RedisError:
+            pass
+
+        return None
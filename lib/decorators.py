@@ -1,7 +1,7 @@
 from functools import wraps
 
 import stripe
-from flask import jsonify
+from flask import jsonify, request
 from flask_jwt_extended import (
     verify_jwt_in_request,
     get_jwt_claims,
@@ -9,6 +9,27 @@ from flask_jwt_extended import (
 )
 
 
+def claims_are_current():
+    """
+    Determine if the role and subscription claims in the current access token
+    can be trusted. Tokens issued without a version (JWT_CLAIMS_AUTHORIZATION
+    was disabled) or before the user's role or subscription last changed are
+    not, and the caller should check current_user instead.
+
+    The version is compared with current_user's, verify_jwt_in_request has
+    already loaded the user (from the identity cache or with 1 query) so this
+    doesn't need a query of its own.
+
+    :return: bool
+    """
+    version = get_jwt_claims().get('version')
+
+    if version is None or not current_user:
+        return False
+
+    return version == current_user.auth_version
+
+
 def admin_required(fn):
     """
     Will protect endpoints to make sure that 1) a valid JWT is provided, and
@@ -23,7 +44,15 @@ def admin_required(fn):
     def wrapper(*args, **kwargs):
         verify_jwt_in_request()  # will return a 401 if no token provided
         claims = get_jwt_claims()
-        if claims['role'] != 'admin':
+
+        # Tokens without a version predate claims authorization, their role
+        # claim is trusted as it always has been
+        if claims.get('version') is None or claims_are_current():
+            role = claims['role']
+        else:
+            role = current_user.role
+
+        if role != 'admin':
             response = {
                 'error': {
                     'message': 'Admin required.'
@@ -38,7 +67,8 @@ def admin_required(fn):
 def jwt_and_subscription_required(fn):
     """
     Ensures a user is authenticated and has an active subscription before
-    accessing certain endpoints.
+    accessing certain endpoints. The subscription status claim is used when
+    it's current, otherwise current_user's subscription.
 
     :param fn: Function being decorated
     :type fn: Function
@@ -47,7 +77,12 @@ def jwt_and_subscription_required(fn):
     @wraps(fn)
     def decorated_function(*args, **kwargs):
         verify_jwt_in_request()
-        if not current_user.subscription:
+        if claims_are_current():
+            subscribed = get_jwt_claims()['subscription_status'] == 'active'
+        else:
+            subscribed = current_user.subscription is not None
+
+        if not subscribed:
             msg = 'You need an active subscription to access this resource.'
             response = {
                 'error': msg
@@ -97,3 +132,29 @@ def handle_stripe_exceptions(fn):
             return jsonify(response), 400
 
     return decorated_function
+
+
+def cache_policy(max_age=0, private=True):
+    """
+    Let clients (and shared caches, for public responses) keep the JSON
+    responses of a view. Responses get an ETag so a client with a current
+    copy is answered with a 304 instead of the whole body again, see
+    lib.representations.output_json.
+
+    :param max_age: Seconds a response can be used before it's revalidated
+    :type max_age: int
+    :param private: Only the client may cache it, not shared caches
+    :type private: bool
+    :return: Function
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def decorated_function(*args, **kwargs):
+            # On the request rather than g, which is shared by every request
+            # when an app context is already pushed
+            request.cache_policy = {'max_age': max_age, 'private': private}
+            return fn(*args, **kwargs)
+
+        return decorated_function
+
+    return decorator
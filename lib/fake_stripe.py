@@ -0,0 +1,267 @@
+import itertools
+import json
+import threading
+import time
+
+from werkzeug.serving import make_server
+from werkzeug.wrappers import Request, Response
+
+
+class FakeStripe(object):
+    """
+    A local HTTP server which speaks enough of Stripe's API for the billing
+    gateway to run against it in tests (point stripe.api_base at its url).
+
+    Every request is recorded, and failures can be injected to exercise
+    timeouts, retries and the circuit breaker:
+
+        fake.fail(2, status=500)  # the next 2 requests get a 500
+        fake.delay = 1            # wait a second before every response
+    """
+    def __init__(self, host='127.0.0.1', port=0):
+        self.requests = []
+        self.delay = 0
+        self._failures = []
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.customers = {}
+        self.subscriptions = {}
+        self.invoices = []
+
+        self._server = make_server(host, port, self._wsgi, threaded=True)
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://{0}:{1}'.format(self._server.server_address[0],
+                                       self._server.server_port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._thread.join()
+
+    def reset(self):
+        """
+        Forget every request, injected failure and object.
+
+        :return: None
+        """
+        with self._lock:
+            self.requests = []
+            self.delay = 0
+            self._failures = []
+            self.customers = {}
+            self.subscriptions = {}
+            self.invoices = []
+
+        return None
+
+    def fail(self, times=1, status=500):
+        """
+        Fail the next requests with a status code.
+
+        :param times: Number of requests to fail
+        :type times: int
+        :param status: HTTP status code
+        :type status: int
+        :return: None
+        """
+        with self._lock:
+            self._failures.extend([status] * times)
+
+        return None
+
+    def add_customer(self, plan=None):
+        """
+        Create a customer, subscribed to a plan if there is one.
+
+        :param plan: Plan identifier
+        :type plan: str
+        :return: dict
+        """
+        customer_id = self._id('cus')
+        subscriptions = []
+
+        if plan:
+            subscriptions.append(self._add_subscription(customer_id, plan))
+
+        customer = {
+            'id': customer_id,
+            'object': 'customer',
+            'subscriptions': self._list(subscriptions,
+                                        '/v1/customers/{0}/subscriptions'
+                                        .format(customer_id))
+        }
+        self.customers[customer_id] = customer
+
+        return customer
+
+    def add_invoice(self, customer_id, plan, created, receipt_number=None,
+                    total=500):
+        """
+        Create a paid subscription invoice.
+
+        :param customer_id: Customer the invoice belongs to
+        :type customer_id: str
+        :param plan: Plan identifier
+        :type plan: str
+        :param created: Unix timestamp
+        :type created: int
+        :param receipt_number: Receipt number
+        :type receipt_number: str
+        :param total: Amount in cents
+        :type total: int
+        :return: dict
+        """
+        invoice_id = self._id('in')
+        invoice = {
+            'id': invoice_id,
+            'object': 'invoice',
+            'customer': customer_id,
+            'created': created,
+            'date': created,
+            'receipt_number': receipt_number,
+            'currency': 'usd',
+            'tax': None,
+            'tax_percent': None,
+            'total': total,
+            'lines': self._list([{
+                'id': self._id('sli'),
+                'object': 'line_item',
+                'type': 'subscription',
+                'period': {'start': created, 'end': created + 2592000},
+                'plan': {'id': plan, 'object': 'plan', 'nickname': plan,
+                         'interval': 'month', 'product': 'prod_000'}
+            }], '/v1/invoices/{0}/lines'.format(invoice_id))
+        }
+        self.invoices.append(invoice)
+
+        return invoice
+
+    def _id(self, prefix):
+        return '{0}_{1:06d}'.format(prefix, next(self._ids))
+
+    def _list(self, data, url):
+        return {'object': 'list', 'data': data, 'has_more': False,
+                'url': url}
+
+    def _add_subscription(self, customer_id, plan):
+        subscription_id = self._id('sub')
+        subscription = {
+            'id': subscription_id,
+            'object': 'subscription',
+            'customer': customer_id,
+            'status': 'active',
+            'plan': {'id': plan, 'object': 'plan'},
+            'items': self._list([{'id': self._id('si'),
+                                  'object': 'subscription_item',
+                                  'plan': {'id': plan, 'object': 'plan'}}],
+                                '/v1/subscription_items')
+        }
+        self.subscriptions[subscription_id] = subscription
+
+        return subscription
+
+    def _error(self, status, message, type='invalid_request_error'):
+        return status, {'error': {'type': type, 'message': message}}
+
+    def _handle(self, request):
+        parts = request.path.strip('/').split('/')[1:]
+        method = request.method
+
+        if parts[:1] == ['customers']:
+            if method == 'POST' and len(parts) == 1:
+                return 200, self.add_customer(request.form.get('plan'))
+
+            customer = self.customers.get(parts[1]) if len(parts) > 1 \
+                else None
+            if customer is None:
+                return self._error(404, 'No such customer')
+
+            return 200, customer
+
+        if parts[:1] == ['subscriptions']:
+            if len(parts) == 1:
+                customer_id = request.args.get('customer')
+                data = [subscription for subscription
+                        in self.subscriptions.values()
+                        if subscription['customer'] == customer_id]
+                return 200, self._list(data, '/v1/subscriptions')
+
+            subscription = self.subscriptions.get(parts[1])
+            if subscription is None:
+                return self._error(404, 'No such subscription')
+
+            if method == 'DELETE':
+                del self.subscriptions[parts[1]]
+                return 200, dict(subscription, status='canceled')
+
+            if method == 'POST':
+                plan = request.form.get('items[0][plan]') or \
+                    request.form.get('plan')
+                if plan:
+                    subscription['plan'] = {'id': plan, 'object': 'plan'}
+                    subscription['items']['data'][0]['plan'] = \
+                        subscription['plan']
+
+            return 200, subscription
+
+        if parts == ['invoices'] and method == 'GET':
+            return 200, self._page(request, [
+                invoice for invoice in self.invoices
+                if invoice['customer'] == request.args.get('customer') and
+                invoice['created'] >= int(request.args.get('created[gte]',
+                                                           0)) and
+                invoice['created'] < int(request.args.get('created[lt]',
+                                                          2 ** 32))],
+                '/v1/invoices')
+
+        return self._error(404, 'Unrecognized request URL')
+
+    def _page(self, request, data, url):
+        # Newest first, like Stripe
+        data = sorted(data, key=lambda item: item['created'], reverse=True)
+        ids = [item['id'] for item in data]
+
+        starting_after = request.args.get('starting_after')
+        if starting_after in ids:
+            data = data[ids.index(starting_after) + 1:]
+
+        limit = int(request.args.get('limit', 10))
+        page = self._list(data[:limit], url)
+        page['has_more'] = len(data) > limit
+
+        return page
+
+    def _wsgi(self, environ, start_response):
+        request = Request(environ)
+
+        with self._lock:
+            self.requests.append({
+                'method': request.method,
+                'path': request.path,
+                'idempotency_key': request.headers.get('Idempotency-Key')
+            })
+            status = self._failures.pop(0) if self._failures else None
+
+        if self.delay:
+            time.sleep(self.delay)
+
+        if status:
+            status, body = self._error(status, 'Injected failure',
+                                       type='api_error')
+        else:
+            with self._lock:
+                status, body = self._handle(request)
+
+        response = Response(json.dumps(body), status=status,
+                            mimetype='application/json')
+
+        return response(environ, start_response)
@@ -0,0 +1,220 @@
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+import redis
+from werkzeug.security import (
+    DEFAULT_PBKDF2_ITERATIONS,
+    generate_password_hash,
+    check_password_hash
+)
+
+
+class PasswordHasherBusy(Exception):
+    """
+    Raised when too many passwords are already being hashed, views should
+    respond with a 429.
+    """
+    pass
+
+
+class PasswordHasher(object):
+    """
+    A Flask extension for hashing and verifying passwords in a bounded pool
+    of PASSWORD_HASH_WORKERS processes per gunicorn worker, so that the CPU
+    work doesn't hold the GIL while the worker's other threads serve
+    requests. Once PASSWORD_HASH_CONCURRENCY hashes are running
+    PasswordHasherBusy is raised, a burst of logins turns into 429s rather
+    than a queue in front of every pool.
+
+    The running hashes are counted in a Redis sorted set shared by every
+    worker (slots of a worker that died expire after
+    PASSWORD_HASH_SLOT_TIMEOUT seconds). Without a Redis URL they're counted
+    per process, which only limits anything when gunicorn runs more than 1
+    thread per worker.
+
+    With PASSWORD_HASH_WORKERS set to 0 passwords are hashed on the calling
+    thread and with PASSWORD_HASH_CONCURRENCY set to 0 there's no limit,
+    which is also the behavior until init_app is called.
+    """
+    def __init__(self):
+        self.method = 'pbkdf2:sha256:150000'
+        self.salt_length = 8
+        self.workers = 0
+        self.concurrency = 0
+        self.slot_timeout = 30
+        self.key = 'password_hash_slots'
+        self.client = None
+        self._running = 0
+        self._pool = None
+        self._pool_pid = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """
+        Configure the hasher from the Flask app's config.
+
+        :param app: Flask application instance
+        :return: None
+        """
+        self.method = app.config.get('PASSWORD_HASH_METHOD', self.method)
+        self.salt_length = app.config.get('PASSWORD_HASH_SALT_LENGTH',
+                                          self.salt_length)
+        self.workers = app.config.get('PASSWORD_HASH_WORKERS', 0)
+        self.concurrency = app.config.get('PASSWORD_HASH_CONCURRENCY', 0)
+        self.slot_timeout = app.config.get('PASSWORD_HASH_SLOT_TIMEOUT',
+                                           self.slot_timeout)
+
+        redis_url = app.config.get('PASSWORD_HASH_REDIS_URL')
+        if redis_url:
+            self.client = redis.StrictRedis.from_url(redis_url)
+        else:
+            self.client = None
+
+        return None
+
+    @contextmanager
+    def _slot(self):
+        """
+        Hold 1 of the concurrency slots while hashing, raises
+        PasswordHasherBusy if they're all taken.
+        """
+        if not self.concurrency:
+            yield
+            return
+
+        if self.client is None:
+            with self._lock:
+                if self._running >= self.concurrency:
+                    raise PasswordHasherBusy()
+                self._running += 1
+
+            try:
+                yield
+            finally:
+                with self._lock:
+                    self._running -= 1
+            return
+
+        token = uuid.uuid4().hex
+        now = time.time()
+
+        try:
+            pipeline = self.client.pipeline()
+            pipeline.zremrangebyscore(self.key, '-inf',
+                                      now - self.slot_timeout)
+            pipeline.zadd(self.key, {token: now})
+            pipeline.zcard(self.key)
+            _, _, running = pipeline.execute()
+        except redis.exceptions.RedisError:
+            # Logins keep working while Redis is down, just without a limit
+            token, running = None, 0
+
+        if running > self.concurrency:
+            self._release(token)
+            raise PasswordHasherBusy()
+
+        try:
+            yield
+        finally:
+            self._release(token)
+
+    def _release(self, token):
+        if token is None:
+            return None
+
+        try:
+            self.client.zrem(self.key, token)
+        except redis.exceptions.RedisError:
+            # It expires after slot_timeout
+            pass
+
+        return None
+
+    def _get_pool(self):
+        """
+        Gunicorn forks its workers after the app is created so every process
+        lazily starts a pool of its own.
+
+        :return: ProcessPoolExecutor
+        """
+        with self._lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+                self._pool_pid = os.getpid()
+
+        return self._pool
+
+    def _run(self, fn, *args):
+        """
+        Run a hashing function in the pool, or inline if there isn't one,
+        while holding a concurrency slot.
+
+        :param fn: Function to run
+        :type fn: Function
+        :return: Result of the function
+        """
+        with self._slot():
+            if not self.workers:
+                return fn(*args)
+
+            return self._get_pool().submit(fn, *args).result()
+
+    def hash(self, password):
+        """
+        Hash a plaintext password with the configured method and cost.
+
+        :param password: Password in plain text
+        :type password: str
+        :return: str
+        """
+        return self._run(generate_password_hash, password, self.method,
+                         self.salt_length)
+
+    def check(self, pwhash, password):
+        """
+        Verify a plaintext password against a hash.
+
+        :param pwhash: Hashed password
+        :type pwhash: str
+        :param password: Password in plain text
+        :type password: str
+        :return: bool
+        """
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """
+        Determine if a hash was made with a different method, cost or salt
+        length than the ones currently configured.
+
+        :param pwhash: Hashed password
+        :type pwhash: str
+        :return: bool
+        """
+        if pwhash is None or pwhash.count('$') < 2:
+            return True
+
+        method, salt, _ = pwhash.split('$', 2)
+
+        return method != _full_method(self.method) or \
+            len(salt) != self.salt_length
+
+
+def _full_method(method):
+    """
+    Add werkzeug's default iteration count to a pbkdf2 method without one,
+    hashes always include it so "pbkdf2:sha256" is stored as
+    "pbkdf2:sha256:150000".
+
+    :param method: Hash method
+    :type method: str
+    :return: str
+    """
+    if method.startswith('pbkdf2:') and method.count(':') == 1:
+        return '{0}:{1}'.format(method, DEFAULT_PBKDF2_ITERATIONS)
+
+    return method
@@ -0,0 +1,72 @@
+import hashlib
+
+from lib.util_json import dumps
+
+
+class _FrozenDict(dict):
+    """
+    A dict which can't be changed after it's created, it still serializes
+    like any other dict.
+    """
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('Plans are read only.')
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return _FrozenDict((key, _freeze(item)) for key, item in value.items())
+
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+
+    return value
+
+
+class PlanRegistry(object):
+    """
+    A Flask extension holding the subscription plans of STRIPE_PLANS, built
+    once when the app is created. Plans are looked up by id without scanning
+    the settings.
+
+    The list of plans is serialized up front along with a strong ETag, so
+    it can be sent as is and answered with a 304 when it hasn't changed.
+    """
+    def __init__(self):
+        self.plans = _FrozenDict()
+        self.json = b''
+        self.etag = None
+
+    def init_app(self, app):
+        """
+        Build the registry from the Flask app's config.
+
+        :param app: Flask application instance
+        :return: None
+        """
+        plans = {}
+
+        for plan in (app.config.get('STRIPE_PLANS') or {}).values():
+            plan = _freeze(plan)
+            plans[plan['id']] = plan
+
+        self.plans = _FrozenDict(plans)
+
+        # Same format as lib.representations.output_json
+        self.json = dumps({'data': {'plans': self.plans}},
+                          app.config.get('JSON_ENCODER', 'auto'))
+        self.etag = hashlib.sha256(self.json).hexdigest()[:32]
+
+        return None
+
+    def get(self, plan):
+        """
+        Get a plan by its identifier.
+
+        :param plan: Plan identifier
+        :type plan: str
+        :return: dict or None
+        """
+        return self.plans.get(plan)
@@ -1,12 +1,18 @@
-import json
+import hashlib
 
-from flask import make_response
+from flask import current_app, make_response, request
+
+from lib.util_json import dumps
 
 
 def output_json(data, code=200, headers=None):
     """
     Returns a JSON response in our API views, including headers, and a status
-    code.
+    code. Data is serialized straight to bytes by the JSON_ENCODER backend.
+
+    Views with a cache policy (see lib.decorators.cache_policy) get an ETag
+    and Cache-Control headers, and conditional requests for a response that
+    hasn't changed are answered with a 304.
 
     :param data: Data to send to the client
     :type data: dict
@@ -21,7 +27,7 @@ def output_json(data, code=200, headers=None):
     if data == '':
         dumped = data
     else:
-        dumped = json.dumps(data, default=str)
+        dumped = dumps(data, current_app.config.get('JSON_ENCODER', 'auto'))
 
     if headers:
         headers.update({'Content-Type': content_type})
@@ -29,4 +35,75 @@ def output_json(data, code=200, headers=None):
         headers = {'Content-Type': content_type}
     
     response = make_response(dumped, code, headers)
+
+    if response.status_code == 200 and \
+            getattr(request, 'cache_policy', None) is not None:
+        response = make_conditional(response)
+
     return response
+
+
+def cache_validators(*resources):
+    """
+    Build an ETag and Last-Modified date for a response made of 1 or more
+    model instances (anything with an id and updated_on). Strings, such as
+    the version of something else the response depends on, and None (a
+    missing resource) are part of the ETag too.
+
+    :param resources: Model instances, strings or None
+    :return: tuple of (etag, last modified date)
+    """
+    parts = []
+    last_modified = None
+
+    for resource in resources:
+        if resource is None or isinstance(resource, str):
+            parts.append(str(resource))
+            continue
+
+        updated_on = resource.updated_on
+        parts.append('{0}:{1}:{2}'.format(
+            resource.__tablename__, resource.id,
+            updated_on.isoformat() if updated_on else ''))
+
+        if updated_on and (last_modified is None or
+                           updated_on > last_modified):
+            last_modified = updated_on
+
+    etag = hashlib.sha256('|'.join(parts).encode('utf-8')).hexdigest()[:32]
+
+    return etag, last_modified
+
+
+def make_conditional(response):
+    """
+    Add the cache headers of the current view's cache policy to a response,
+    and turn it into a 304 when the client's copy is still current. The
+    ETag comes from the validators set by the view, or from the body.
+
+    :param response: Flask response
+    :return: Flask response
+    """
+    policy = getattr(request, 'cache_policy', None) or \
+        {'max_age': 0, 'private': True}
+    etag, last_modified = getattr(request, 'cache_validators', None) or \
+        (None, None)
+
+    if etag is None and response.get_data():
+        etag = hashlib.sha256(response.get_data()).hexdigest()[:32]
+
+    if etag:
+        response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+
+    if policy['private']:
+        response.cache_control.private = True
+    else:
+        response.cache_control.public = True
+    response.cache_control.max_age = policy['max_age']
+    if not policy['max_age']:
+        # Clients may keep it, but have to check it's current every time
+        response.cache_control.no_cache = True
+
+    return response.make_conditional(request)
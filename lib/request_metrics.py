@@ -0,0 +1,150 @@
+import time
+
+from flask import current_app, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class RequestMetrics(object):
+    """
+    A Flask extension which counts the SQL queries and Stripe calls made
+    while handling a request, along with the time spent in them.
+
+    Every response gets a Server-Timing header, browsers show it next to the
+    request in their dev tools. It exposes internal timings to clients, so
+    it's off unless REQUEST_METRICS_ENABLED is set. With log enabled the
+    same numbers are logged per endpoint, as fields of the log record for
+    structured log handlers. Queries and calls made outside of a request
+    (celery tasks, CLI commands) aren't tracked.
+    """
+    # Metric -> Server-Timing description
+    METRICS = (('sql', 'queries'), ('stripe', 'calls'))
+
+    def __init__(self):
+        self.enabled = False
+        self.log = False
+        self._listening = False
+
+    def init_app(self, app):
+        """
+        Register the request hooks on the Flask app.
+
+        :param app: Flask application instance
+        :return: None
+        """
+        self.enabled = app.config.get('REQUEST_METRICS_ENABLED', False)
+        self.log = app.config.get('REQUEST_METRICS_LOG', False)
+
+        if not self.enabled:
+            return None
+
+        app.before_request(self._start)
+        app.after_request(self._finish)
+
+        # Listen on every engine once, no matter how many apps are created
+        if not self._listening:
+            event.listen(Engine, 'before_cursor_execute', self._before_query)
+            event.listen(Engine, 'after_cursor_execute', self._after_query)
+            event.listen(Engine, 'handle_error', self._failed_query)
+            self._listening = True
+
+        return None
+
+    def record(self, metric, seconds):
+        """
+        Count a call made by the current request.
+
+        :param metric: Metric name, such as sql or stripe
+        :type metric: str
+        :param seconds: Time the call took
+        :type seconds: float
+        :return: None
+        """
+        metrics = self.current()
+
+        if metrics is not None:
+            count, total = metrics.get(metric, (0, 0.0))
+            metrics[metric] = (count + 1, total + seconds)
+
+        return None
+
+    def current(self):
+        """
+        Get the metrics of the current request.
+
+        :return: dict of metric -> (count, seconds), or None outside a
+            request
+        """
+        if not has_request_context():
+            return None
+
+        # Kept on the request rather than g, which outlives the request when
+        # an app context was already pushed
+        return getattr(request, 'request_metrics', None)
+
+    def server_timing(self, metrics, duration):
+        """
+        Format metrics as a Server-Timing header, durations are in ms.
+
+        :param metrics: Metrics of a request
+        :type metrics: dict
+        :param duration: Time spent on the request, in seconds
+        :type duration: float
+        :return: str
+        """
+        entries = []
+
+        for metric, description in RequestMetrics.METRICS:
+            count, seconds = metrics.get(metric, (0, 0.0))
+            entries.append('{0};desc="{1} {2}";dur={3:.1f}'.format(
+                metric, count, description, seconds * 1000))
+
+        entries.append('app;dur={0:.1f}'.format(duration * 1000))
+
+        return ', '.join(entries)
+
+    def _start(self):
+        request.request_metrics = {}
+        request.request_metrics_started_on = time.perf_counter()
+
+    def _finish(self, response):
+        metrics = self.current()
+        if metrics is None:
+            return response
+
+        duration = time.perf_counter() - request.request_metrics_started_on
+        response.headers['Server-Timing'] = self.server_timing(metrics,
+                                                               duration)
+
+        if self.log:
+            fields = {'endpoint': request.endpoint,
+                      'status': response.status_code,
+                      'duration_ms': round(duration * 1000, 1)}
+
+            for metric, description in RequestMetrics.METRICS:
+                count, seconds = metrics.get(metric, (0, 0.0))
+                fields['{0}_{1}'.format(metric, description)] = count
+                fields['{0}_ms'.format(metric)] = round(seconds * 1000, 1)
+
+            message = ' '.join('{0}={1}'.format(key, value)
+                               for key, value in sorted(fields.items()))
+            current_app.logger.info(message,
+                                    extra={'request_metrics': fields})
+
+        return response
+
+    def _before_query(self, conn, cursor, statement, parameters, context,
+                      executemany):
+        conn.info.setdefault('request_metrics_started_on', []).append(
+            time.perf_counter())
+
+    def _after_query(self, conn, *args):
+        started_on = conn.info.get('request_metrics_started_on')
+
+        if started_on:
+            self.record('sql', time.perf_counter() - started_on.pop())
+
+    def _failed_query(self, context):
+        # Failed queries are counted too, other errors have no cursor
+        if context.connection is not None and context.cursor is not None:
+            self._after_query(context.connection)
@@ -1,5 +1,10 @@
+from contextlib import contextmanager
+
 import pytest
 from flask import url_for
+from sqlalchemy import event
+
+from vidme.extensions import db
 
 
 def assert_status_with_message(status_code=200, response=None, message=None):
@@ -21,6 +26,34 @@ def assert_status_with_message(status_code=200, response=None, message=None):
     assert message in str(response.data)
 
 
+@contextmanager
+def assert_max_queries(max_queries):
+    """
+    Check that no more than a number of SQL queries are run within the block,
+    savepoints don't count.
+
+    :param max_queries: Max number of queries
+    :type max_queries: int
+
+    :return: list of the queries that were run
+    """
+    queries = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        if not statement.startswith(('SAVEPOINT', 'RELEASE', 'ROLLBACK')):
+            queries.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        yield queries
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count)
+
+    assert len(queries) <= max_queries, \
+        '{0} queries were run, expected at most {1}:\n{2}'.format(
+            len(queries), max_queries, '\n'.join(queries))
+
+
 class ViewTestMixin(object):
     """
     Automatically load in a session and client. To be used on view tests.
@@ -0,0 +1,506 @@
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+import redis
+
+
+class LRUCache(object):
+    """
+    A thread safe, in-process least recently used cache. Every entry expires
+    after a fixed amount of seconds so that workers which never see a write
+    don't serve an old value forever.
+    """
+    def __init__(self, maxsize=1024, ttl=5):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Get a value, or None if it's missing or has expired.
+
+        :param key: Cache key
+        :type key: str
+        :return: Cached value or None
+        """
+        with self._lock:
+            item = self._data.get(key)
+
+            if item is None:
+                return None
+
+            expires_on, value = item
+            if expires_on <= time.monotonic():
+                del self._data[key]
+                return None
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Add a value, evicting the least recently used entries once the cache
+        is full.
+
+        :param key: Cache key
+        :type key: str
+        :param value: Value to cache
+        :param ttl: Seconds until it expires, defaults to the cache's TTL
+        :type ttl: int
+        :return: None
+        """
+        expires_on = time.monotonic() + (self.ttl if ttl is None else ttl)
+
+        with self._lock:
+            self._data[key] = (expires_on, value)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+        return None
+
+    def add(self, key, value, ttl=None):
+        """
+        Add a value unless the key already exists.
+
+        :param key: Cache key
+        :type key: str
+        :param value: Value to cache
+        :param ttl: Seconds until it expires, defaults to the cache's TTL
+        :type ttl: int
+        :return: bool, True if the value was added
+        """
+        now = time.monotonic()
+
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[0] > now:
+                return False
+
+            self._data[key] = (now + (self.ttl if ttl is None else ttl),
+                               value)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+        return True
+
+    def delete(self, *keys):
+        """
+        Remove 1 or more keys.
+
+        :return: None
+        """
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+        return None
+
+    def clear(self):
+        """
+        Remove every entry.
+
+        :return: None
+        """
+        with self._lock:
+            self._data.clear()
+
+        return None
+
+
+class RedisCache(object):
+    """
+    A cache shared by every gunicorn worker (and celery) through Redis. Values
+    are pickled. Redis being down is treated as a cache miss, a cache should
+    never take the API down with it.
+    """
+    # Set a value only if the key's version (the cache's epoch and the key's
+    # own counter) hasn't changed since it was read
+    SET_IF_VERSION = """
+        local version = (redis.call('GET', KEYS[2]) or '0') .. '.' ..
+            (redis.call('GET', KEYS[3]) or '0')
+        if version ~= ARGV[1] then
+            return 0
+        end
+        redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+        return 1
+    """
+
+    def __init__(self, url, ttl=300, prefix='cache'):
+        self.ttl = ttl
+        self.prefix = prefix
+        self.client = redis.StrictRedis.from_url(url)
+        self._set_if_version = self.client.register_script(
+            RedisCache.SET_IF_VERSION)
+
+    def _key(self, key):
+        return '{0}:{1}'.format(self.prefix, key)
+
+    def _version_keys(self, key):
+        return ('{0}:version'.format(self.prefix),
+                '{0}:version:{1}'.format(self.prefix, key))
+
+    def get(self, key):
+        """
+        Get a value, or None if it's missing or Redis can't be reached.
+
+        :param key: Cache key
+        :type key: str
+        :return: Cached value or None
+        """
+        try:
+            value = self.client.get(self._key(key))
+        except redis.exceptions.RedisError:
+            return None
+
+        if value is None:
+            return None
+
+        return pickle.loads(value)
+
+    def set(self, key, value, ttl=None):
+        """
+        Add a value.
+
+        :param key: Cache key
+        :type key: str
+        :param value: Value to cache
+        :param ttl: Seconds until it expires, defaults to the cache's TTL
+        :type ttl: int
+        :return: None
+        """
+        try:
+            self.client.setex(self._key(key), self.ttl if ttl is None else ttl,
+                              pickle.dumps(value))
+        except redis.exceptions.RedisError:
+            pass
+
+        return None
+
+    def add(self, key, value, ttl=None):
+        """
+        Add a value unless the key already exists, atomically. When Redis
+        can't be reached the value is considered added.
+
+        :param key: Cache key
+        :type key: str
+        :param value: Value to cache
+        :param ttl: Seconds until it expires, defaults to the cache's TTL
+        :type ttl: int
+        :return: bool, True if the value was added
+        """
+        try:
+            return bool(self.client.set(self._key(key), pickle.dumps(value),
+                                        nx=True,
+                                        ex=self.ttl if ttl is None else ttl))
+        except redis.exceptions.RedisError:
+            return True
+
+    def delete(self, *keys):
+        """
+        Remove 1 or more keys.
+
+        :return: None
+        """
+        if not keys:
+            return None
+
+        try:
+            self.client.delete(*[self._key(key) for key in keys])
+        except redis.exceptions.RedisError:
+            pass
+
+        return None
+
+    def version(self, key):
+        """
+        Get the current version of a key, or None if Redis can't be reached.
+
+        :param key: Cache key
+        :type key: str
+        :return: str or None
+        """
+        try:
+            epoch, version = self.client.mget(self._version_keys(key))
+        except redis.exceptions.RedisError:
+            return None
+
+        return '{0}.{1}'.format(int(epoch or 0), int(version or 0))
+
+    def set_if_version(self, key, value, version, ttl=None):
+        """
+        Add a value, unless the key's version has changed since it was read.
+
+        :param key: Cache key
+        :type key: str
+        :param value: Value to cache
+        :param version: Version from version()
+        :type version: str
+        :param ttl: Seconds until it expires, defaults to the cache's TTL
+        :type ttl: int
+        :return: bool, True if the value was added
+        """
+        try:
+            return bool(self._set_if_version(
+                keys=[self._key(key)] + list(self._version_keys(key)),
+                args=[version, pickle.dumps(value),
+                      self.ttl if ttl is None else ttl]))
+        except redis.exceptions.RedisError:
+            return False
+
+    def bump(self, *keys):
+        """
+        Change the version of 1 or more keys, or of every key without any.
+        Versions outlive the values they guard.
+
+        :return: None
+        """
+        if keys:
+            version_keys = [self._version_keys(key)[1] for key in keys]
+        else:
+            version_keys = [self._version_keys('')[0]]
+
+        try:
+            pipeline = self.client.pipeline()
+            for version_key in version_keys:
+                pipeline.incr(version_key)
+                pipeline.expire(version_key, self.ttl * 2)
+            pipeline.execute()
+        except redis.exceptions.RedisError:
+            pass
+
+        return None
+
+    def clear(self):
+        """
+        Remove every key under this cache's prefix.
+
+        :return: None
+        """
+        try:
+            keys = list(self.client.scan_iter(match=self._key('*')))
+            if keys:
+                self.client.delete(*keys)
+        except redis.exceptions.RedisError:
+            pass
+
+        return None
+
+
+class TieredCache(object):
+    """
+    A Flask extension which checks an in-process LRU first and then falls
+    back to an optional Redis tier. Settings are read from the app config
+    using a prefix, for example with a prefix of "IDENTITY_CACHE":
+
+        IDENTITY_CACHE_ENABLED, IDENTITY_CACHE_SIZE, IDENTITY_CACHE_TTL,
+        IDENTITY_CACHE_REDIS_URL, IDENTITY_CACHE_REDIS_TTL
+
+    A versioned cache never returns a value written before the key's last
+    delete. Every delete (and clear) changes the key's version, set only
+    writes a value if the version it read before loading the value is still
+    current, and get checks the version of every hit, including hits in the
+    local tier. With Redis that's 1 small round trip per get, so writes in
+    any worker are seen right away. Without Redis the versions are per
+    process, so only this process's deletes are seen.
+    """
+    def __init__(self, config_prefix, versioned=False):
+        self.config_prefix = config_prefix
+        self.versioned = versioned
+        self.enabled = False
+        self.local = LRUCache()
+        self.shared = None
+        self._epoch = 0
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def _config(self, app, name, default=None):
+        return app.config.get('{0}_{1}'.format(self.config_prefix, name),
+                              default)
+
+    def init_app(self, app):
+        """
+        Configure the cache from the Flask app's config.
+
+        :param app: Flask application instance
+        :return: None
+        """
+        self.enabled = self._config(app, 'ENABLED', True)
+        self.local = LRUCache(maxsize=self._config(app, 'SIZE', 1024),
+                              ttl=self._config(app, 'TTL', 5))
+
+        redis_url = self._config(app, 'REDIS_URL')
+        if redis_url:
+            self.shared = RedisCache(redis_url,
+                                     ttl=self._config(app, 'REDIS_TTL', 300),
+                                     prefix=self.config_prefix.lower())
+        else:
+            self.shared = None
+
+        return None
+
+    def version(self, key):
+        """
+        Get the current version of a key in a versioned cache, read it before
+        loading the value that will be passed to set.
+
+        :param key: Cache key
+        :type key: str
+        :return: str, or None if it can't be read
+        """
+        if not self.enabled or not self.versioned:
+            return None
+
+        if self.shared:
+            return self.shared.version(key)
+
+        with self._lock:
+            return '{0}.{1}'.format(self._epoch, self._versions.get(key, 0))
+
+    def get(self, key):
+        """
+        Get a value from the local tier, then the shared tier.
+
+        :param key: Cache key
+        :type key: str
+        :return: Cached value or None
+        """
+        if not self.enabled:
+            return None
+
+        if self.versioned:
+            return self._get_versioned(key)
+
+        value = self.local.get(key)
+
+        if value is None and self.shared:
+            value = self.shared.get(key)
+            if value is not None:
+                self.local.set(key, value)
+
+        return value
+
+    def _get_versioned(self, key):
+        version = self.version(key)
+        if version is None:
+            return None
+
+        entry = self.local.get(key)
+
+        if (entry is None or entry[0] != version) and self.shared:
+            entry = self.shared.get(key)
+            if entry is not None and entry[0] == version:
+                self.local.set(key, entry)
+
+        if entry is None or entry[0] != version:
+            return None
+
+        return entry[1]
+
+    def set(self, key, value, version=None):
+        """
+        Add a value to every tier. A versioned cache only adds it if version
+        is still the key's current version.
+
+        :param key: Cache key
+        :type key: str
+        :param value: Value to cache
+        :param version: Version from version(), read before loading value
+        :type version: str
+        :return: None
+        """
+        if not self.enabled:
+            return None
+
+        if self.versioned:
+            if version is None:
+                return None
+
+            entry = (version, value)
+
+            if self.shared:
+                if self.shared.set_if_version(key, entry, version):
+                    self.local.set(key, entry)
+                return None
+
+            with self._lock:
+                if version == '{0}.{1}'.format(self._epoch,
+                                               self._versions.get(key, 0)):
+                    self.local.set(key, entry)
+            return None
+
+        self.local.set(key, value)
+        if self.shared:
+            self.shared.set(key, value)
+
+        return None
+
+    def add(self, key, value):
+        """
+        Add a value unless the key already exists. The shared tier decides
+        when there is one, so a key can only be added once across workers.
+
+        :param key: Cache key
+        :type key: str
+        :param value: Value to cache
+        :return: bool, True if the value was added
+        """
+        if not self.enabled:
+            return True
+
+        if self.shared:
+            added = self.shared.add(key, value)
+            if added:
+                self.local.set(key, value)
+            return added
+
+        return self.local.add(key, value)
+
+    def delete(self, *keys):
+        """
+        Remove 1 or more keys from every tier.
+
+        :return: None
+        """
+        if self.versioned:
+            if self.shared:
+                self.shared.bump(*keys)
+            else:
+                with self._lock:
+                    for key in keys:
+                        self._versions[key] = self._versions.get(key, 0) + 1
+
+        self.local.delete(*keys)
+        if self.shared:
+            self.shared.delete(*keys)
+
+        return None
+
+    def clear(self):
+        """
+        Remove every entry from every tier.
+
+        :return: None
+        """
+        if self.versioned:
+            if self.shared:
+                # Old entries no longer match and expire on their own
+                self.shared.bump()
+            else:
+                with self._lock:
+                    self._epoch += 1
+                    self._versions.clear()
+            self.local.clear()
+            return None
+
+        self.local.clear()
+        if self.shared:
+            self.shared.clear()
+
+        return None
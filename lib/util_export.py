@@ -0,0 +1,73 @@
+import csv
+import datetime
+import io
+
+from lib.util_json import dumps
+
+# Rows are sent to the client in chunks rather than 1 at a time
+CHUNK_SIZE = 500
+
+
+def _csv_value(value):
+    # Dates use ISO 8601 like the JSON API, None is left empty
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+
+    return value
+
+
+def ndjson_stream(columns, rows, encoder='auto', chunk_size=CHUNK_SIZE):
+    """
+    Serialize rows as newline delimited JSON, 1 object per row.
+
+    :param columns: Column names, in the order of each row's values
+    :type columns: list
+    :param rows: Iterable of rows
+    :param encoder: auto, orjson or json
+    :type encoder: str
+    :param chunk_size: Rows per chunk
+    :type chunk_size: int
+    :return: Generator of bytes
+    """
+    chunk = []
+
+    for row in rows:
+        chunk.append(dumps(dict(zip(columns, row)), encoder))
+
+        if len(chunk) >= chunk_size:
+            yield b'\n'.join(chunk) + b'\n'
+            chunk = []
+
+    if chunk:
+        yield b'\n'.join(chunk) + b'\n'
+
+
+def csv_stream(columns, rows, chunk_size=CHUNK_SIZE):
+    """
+    Serialize rows as CSV, starting with a header row.
+
+    :param columns: Column names, in the order of each row's values
+    :type columns: list
+    :param rows: Iterable of rows
+    :param chunk_size: Rows per chunk
+    :type chunk_size: int
+    :return: Generator of bytes
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    count = 0
+
+    for row in rows:
+        writer.writerow([_csv_value(value) for value in row])
+        count += 1
+
+        if count >= chunk_size:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+            count = 0
+
+    # Without any rows this is still the header
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
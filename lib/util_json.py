@@ -0,0 +1,75 @@
+import datetime
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(value):
+    """
+    Serialize the types the JSON encoders don't know about. Dates use ISO
+    8601 like marshmallow does, decimals are sent as strings so no precision
+    is lost. Anything else is sent as a string, as it always has been.
+
+    :param value: Value to serialize
+    :return: JSON serializable value
+    """
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+
+    # Such as the rows of a SQLAlchemy query, orjson only takes plain tuples
+    if isinstance(value, tuple):
+        return list(value)
+
+    return str(value)
+
+
+_stdlib_encoder = json.JSONEncoder(default=_default, separators=(',', ':'))
+
+
+def _stdlib_dumps(data):
+    return _stdlib_encoder.encode(data).encode('utf-8')
+
+
+def _orjson_dumps(data):
+    # orjson handles dates itself, in the same format as _default. Keys are
+    # coerced to strings like the json module does
+    return orjson.dumps(data, default=_default,
+                        option=orjson.OPT_NON_STR_KEYS)
+
+
+ENCODERS = {'json': _stdlib_dumps}
+if orjson is not None:
+    ENCODERS['orjson'] = _orjson_dumps
+
+
+def get_encoder(name='auto'):
+    """
+    Return a function which serializes data to JSON bytes. "auto" picks the
+    fastest encoder that is installed.
+
+    :param name: auto, orjson or json
+    :type name: str
+    :return: Function
+    """
+    if name == 'auto':
+        name = 'orjson' if 'orjson' in ENCODERS else 'json'
+
+    try:
+        return ENCODERS[name]
+    except KeyError:
+        raise ValueError('JSON encoder "{0}" is not available.'.format(name))
+
+
+def dumps(data, encoder='auto'):
+    """
+    Serialize data to JSON bytes.
+
+    :param data: Data to serialize
+    :param encoder: auto, orjson or json
+    :type encoder: str
+    :return: bytes
+    """
+    return get_encoder(encoder)(data)
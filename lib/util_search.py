@@ -0,0 +1,111 @@
+import threading
+from collections import defaultdict
+
+
+def ngrams(value, n=3):
+    """
+    Split a string into a set of lowercase n-grams.
+
+    :param value: String to split
+    :type value: str
+    :param n: Length of each n-gram
+    :type n: int
+    :return: set
+    """
+    value = (value or '').lower()
+
+    return {value[i:i + n] for i in range(len(value) - n + 1)}
+
+
+def similarity(a, b, n=3):
+    """
+    How similar two strings are from 0 to 1, the number of shared n-grams
+    over the number of distinct n-grams (like pg_trgm's similarity()).
+
+    :param a: First string
+    :type a: str
+    :param b: Second string
+    :type b: str
+    :param n: Length of each n-gram
+    :type n: int
+    :return: float
+    """
+    a, b = ngrams(a, n), ngrams(b, n)
+
+    if not a or not b:
+        return 0.0
+
+    return len(a & b) / float(len(a | b))
+
+
+class NgramIndex(object):
+    """
+    An in-memory n-gram index for partial matching and ranking on databases
+    without pg_trgm (SQLite in tests). Documents are an id and a list of
+    fields, a document matches when any field contains the query.
+
+    The index has a version so that the caller can cheaply check if it needs
+    rebuilding, such as a row count and the latest updated_on.
+    """
+    def __init__(self, n=3):
+        self.n = n
+        self.version = None
+        self._postings = defaultdict(set)
+        self._documents = {}
+        self._lock = threading.Lock()
+
+    def build(self, documents, version=None):
+        """
+        Replace the contents of the index.
+
+        :param documents: Iterable of (id, fields) tuples
+        :type documents: iterable
+        :param version: Anything identifying the state that was indexed
+        :return: None
+        """
+        postings = defaultdict(set)
+        indexed = {}
+
+        for id, fields in documents:
+            fields = [(field or '').lower() for field in fields]
+            indexed[id] = fields
+
+            for field in fields:
+                for gram in ngrams(field, self.n):
+                    postings[gram].add(id)
+
+        with self._lock:
+            self._postings = postings
+            self._documents = indexed
+            self.version = version
+
+        return None
+
+    def search(self, query):
+        """
+        Find every document containing the query, most similar first.
+
+        :param query: Search query
+        :type query: str
+        :return: list of ids
+        """
+        query = query.lower()
+        grams = ngrams(query, self.n)
+
+        with self._lock:
+            if grams:
+                # Only documents with every n-gram of the query can match
+                candidates = set.intersection(
+                    *[self._postings.get(gram, set()) for gram in grams])
+            else:
+                candidates = set(self._documents)
+
+            scored = []
+            for id in candidates:
+                fields = self._documents[id]
+                if any(query in field for field in fields):
+                    score = max(similarity(query, field, self.n)
+                                for field in fields)
+                    scored.append((-score, id))
+
+        return [id for _, id in sorted(scored)]
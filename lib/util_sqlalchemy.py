@@ -1,10 +1,16 @@
+import base64
 import datetime
+import json
 
-from sqlalchemy import DateTime
+from sqlalchemy import DateTime, and_, literal, or_, tuple_
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.sql.expression import ClauseElement, Executable
 from sqlalchemy.types import TypeDecorator
 
 from lib.util_datetime import timezone_aware_datetime
-from vidme.extensions import db
+from vidme.extensions import db, identity_cache
 
 
 class AwareDateTime(TypeDecorator):
@@ -25,11 +31,172 @@ class AwareDateTime(TypeDecorator):
         return 'AwareDateTime()'
 
 
+class Explain(Executable, ClauseElement):
+    """
+    Postgres' query plan of a statement, as JSON. The statement's parameters
+    stay bound parameters rather than being rendered into the SQL.
+    """
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain, 'postgresql')
+def _compile_explain(element, compiler, **kwargs):
+    return 'EXPLAIN (FORMAT JSON) {0}'.format(
+        compiler.process(element.statement, **kwargs))
+
+
+class KeysetPagination(object):
+    """
+    A page of results from ResourceMixin.paginate_keyset. Cursors are opaque
+    to the client, they encode the sort key of the first/last item so the
+    next page can be found with an indexed WHERE instead of an OFFSET.
+    """
+    def __init__(self, items, has_next, has_prev, next_cursor, prev_cursor):
+        self.items = items
+        self.has_next = has_next
+        self.has_prev = has_prev
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+
+def _encode_cursor(values, direction):
+    """
+    Encode sort key values into an opaque, URL safe cursor.
+
+    :param values: Sort key values
+    :type values: list
+    :param direction: Either "next" or "prev"
+    :type direction: str
+    :return: str
+    """
+    values = [value.isoformat() if isinstance(value, datetime.date)
+              else value for value in values]
+    payload = json.dumps({'v': values, 'd': direction})
+
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('utf-8')
+
+
+def _decode_cursor(cursor, columns):
+    """
+    Decode a cursor made by _encode_cursor, raises a ValueError if it has
+    been tampered with.
+
+    :param cursor: Cursor
+    :type cursor: str
+    :param columns: Sort columns the cursor was made for
+    :type columns: list
+    :return: tuple of (values, direction)
+    """
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode('utf-8')))
+        values, direction = payload['v'], payload['d']
+    except (TypeError, ValueError, KeyError):
+        raise ValueError('Invalid cursor.')
+
+    if direction not in ('next', 'prev') or not isinstance(values, list) or \
+            len(values) != len(columns):
+        raise ValueError('Invalid cursor.')
+
+    decoded = []
+    for (column, _), value in zip(columns, values):
+        if value is not None:
+            value = _decode_cursor_value(column, value)
+
+        decoded.append(value)
+
+    return decoded, direction
+
+
+def _decode_cursor_value(column, value):
+    """
+    Convert a value of a cursor back to the column's type, raises a
+    ValueError if it can't be.
+
+    :param column: Table column
+    :param value: Value from the cursor
+    :return: Value
+    """
+    # TypeDecorators such as AwareDateTime wrap the real type
+    python_type = getattr(column.type, 'impl', column.type).python_type
+
+    if python_type is float:
+        python_type = (int, float)
+
+    try:
+        if python_type is datetime.datetime:
+            return datetime.datetime.fromisoformat(value)
+
+        if python_type is datetime.date:
+            return datetime.date.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor.')
+
+    if not isinstance(value, python_type):
+        raise ValueError('Invalid cursor.')
+
+    return value
+
+
+def _keyset_filter(columns, values, after):
+    """
+    Build a filter which matches rows sorted strictly after (or before) the
+    given sort key. NULLs are always sorted last, columns which can't be NULL
+    aren't checked for them so the filter can be served by an index.
+
+    :param columns: List of (column, direction) tuples
+    :type columns: list
+    :param values: Sort key values
+    :type values: list
+    :param after: Match rows after rather than before the sort key
+    :type after: bool
+    :return: SQLAlchemy filter
+    """
+    directions = set(direction for _, direction in columns)
+    if len(directions) == 1 and None not in values and \
+            not any(column.nullable for column, _ in columns):
+        # A row value comparison is an index range condition on Postgres
+        keys = tuple_(*[column for column, _ in columns])
+        bound = tuple_(*[literal(value, type_=column.type)
+                         for (column, _), value in zip(columns, values)])
+
+        if (directions.pop() == 'asc') == after:
+            return keys > bound
+        return keys < bound
+
+    clauses = []
+    equal = []
+
+    for (column, direction), value in zip(columns, values):
+        if value is None:
+            beyond = None if after else column.isnot(None)
+            same = column.is_(None)
+        else:
+            if (direction == 'asc') == after:
+                beyond = column > value
+            else:
+                beyond = column < value
+
+            if after and column.nullable:
+                beyond = or_(beyond, column.is_(None))
+            same = column == value
+
+        if beyond is not None:
+            clauses.append(and_(*(equal + [beyond])))
+        equal.append(same)
+
+    return or_(*clauses)
+
+
 class ResourceMixin(object):
     """
     For adding common functionality to our SQL models such as save(), delete(),
     and created/updated timezone aware dates
     """
+    # Relationships which can be eager loaded, name -> loader strategy (such
+    # as joinedload for 1 row, selectinload for collections)
+    EAGER_LOADS = {}
+
     # Keep track of when records are created and updated
     created_on = db.Column(AwareDateTime(), 
                             default=timezone_aware_datetime)
@@ -37,6 +204,27 @@ class ResourceMixin(object):
                             default=timezone_aware_datetime,
                             onupdate=timezone_aware_datetime)
     
+    @classmethod
+    def load_options(cls, load=()):
+        """
+        Build query options that eager load relationships, so the cost of a
+        query doesn't depend on which relationships are used afterwards.
+
+        :param load: Names of relationships in EAGER_LOADS
+        :type load: tuple
+        :return: list of SQLAlchemy loader options
+        """
+        options = []
+
+        for name in load:
+            if name not in cls.EAGER_LOADS:
+                raise ValueError('{0} can\'t eager load "{1}".'.format(
+                    cls.__name__, name))
+
+            options.append(cls.EAGER_LOADS[name](getattr(cls, name)))
+
+        return options
+
     @classmethod
     def sort_by(cls, field, direction):
         """
@@ -59,9 +247,103 @@ class ResourceMixin(object):
         return field, direction
 
     @classmethod
-    def get_bulk_action_ids(cls, scope, ids, omit_ids=[], query=''):
+    def paginate_keyset(cls, query, columns, cursor=None, per_page=30):
         """
-        Determine which IDs are to be modified.
+        Paginate a query with a cursor rather than an OFFSET, which stays fast
+        no matter how deep the page is. The primary key is added to the sort
+        columns to break ties.
+
+        :param query: Query to paginate
+        :type query: SQLAlchemy query
+        :param columns: List of (table column, direction) tuples to sort by
+        :type columns: list
+        :param cursor: Cursor from a previous page
+        :type cursor: str
+        :param per_page: Max number of items
+        :type per_page: int
+        :return: KeysetPagination
+        """
+        if per_page < 1:
+            raise ValueError('Invalid page size.')
+
+        columns = list(columns) + [(cls.__table__.c.id, columns[-1][1])]
+
+        if cursor:
+            values, direction = _decode_cursor(cursor, columns)
+            query = query.filter(
+                _keyset_filter(columns, values, after=direction == 'next'))
+        else:
+            direction = 'next'
+
+        order_by = []
+        for column, column_direction in columns:
+            if direction == 'prev':
+                column_direction = 'desc' if column_direction == 'asc' \
+                    else 'asc'
+            order = column.asc() if column_direction == 'asc' \
+                else column.desc()
+            # Reversing the order must keep NULLs where they were. Columns
+            # without NULLs are left alone so they match their indexes
+            if not column.nullable:
+                order_by.append(order)
+            elif direction == 'next':
+                order_by.append(order.nullslast())
+            else:
+                order_by.append(order.nullsfirst())
+
+        items = query.order_by(*order_by).limit(per_page + 1).all()
+        has_more = len(items) > per_page
+        items = items[:per_page]
+
+        if direction == 'next':
+            has_next, has_prev = has_more, cursor is not None
+        else:
+            items.reverse()
+            has_next, has_prev = True, has_more
+
+        def sort_key(item):
+            return [getattr(item, cls.__mapper__.get_property_by_column(
+                column).key) for column, _ in columns]
+
+        next_cursor = None
+        prev_cursor = None
+        if items and has_next:
+            next_cursor = _encode_cursor(sort_key(items[-1]), 'next')
+        if items and has_prev:
+            prev_cursor = _encode_cursor(sort_key(items[0]), 'prev')
+
+        return KeysetPagination(items, has_next, has_prev, next_cursor,
+                                prev_cursor)
+
+    @classmethod
+    def count_results(cls, query, estimate=False):
+        """
+        Count the results of a query. Estimates come from Postgres' query
+        planner, which avoids scanning the whole table but can be off,
+        especially when statistics are stale.
+
+        :param query: Query to count
+        :type query: SQLAlchemy query
+        :param estimate: Estimate the count rather than counting
+        :type estimate: bool
+        :return: int
+        """
+        dialect = db.session.bind.dialect
+
+        if not estimate or dialect.name != 'postgresql':
+            return query.order_by(None).count()
+
+        plan = db.session.execute(
+            Explain(query.order_by(None).statement)).scalar()
+
+        return plan[0]['Plan']['Plan Rows']
+
+    @classmethod
+    def bulk_action_scope(cls, scope, ids, omit_ids=(), query=''):
+        """
+        Describe which IDs are to be modified without resolving them, so that
+        a scope of every search result stays small enough to be passed to a
+        Celery task. Resolve it with iter_bulk_action_ids().
 
         :param scope: Affect all or only a subset of items
         :type scope: str
@@ -71,27 +353,116 @@ class ResourceMixin(object):
         :type omit_ids: list
         :param query: Search query (if applicable)
         :type query: str
-        :return: list
+        :return: dict
         """
-        omit_ids = map(str, omit_ids)
+        # Remove one or more items from the list, useful for preventing the
+        # current user from deleting themselves from the db when bulk deleting
+        # user accounts
+        selection = {'omit_ids': sorted({int(id) for id in omit_ids})}
 
         if scope == 'all_search_results':
             # Change the scope to go from selected ids to all search results
-            ids = cls.query.with_entities(cls.id).filter(cls.search(query))
+            selection['query'] = query
+        else:
+            selection['ids'] = [int(id) for id in ids]
 
-            # SQLAlchemy returns a  list of tuples, need a list of strs
-            ids = [str(item[0]) for item in ids]
+        return selection
 
-        # Remove one or more items from the list, useful for preventing the
-        # current user from deleting themselves from the db when bulk deleting
-        # user accounts
-        if omit_ids:
-            ids = [str(id) for id in ids if str(id) not in omit_ids]
+    @classmethod
+    def iter_bulk_action_ids(cls, selection, chunk_size=500):
+        """
+        Yield the IDs of a bulk action scope in chunks.
+
+        Search results are read with keyset pagination on the id rather than
+        a server side cursor, the caller usually commits between chunks which
+        would close the cursor.
+
+        :param selection: Scope from bulk_action_scope()
+        :type selection: dict
+        :param chunk_size: Max number of IDs per chunk
+        :type chunk_size: int
+        :return: Generator of lists
+        """
+        omit_ids = set(selection.get('omit_ids', ()))
+
+        if 'ids' in selection:
+            ids = [id for id in selection['ids'] if id not in omit_ids]
+
+            for i in range(0, len(ids), chunk_size):
+                yield ids[i:i + chunk_size]
+
+            return
+
+        query = cls._bulk_action_query(selection)
+        last_id = None
 
-        print(omit_ids)
-        print(ids)
-        return ids
+        while True:
+            chunk_query = query
+            if last_id is not None:
+                chunk_query = chunk_query.filter(cls.id > last_id)
 
+            ids = [item[0] for item in
+                   chunk_query.order_by(cls.id).limit(chunk_size)]
+            if not ids:
+                return
+
+            last_id = ids[-1]
+            yield ids
+
+    @classmethod
+    def count_bulk_action_ids(cls, selection):
+        """
+        Count the IDs of a bulk action scope.
+
+        :param selection: Scope from bulk_action_scope()
+        :type selection: dict
+        :return: int
+        """
+        if 'ids' in selection:
+            omit_ids = set(selection.get('omit_ids', ()))
+            return len([id for id in selection['ids'] if id not in omit_ids])
+
+        return cls.count_results(cls._bulk_action_query(selection))
+
+    @classmethod
+    def _bulk_action_query(cls, selection):
+        """
+        Select the IDs of every search result in a bulk action scope.
+
+        :param selection: Scope from bulk_action_scope()
+        :type selection: dict
+        :return: SQLAlchemy query
+        """
+        query = db.session.query(cls.id)
+
+        if selection.get('query'):
+            query = query.filter(cls.search(selection['query']))
+
+        if selection.get('omit_ids'):
+            query = query.filter(~cls.id.in_(selection['omit_ids']))
+
+        return query
+
+    @classmethod
+    def get_bulk_action_ids(cls, scope, ids, omit_ids=(), query=''):
+        """
+        Determine which IDs are to be modified.
+
+        :param scope: Affect all or only a subset of items
+        :type scope: str
+        :param ids: List of ids to be modified
+        :type ids: list
+        :param omit_ids: Remove one or more IDs from the list
+        :type omit_ids: list
+        :param query: Search query (if applicable)
+        :type query: str
+        :return: list
+        """
+        selection = cls.bulk_action_scope(scope, ids, omit_ids=omit_ids,
+                                          query=query)
+
+        return [id for chunk in cls.iter_bulk_action_ids(selection)
+                for id in chunk]
 
     @classmethod
     def bulk_delete(cls, ids):
@@ -107,14 +478,57 @@ class ResourceMixin(object):
 
         return delete_count
 
+    @classmethod
+    def from_snapshot(cls, values):
+        """
+        Re-create a detached model instance from a snapshot without hitting
+        the database. Values are set as if they were loaded, so nothing is
+        marked dirty and the instance can be merged with load=False.
+
+        :param values: Column values from to_snapshot()
+        :type values: dict
+        :return: Model instance
+        """
+        instance = cls.__mapper__.class_manager.new_instance()
+
+        for key, value in values.items():
+            set_committed_value(instance, key, value)
+
+        make_transient_to_detached(instance)
+
+        return instance
+
+    def to_snapshot(self):
+        """
+        Dump the column values of a model instance, this is what ends up in
+        caches.
+
+        :return: dict
+        """
+        return {attr.key: getattr(self, attr.key)
+                for attr in self.__mapper__.column_attrs}
+
+    def cache_keys(self):
+        """
+        Identity cache keys which depend on this instance, they're evicted
+        whenever it's saved or deleted. Override this on cached models.
+
+        :return: list
+        """
+        return []
+
     def save(self):
         """
         Save a model instance.
 
         :return: Model instance
         """
+        cache_keys = self.cache_keys()
+
         db.session.add(self)
         db.session.commit()
+
+        identity_cache.delete(*cache_keys)
     
     def delete(self):
         """
@@ -122,5 +536,11 @@ class ResourceMixin(object):
 
         :return: db.session.commit() result
         """
+        cache_keys = self.cache_keys()
+
         db.session.delete(self)
-        return db.session.commit()
+        result = db.session.commit()
+
+        identity_cache.delete(*cache_keys)
+
+        return result
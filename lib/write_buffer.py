@@ -0,0 +1,165 @@
+import json
+import time
+import uuid
+from contextlib import contextmanager
+
+import redis
+
+
+class WriteBuffer(object):
+    """
+    A Flask extension for deferring writes so they can be applied in bulk by
+    a periodic task. Items are pushed onto a Redis list shared by every
+    gunicorn worker. Without a Redis URL nothing is buffered, push returns
+    False and callers write the item themselves.
+
+    A drained batch is moved to its own processing list until it's been
+    written. It's put back at the front of the buffer if writing it fails,
+    or by requeue_stale if the process writing it died. A batch that takes
+    longer than the processing timeout to write is written twice.
+
+    Settings are read from the app config using a prefix, for example with a
+    prefix of "ACTIVITY_BUFFER":
+
+        ACTIVITY_BUFFER_ENABLED, ACTIVITY_BUFFER_REDIS_URL,
+        ACTIVITY_BUFFER_BATCH_SIZE, ACTIVITY_BUFFER_PROCESSING_TIMEOUT
+    """
+    # Move up to ARGV[1] items from the front of the buffer to a processing
+    # list, in a single step so they're never in both or in neither
+    MOVE_TO_PROCESSING = """
+        local items = redis.call('LRANGE', KEYS[1], 0, ARGV[1] - 1)
+        if #items > 0 then
+            redis.call('LTRIM', KEYS[1], #items, -1)
+            redis.call('RPUSH', KEYS[2], unpack(items))
+        end
+        return items
+    """
+
+    # Put a processing list back at the front of the buffer, in order
+    RETURN_TO_BUFFER = """
+        local items = redis.call('LRANGE', KEYS[2], 0, -1)
+        for i = #items, 1, -1 do
+            redis.call('LPUSH', KEYS[1], items[i])
+        end
+        redis.call('DEL', KEYS[2])
+        return #items
+    """
+
+    def __init__(self, config_prefix):
+        self.config_prefix = config_prefix
+        self.key = config_prefix.lower()
+        self.enabled = False
+        self.batch_size = 500
+        self.processing_timeout = 300
+        self.client = None
+        self._move_to_processing = None
+        self._return_to_buffer = None
+
+    def _config(self, app, name, default=None):
+        return app.config.get('{0}_{1}'.format(self.config_prefix, name),
+                              default)
+
+    def init_app(self, app):
+        """
+        Configure the buffer from the Flask app's config.
+
+        :param app: Flask application instance
+        :return: None
+        """
+        self.enabled = self._config(app, 'ENABLED', True)
+        self.batch_size = self._config(app, 'BATCH_SIZE', 500)
+        self.processing_timeout = self._config(app, 'PROCESSING_TIMEOUT',
+                                               300)
+
+        redis_url = self._config(app, 'REDIS_URL')
+        if redis_url:
+            self.client = redis.StrictRedis.from_url(redis_url)
+            self._move_to_processing = self.client.register_script(
+                WriteBuffer.MOVE_TO_PROCESSING)
+            self._return_to_buffer = self.client.register_script(
+                WriteBuffer.RETURN_TO_BUFFER)
+        else:
+            self.client = None
+
+        return None
+
+    def push(self, item):
+        """
+        Add an item to the buffer. False is returned when the buffer is
+        disabled, has no Redis URL or Redis can't be reached, the caller
+        should then write the item itself.
+
+        :param item: JSON serializable item
+        :type item: dict
+        :return: bool
+        """
+        if not self.enabled or self.client is None:
+            return False
+
+        try:
+            self.client.rpush(self.key, json.dumps(item))
+        except redis.exceptions.RedisError:
+            return False
+
+        return True
+
+    @contextmanager
+    def drain(self, limit=None):
+        """
+        Take up to limit items, oldest first. They're only removed once the
+        with block exits without an error, otherwise they go back to the
+        front of the buffer:
+
+            with buffer.drain() as items:
+                write(items)
+
+        :param limit: Max number of items, defaults to the batch size
+        :type limit: int
+        :return: list
+        """
+        if self.client is None:
+            yield []
+            return
+
+        # The start time is part of the key so stale batches can be found
+        processing_key = '{0}:processing:{1}:{2}'.format(
+            self.key, int(time.time()), uuid.uuid4().hex)
+        items = self._move_to_processing(
+            keys=[self.key, processing_key],
+            args=[limit or self.batch_size])
+
+        try:
+            yield [json.loads(item) for item in items]
+        except Exception:
+            self._return_to_buffer(keys=[self.key, processing_key])
+            raise
+
+        self.client.delete(processing_key)
+
+    def requeue_stale(self):
+        """
+        Put batches back which have been processing for longer than the
+        processing timeout, the process writing them has most likely died.
+
+        :return: Number of items put back
+        """
+        if self.client is None:
+            return 0
+
+        requeued = 0
+        started_before = time.time() - self.processing_timeout
+
+        for key in self.client.scan_iter(
+                match='{0}:processing:*'.format(self.key)):
+            started_on = int(key.decode('utf-8').split(':')[-2])
+
+            if started_on < started_before:
+                requeued += self._return_to_buffer(keys=[self.key, key])
+
+        return requeued
+
+    def __len__(self):
+        if self.client is None:
+            return 0
+
+        return self.client.llen(self.key)
@@ -1,4 +1,10 @@
-from lib.representations import output_json
+from flask import make_response, request
+
+from lib.representations import (
+    cache_validators,
+    make_conditional,
+    output_json
+)
 
 
 class JSONViewMixin(object):
@@ -10,3 +16,20 @@ class JSONViewMixin(object):
         'application/json': output_json,
         'flask-classful/default': output_json,
     }
+
+    def not_modified(self, *resources):
+        """
+        Check a conditional request against the models a response is made
+        of, before doing the work of building it. The models' updated_on
+        dates become the response's ETag and Last-Modified date.
+
+        :param resources: Model instances, strings or None
+        :return: 304 response if the client's copy is current, else None
+        """
+        request.cache_validators = cache_validators(*resources)
+
+        response = make_conditional(make_response('', 200))
+        if response.status_code == 304:
+            return response
+
+        return None
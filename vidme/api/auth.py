@@ -9,6 +9,7 @@ from flask_jwt_extended import (
     unset_jwt_cookies
 )
 
+from lib.password_hasher import PasswordHasherBusy
 from vidme.blueprints.user.models import User
 from vidme.blueprints.user.schemas import auth_schema
 
@@ -36,10 +37,21 @@ class AuthView(FlaskView):
 
         user = User.find_by_identity(data['identity'])
 
-        if user and user.authenticated(password=data['password']):
+        try:
+            is_authenticated = user and user.authenticated(
+                password=data['password'])
+        except PasswordHasherBusy:
+            response = jsonify({
+                'error': 'Too many sign in attempts, please try again.'
+            })
+            return response, 429, {'Retry-After': '1'}
+
+        if is_authenticated:
             if user.is_active():
-                # identity is used to lookup a user on protected endpoints
-                access_token = create_access_token(identity=user.username)
+                # identity is used to lookup a user on protected endpoints,
+                # the user is already loaded so pass the claims directly
+                access_token = create_access_token(
+                    identity=user.username, user_claims=user.jwt_claims())
 
                 user.update_activity_tracking(request.remote_addr)
 
@@ -1,10 +1,11 @@
-from flask import request, jsonify
+from flask import current_app, request, jsonify
 from flask_classful import FlaskView
-from stripe.error import InvalidRequestError
+from stripe.error import InvalidRequestError, SignatureVerificationError
 
-from vidme.blueprints.billing.models.invoice import Invoice
+from vidme.blueprints.billing.models.stripe_event import StripeEvent
 from vidme.blueprints.billing.gateways.stripecom import Event as \
     PaymentEvent
+from vidme.extensions import webhook_replay_cache
 
 
 class StripeWebhookView(FlaskView):
@@ -14,6 +15,13 @@ class StripeWebhookView(FlaskView):
     is subscribed to a plan. Using webhooks, the API can listen for the
     "invoice.created" event and save an invoice locally, which allows the
     client to display a user's billing history easily.
+
+    With STRIPE_WEBHOOK_ASYNC events are only stored here, a celery task
+    verifies and applies them (see StripeEvent.process_pending).
+
+    With STRIPE_WEBHOOK_SECRET events are verified from their signature
+    instead of being retrieved from stripe, requests without a valid and
+    recent signature are rejected.
     """
     route_prefix = '/api'
 
@@ -32,13 +40,52 @@ class StripeWebhookView(FlaskView):
             response = jsonify({'error': 'Invalid stripe event.'})
             return response, 400
 
-        try:
-            safe_event = PaymentEvent.retrieve(webhook_id)
-            parsed_event = Invoice.parse_from_event(safe_event)
+        secret = current_app.config.get('STRIPE_WEBHOOK_SECRET')
+        verified = False
+
+        if secret:
+            try:
+                PaymentEvent.verify(
+                    request.get_data(as_text=True),
+                    request.headers.get('Stripe-Signature'), secret,
+                    current_app.config.get('STRIPE_WEBHOOK_TOLERANCE', 300))
+            except SignatureVerificationError:
+                response = jsonify({'error': 'Invalid signature.'})
+                return response, 400
+
+            verified = True
 
-            Invoice.prepare_and_save(parsed_event)
+            # A signed request stays valid until the tolerance runs out, only
+            # accept each event once in that window
+            if not webhook_replay_cache.add(webhook_id, True):
+                return jsonify({'success': True}), 200
+
+        if current_app.config.get('STRIPE_WEBHOOK_ASYNC'):
+            # Stripe re-sends events until they're acknowledged, duplicates
+            # are only stored (and processed) once
+            try:
+                is_new = StripeEvent.enqueue(json_data, verified=verified)
+            except Exception:
+                # Let stripe's retry through
+                webhook_replay_cache.delete(webhook_id)
+                raise
+
+            if is_new:
+                from vidme.blueprints.billing.tasks import \
+                    process_stripe_events
+                process_stripe_events.delay()
+
+            return jsonify({'success': True}), 200
+
+        try:
+            if verified:
+                safe_event = json_data
+            else:
+                safe_event = PaymentEvent.retrieve(webhook_id)
+            StripeEvent.apply(safe_event)
         except InvalidRequestError as e:
-            # could not parse the event
+            # could not parse the event, stripe will try again
+            webhook_replay_cache.delete(webhook_id)
             return jsonify({'error': str(e)}), 422
         except Exception as e:
             # In this case something went really wrong so send a 200 so that
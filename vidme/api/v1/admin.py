@@ -1,4 +1,10 @@
-from flask import request, url_for
+from flask import (
+    Response,
+    current_app,
+    request,
+    stream_with_context,
+    url_for
+)
 from flask_classful import route
 from flask_jwt_extended import current_user
 from marshmallow import ValidationError
@@ -6,8 +12,13 @@ from sqlalchemy import text
 
 from vidme.api import JSONViewMixin
 from vidme.api.v1 import V1FlaskView
-from vidme.blueprints.admin.models import Dashboard
-from lib.decorators import admin_required, handle_stripe_exceptions
+from lib.util_export import csv_stream, ndjson_stream
+from vidme.blueprints.admin.models import Dashboard, Export
+from lib.decorators import (
+    admin_required,
+    cache_policy,
+    handle_stripe_exceptions
+)
 from vidme.blueprints.billing.models.subscription import Subscription
 from vidme.blueprints.billing.models.invoice import Invoice
 from vidme.blueprints.user.models import User
@@ -20,6 +31,10 @@ from vidme.blueprints.admin.schemas import (
 from vidme.blueprints.billing.schemas import invoices_schema
 
 USER_NOT_FOUND = 'User not found.'
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
 
 
 class AdminView(JSONViewMixin, V1FlaskView):
@@ -71,14 +86,24 @@ class AdminView(JSONViewMixin, V1FlaskView):
     @admin_required
     def users(self):
         """
-        Use pagination to list out users in the database
+        Use pagination to list out users in the database.
+
+        Pass ?pagination=cursor (or a cursor from a previous page) to page
+        with cursors instead of page numbers, which stays fast on deep pages.
+        ?count=exact or ?count=estimate adds a total to cursor pages.
+
+        With a search query, ?sort=relevance puts the best matches first
+        (page numbers only).
         """
-        page = request.args.get('page', 1)
-        page_size = request.args.get('page_size', 30)
+        page = request.args.get('page', 1, type=int)
+        page_size = request.args.get('page_size', 30, type=int)
 
         # return 30 users at a time max
         if page_size > 30:
             page_size = 30
+        elif page_size < 1:
+            response = {'error': 'Invalid page size.'}
+            return response, 400
 
         sort_by = User.sort_by(request.args.get('sort', 'created_on'),
                                request.args.get('direction', 'desc'))
@@ -86,10 +111,47 @@ class AdminView(JSONViewMixin, V1FlaskView):
 
         # a search feature is provided if the client wants to implement one
         # thats what request.args.get('q') is
-        paginated_users = User.query \
-            .filter(User.search(request.args.get('q', text('')))) \
-            .order_by(User.role.asc(), User.payment_id, text(order_values)) \
-            .paginate(page, page_size, True)
+        query = User.query.filter(User.search(request.args.get('q',
+                                                               text(''))))
+
+        cursor = request.args.get('cursor')
+        if cursor or request.args.get('pagination') == 'cursor':
+            table_columns = User.__table__.columns
+            columns = [(table_columns['role'], 'asc'),
+                       (table_columns['payment_id'], 'asc'),
+                       (table_columns[sort_by[0]], sort_by[1])]
+
+            try:
+                paginated_users = User.paginate_keyset(query, columns,
+                                                       cursor=cursor,
+                                                       per_page=page_size)
+            except ValueError as err:
+                response = {'error': str(err)}
+                return response, 400
+
+            response = {'data': {
+                'users': users_schema.dump(paginated_users.items),
+                'has_next': paginated_users.has_next,
+                'has_prev': paginated_users.has_prev,
+                'next_cursor': paginated_users.next_cursor,
+                'prev_cursor': paginated_users.prev_cursor
+            }}
+
+            count = request.args.get('count')
+            if count in ('exact', 'estimate'):
+                response['data']['total'] = User.count_results(
+                    query, estimate=count == 'estimate')
+
+            return response
+
+        search_query = request.args.get('q', '')
+        if search_query and request.args.get('sort') == 'relevance':
+            query = query.order_by(User.search_rank(search_query), User.id)
+        else:
+            query = query.order_by(User.role.asc(), User.payment_id,
+                                   text(order_values))
+
+        paginated_users = query.paginate(page, page_size, True)
 
         dumped_users = users_schema.dump(paginated_users.items)
         response = {'data': {
@@ -101,31 +163,118 @@ class AdminView(JSONViewMixin, V1FlaskView):
         }}
         return response
 
+    @route('/export/users', methods=['GET'])
+    @admin_required
+    def export_users(self):
+        """
+        Stream every user matching ?q along with their subscription and
+        credit card, as ?format=ndjson (the default) or csv. Sorted with
+        ?sort and ?direction like AdminView:users.
+        """
+        columns, rows = Export.users(query=request.args.get('q', ''),
+                                     sort=request.args.get('sort',
+                                                           'created_on'),
+                                     direction=request.args.get('direction',
+                                                                'desc'))
+
+        return self._export('users', columns, rows)
+
+    @route('/export/invoices', methods=['GET'])
+    @admin_required
+    def export_invoices(self):
+        """
+        Stream the invoices of every user matching ?q, as ?format=ndjson (the
+        default) or csv. Sorted with ?sort and ?direction, newest first by
+        default.
+        """
+        columns, rows = Export.invoices(query=request.args.get('q', ''),
+                                        sort=request.args.get('sort',
+                                                              'created_on'),
+                                        direction=request.args.get(
+                                            'direction', 'desc'))
+
+        return self._export('invoices', columns, rows)
+
+    def _export(self, name, columns, rows):
+        """
+        Stream exported rows as the requested format. Rows are read from the
+        database as the response is sent.
+
+        :param name: Name of the download
+        :type name: str
+        :param columns: Column names
+        :type columns: list
+        :param rows: Iterable of rows
+        :return: Response
+        """
+        export_format = request.args.get('format', 'ndjson')
+
+        if export_format not in EXPORT_FORMATS:
+            response = {'error': 'Format must be one of: {0}.'.format(
+                ', '.join(sorted(EXPORT_FORMATS)))}
+            return response, 400
+
+        if export_format == 'csv':
+            body = csv_stream(columns, rows)
+        else:
+            body = ndjson_stream(columns, rows,
+                                 current_app.config.get('JSON_ENCODER',
+                                                        'auto'))
+
+        headers = {'Content-Disposition': 'attachment; filename={0}.{1}'
+                   .format(name, export_format)}
+        return Response(stream_with_context(body),
+                        mimetype=EXPORT_FORMATS[export_format],
+                        headers=headers)
+
     @route('/users/<username>', methods=['GET'])
     @admin_required
     @handle_stripe_exceptions
+    @cache_policy()
     def get_user(self, username):
         """Allows an admin to fetch specific user data
+
+        The user's invoices are paged and filtered like InvoicesView:index.
         """
-        user = User.find_by_identity(username)
+        # The credit card and subscription come with the user, in 1 query
+        user = User.find_by_identity(username,
+                                     load=('credit_card', 'subscription'))
 
         if user is None:
             response = {'error': USER_NOT_FOUND}
             return response, 404
 
-        invoices = Invoice.billing_history(user=user)
+        page_size = min(request.args.get('page_size', 12, type=int), 100)
+
+        try:
+            invoices = Invoice.billing_history(
+                user=user,
+                cursor=request.args.get('cursor'),
+                per_page=page_size,
+                period_start_on=request.args.get('period_start_on'),
+                period_end_on=request.args.get('period_end_on'))
+        except ValueError as err:
+            response = {'error': str(err)}
+            return response, 400
+
         if user.subscription:
-            # get the upcoming invoice from Stripe
-            upcoming = Invoice.upcoming(customer_id=user.payment_id)
+            # get the upcoming invoice from Stripe (or the cache)
+            upcoming, refreshed_on = Invoice.cached_upcoming(
+                customer_id=user.payment_id)
         else:
-            upcoming = None
+            upcoming, refreshed_on = None, None
 
         dumped_user = user_detail_schema.dump(user)
-        dumped_invoices = invoices_schema.dump(invoices)
+        dumped_invoices = invoices_schema.dump(invoices.items)
         response = {'data': {
             'user': dumped_user,
             'invoices': dumped_invoices,
-            'upcoming_invoice': upcoming
+            'has_next': invoices.has_next,
+            'has_prev': invoices.has_prev,
+            'next_cursor': invoices.next_cursor,
+            'prev_cursor': invoices.prev_cursor,
+            'upcoming_invoice': upcoming,
+            'upcoming_invoice_refreshed_on': refreshed_on
         }}
         return response
 
@@ -173,7 +322,10 @@ class AdminView(JSONViewMixin, V1FlaskView):
                 response = {'error': 'Username is already taken.'}
                 return response, 400
 
-        user.role = data['role']
+        if user.role != data['role']:
+            user.role = data['role']
+            user.bump_auth_version()
+
         user.save()
 
         headers = {'Location': url_for('AdminView:get_user',
@@ -195,18 +347,19 @@ class AdminView(JSONViewMixin, V1FlaskView):
             response = {'error': err.messages}
             return response, 422
 
-        ids = User.get_bulk_action_ids(scope=data['scope'],
-                                       ids=data['bulk_ids'],
-                                       omit_ids=[current_user.id],
-                                       query=request.args.get('q', text('')))
+        # Pass the scope rather than every id to keep the task message small
+        selection = User.bulk_action_scope(scope=data['scope'],
+                                           ids=data['bulk_ids'],
+                                           omit_ids=[current_user.id],
+                                           query=request.args.get('q', ''))
 
         # use a celery task to do this in the background
         from vidme.blueprints.admin.tasks import delete_users
-        delete_users.delay(ids)
+        delete_users.delay(selection)
 
         response = {'data': {
             'deleted': True,
             'message': '{0} user(s) were scheduled to be deleted.'.format(
-                len(ids))
+                User.count_bulk_action_ids(selection))
         }}
         return response
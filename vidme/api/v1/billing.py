@@ -1,4 +1,6 @@
 from flask import (
+    current_app,
+    make_response,
     request,
     url_for
 )
@@ -7,6 +9,7 @@ from marshmallow import ValidationError
 
 from vidme.api import JSONViewMixin
 from vidme.api.v1 import V1FlaskView
+from vidme.extensions import plan_registry
 from vidme.blueprints.billing.models.subscription import Subscription
 from vidme.blueprints.billing.models.invoice import Invoice
 from vidme.blueprints.billing.schemas import (
@@ -15,6 +18,7 @@ from vidme.blueprints.billing.schemas import (
     invoices_schema
 )
 from lib.decorators import (
+    cache_policy,
     handle_stripe_exceptions,
     jwt_and_subscription_required
 )
@@ -98,6 +102,7 @@ class SubscriptionsView(JSONViewMixin, V1FlaskView):
         return '', 204, headers
 
     @jwt_required
+    @cache_policy()
     def index(self):
         """ Get the current users CC and current plan info """
         if not current_user.credit_card:
@@ -106,6 +111,12 @@ class SubscriptionsView(JSONViewMixin, V1FlaskView):
             }
             return response, 404
 
+        not_modified = self.not_modified(current_user.credit_card,
+                                         current_user.subscription,
+                                         plan_registry.etag)
+        if not_modified:
+            return not_modified
+
         active_plan = Subscription.get_plan(current_user.subscription.plan)
         credit_card = credit_card_schema.dump(current_user.credit_card)
         response = {'data': {
@@ -128,12 +139,19 @@ class SubscriptionsView(JSONViewMixin, V1FlaskView):
 class PlansView(JSONViewMixin, V1FlaskView):
 
     def index(self):
-        """Show all of the available plans"""
-        plans = Subscription.get_all_plans()
-        response = {'data': {
-            'plans': plans
-        }}
-        return response, 200
+        """
+        Show all of the available plans. Plans only change with a deploy, so
+        the response is serialized once and can be cached by clients and
+        CDNs, which revalidate it with If-None-Match.
+        """
+        response = make_response(plan_registry.json)
+        response.content_type = 'application/json'
+        response.set_etag(plan_registry.etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config.get(
+            'PLANS_CACHE_MAX_AGE', 300)
+
+        return response.make_conditional(request)
 
     @jwt_and_subscription_required
     @handle_stripe_exceptions
@@ -180,25 +198,46 @@ class PlansView(JSONViewMixin, V1FlaskView):
 class InvoicesView(JSONViewMixin, V1FlaskView):
     @jwt_required
     @handle_stripe_exceptions
+    @cache_policy()
     def index(self):
         """
         Return the user's previous invoices, and the upcoming invoice
         (provided by Stripe). Upcoming invoice could be null if a user has
         unsubbed.
+
+        Invoices are paged with cursors (?cursor=, ?page_size= up to 100) and
+        can be filtered with ?period_start_on= and ?period_end_on=
+        (YYYY-MM-DD).
         """
-        invoices = Invoice.billing_history(user=current_user)
+        page_size = min(request.args.get('page_size', 12, type=int), 100)
+
+        try:
+            invoices = Invoice.billing_history(
+                user=current_user,
+                cursor=request.args.get('cursor'),
+                per_page=page_size,
+                period_start_on=request.args.get('period_start_on'),
+                period_end_on=request.args.get('period_end_on'))
+        except ValueError as err:
+            response = {'error': str(err)}
+            return response, 400
 
         if current_user.subscription:
-            # get the upcoming invoice from stripe
-            upcoming_invoice = Invoice.upcoming(
+            # get the upcoming invoice from stripe (or the cache)
+            upcoming_invoice, refreshed_on = Invoice.cached_upcoming(
                 customer_id=current_user.payment_id)
         else:
-            upcoming_invoice = None
+            upcoming_invoice, refreshed_on = None, None
 
-        dumped_invoices = invoices_schema.dump(invoices)
+        dumped_invoices = invoices_schema.dump(invoices.items)
         response = {'data': {
             'invoices': dumped_invoices,
-            'upcoming_invoice': upcoming_invoice
+            'has_next': invoices.has_next,
+            'has_prev': invoices.has_prev,
+            'next_cursor': invoices.next_cursor,
+            'prev_cursor': invoices.prev_cursor,
+            'upcoming_invoice': upcoming_invoice,
+            'upcoming_invoice_refreshed_on': refreshed_on
         }}
 
         return response, 200
@@ -2,6 +2,7 @@ from flask import request, url_for
 from flask_classful import route
 from marshmallow import ValidationError
 
+from lib.password_hasher import PasswordHasherBusy
 from vidme.api import JSONViewMixin
 from vidme.api.v1 import V1FlaskView
 from vidme.blueprints.user.models import User
@@ -22,10 +23,16 @@ class UsersView(JSONViewMixin, V1FlaskView):
             response = {'error': err.messages}
             return response, 422
 
+        try:
+            password = User.encrypt_password(data.get('password'))
+        except PasswordHasherBusy:
+            response = {'error': 'Too many sign ups, please try again.'}
+            return response, 429, {'Retry-After': '1'}
+
         user = User()
         user.email = data.get('email')
         user.username = data.get('username')
-        user.password = User.encrypt_password(data.get('password'))
+        user.password = password
         user.save()
 
         # send verification email with celery as a background task
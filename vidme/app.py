@@ -5,6 +5,7 @@ from celery import Celery
 import stripe
 
 from vidme.blueprints.user.models import User
+from vidme.blueprints.billing.gateways.http_client import StripeHTTPClient
 from vidme.api.auth import AuthView
 from vidme.api.stripe_webhook import StripeWebhookView
 from vidme.api.v1.user import UsersView
@@ -18,11 +19,21 @@ from vidme.extensions import (
     jwt,
     db,
     marshmallow,
-    mail
+    mail,
+    identity_cache,
+    password_hasher,
+    activity_buffer,
+    dashboard_counters,
+    product_cache,
+    upcoming_invoice_cache,
+    webhook_replay_cache,
+    plan_registry,
+    request_metrics
 )
 
 CELERY_TASK_LIST = [
     'vidme.blueprints.admin.tasks',
+    'vidme.blueprints.billing.tasks',
     'vidme.blueprints.user.tasks',
 ]
 
@@ -71,6 +82,11 @@ def create_app(settings_override=None):
 
     stripe.api_key = app.config.get('STRIPE_SECRET_KEY')
     stripe.api_version = app.config.get('STRIPE_API_VERSION')
+    stripe.max_network_retries = app.config.get('STRIPE_MAX_NETWORK_RETRIES',
+                                                2)
+    stripe.default_http_client = StripeHTTPClient.from_config(app.config)
+    if app.config.get('STRIPE_API_BASE'):
+        stripe.api_base = app.config['STRIPE_API_BASE']
 
     # register the API views
     AuthView.register(app)
@@ -101,6 +117,15 @@ def extensions(app):
     db.init_app(app)
     marshmallow.init_app(app)
     mail.init_app(app)
+    identity_cache.init_app(app)
+    password_hasher.init_app(app)
+    activity_buffer.init_app(app)
+    dashboard_counters.init_app(app)
+    product_cache.init_app(app)
+    upcoming_invoice_cache.init_app(app)
+    webhook_replay_cache.init_app(app)
+    plan_registry.init_app(app)
+    request_metrics.init_app(app)
 
     return None
 
@@ -116,7 +141,7 @@ def jwt_callbacks():
         This is called every time a user accesses a protected endpoint.
         "username" was the identity we used when creating the access_token
         """
-        return User.query.filter(User.username == identity).first()
+        return User.find_by_jwt_identity(identity)
 
     @jwt.user_claims_loader
     def add_claims_to_access_token_callback(identity):
@@ -125,11 +150,13 @@ def jwt_callbacks():
         additional info regarding the user to the access token. Identity
         (username) of the user is passed as a param. Will mainly be used to
         determine if a user is an admin or not.
+
+        Views which already have the user loaded should pass
+        user_claims=user.jwt_claims() to create_access_token instead, which
+        skips this callback.
         """
         user = User.query.filter(User.username == identity).first()
-        return {
-            'role': user.role
-        }
+        return user.jwt_claims()
 
     @jwt.unauthorized_loader
     def jwt_unauthorized_callback(error):
@@ -1,14 +1,29 @@
-from sqlalchemy import func
+from collections import OrderedDict, defaultdict
+
+from sqlalchemy import event, func, inspect
 
 from vidme.blueprints.user.models import User, db
+from vidme.blueprints.billing.models.credit_card import CreditCard
+from vidme.blueprints.billing.models.invoice import Invoice
 from vidme.blueprints.billing.models.subscription import Subscription
+from vidme.extensions import dashboard_counters
 
 
 class Dashboard(object):
     """
     This class will help with displaying certain data regarding users and
     plans.
+
+    Counts are read from the dashboard counter store, which is kept up to date
+    as users and subscriptions are committed (see the listeners below) and
+    reconciled with the database periodically.
     """
+    # Counter group name -> (model, field to group on)
+    COUNTERS = {
+        'users': (User, 'role'),
+        'plans': (Subscription, 'plan')
+    }
+
     @classmethod
     def group_and_count_plans(cls):
         """
@@ -16,7 +31,7 @@ class Dashboard(object):
 
         :return: dict
         """
-        return Dashboard._group_and_count(Subscription, Subscription.plan)
+        return Dashboard._counted('plans')
 
     @classmethod
     def group_and_count_users(cls):
@@ -25,7 +40,63 @@ class Dashboard(object):
 
         :return: dict
         """
-        return Dashboard._group_and_count(User, User.role)
+        return Dashboard._counted('users')
+
+    @classmethod
+    def reconcile_counters(cls, group=None):
+        """
+        Rebuild 1 or all counter groups from the database, this corrects any
+        drift from writes the listeners didn't see (bulk queries, cascades in
+        the database or a rolled back savepoint).
+
+        :param group: Counter group name, defaults to all of them
+        :type group: str
+        :return: dict of counts per group
+        """
+        groups = [group] if group else Dashboard.COUNTERS.keys()
+        reconciled = {}
+
+        for name in groups:
+            model, field = Dashboard.COUNTERS[name]
+            column = getattr(model, field)
+
+            query = db.session.query(column, func.count(model.id)) \
+                .group_by(column).all()
+            counts = {_counter_key(value): count for value, count in query}
+
+            dashboard_counters.replace(name, counts)
+            reconciled[name] = counts
+
+        return reconciled
+
+    @classmethod
+    def _counted(cls, group):
+        """
+        Return the counts of a counter group in the same format as
+        _group_and_count, rebuilding the group if it's missing.
+
+        :param group: Counter group name
+        :type group: str
+        :return: dict
+        """
+        counts = dashboard_counters.get(group)
+
+        if counts is None:
+            if not dashboard_counters.enabled:
+                model, field = Dashboard.COUNTERS[group]
+                return Dashboard._group_and_count(model,
+                                                  getattr(model, field))
+
+            counts = Dashboard.reconcile_counters(group)[group]
+
+        # Rows without a value are part of the total but not grouped
+        query = [[count, value] for value, count in sorted(counts.items())
+                 if value and count]
+
+        return {
+            'query': query,
+            'total': sum(counts.values())
+        }
 
     @classmethod
     def _group_and_count(cls, model, field):
@@ -49,3 +120,236 @@ class Dashboard(object):
         }
 
         return results
+
+
+class Export(object):
+    """
+    Export users and invoices for finance or support. Rows are read with a
+    server side cursor (on Postgres) and only the exported columns are
+    selected, so memory use doesn't grow with the size of the table.
+    """
+    # Rows fetched from the database at a time
+    BATCH_SIZE = 1000
+
+    USER_COLUMNS = OrderedDict([
+        ('id', User.id),
+        ('username', User.username),
+        ('email', User.email),
+        ('name', User.name),
+        ('role', User.role),
+        ('sign_in_count', User.sign_in_count),
+        ('last_sign_in_on', User.last_sign_in_on),
+        ('created_on', User.created_on),
+        ('payment_id', User.payment_id),
+        ('cancelled_subscription_on', User.cancelled_subscription_on),
+        ('plan', Subscription.plan),
+        ('subscribed_on', Subscription.created_on),
+        ('brand', CreditCard.brand),
+        ('last4', CreditCard.last4),
+        ('exp_date', CreditCard.exp_date)
+    ])
+
+    INVOICE_COLUMNS = OrderedDict([
+        ('id', Invoice.id),
+        ('user_id', Invoice.user_id),
+        ('username', User.username),
+        ('email', User.email),
+        ('created_on', Invoice.created_on),
+        ('plan', Invoice.plan),
+        ('receipt_number', Invoice.receipt_number),
+        ('description', Invoice.description),
+        ('period_start_on', Invoice.period_start_on),
+        ('period_end_on', Invoice.period_end_on),
+        ('currency', Invoice.currency),
+        ('tax', Invoice.tax),
+        ('tax_percent', Invoice.tax_percent),
+        ('total', Invoice.total),
+        ('brand', Invoice.brand),
+        ('last4', Invoice.last4),
+        ('exp_date', Invoice.exp_date)
+    ])
+
+    @classmethod
+    def users(cls, query='', sort='created_on', direction='desc'):
+        """
+        Export users along with their subscription and credit card. Users
+        are searched and sorted like the admin's list of users.
+
+        :param query: Search query
+        :type query: str
+        :param sort: User field to sort by, or relevance
+        :type sort: str
+        :param direction: asc or desc
+        :type direction: str
+        :return: tuple of (column names, iterable of rows)
+        """
+        rows = db.session.query(*Export.USER_COLUMNS.values()) \
+            .select_from(User) \
+            .outerjoin(Subscription, Subscription.user_id == User.id) \
+            .outerjoin(CreditCard, CreditCard.user_id == User.id) \
+            .filter(User.search(query)) \
+            .order_by(*Export._user_order(query, sort, direction)) \
+            .yield_per(Export.BATCH_SIZE)
+
+        return list(Export.USER_COLUMNS), rows
+
+    @classmethod
+    def invoices(cls, query='', sort='created_on', direction='desc'):
+        """
+        Export the invoices of the users matching a search, newest first
+        unless sorted otherwise.
+
+        :param query: Search query, applied to the invoice's user
+        :type query: str
+        :param sort: Invoice field to sort by
+        :type sort: str
+        :param direction: asc or desc
+        :type direction: str
+        :return: tuple of (column names, iterable of rows)
+        """
+        field, direction = Invoice.sort_by(sort, direction)
+        column = Invoice.__table__.columns[field]
+
+        rows = db.session.query(*Export.INVOICE_COLUMNS.values()) \
+            .select_from(Invoice) \
+            .join(User, User.id == Invoice.user_id) \
+            .filter(User.search(query)) \
+            .order_by(getattr(column, direction)(),
+                      getattr(Invoice.id, direction)()) \
+            .yield_per(Export.BATCH_SIZE)
+
+        return list(Export.INVOICE_COLUMNS), rows
+
+    @classmethod
+    def _user_order(cls, query, sort, direction):
+        """
+        Order users the same way as AdminView:users.
+
+        :param query: Search query
+        :type query: str
+        :param sort: User field to sort by, or relevance
+        :type sort: str
+        :param direction: asc or desc
+        :type direction: str
+        :return: list of SQLAlchemy order by clauses
+        """
+        if query and sort == 'relevance':
+            return [User.search_rank(query), User.id]
+
+        field, direction = User.sort_by(sort, direction)
+        column = User.__table__.columns[field]
+
+        # Columns are qualified, subscriptions and credit cards have the same
+        # field names
+        return [User.role.asc(), User.payment_id.asc(),
+                getattr(column, direction)(), User.id.asc()]
+
+
+def _counter_key(value):
+    """
+    Counters are keyed by strings, rows without a value are counted under "".
+
+    :param value: Value being counted
+    :return: str
+    """
+    return '' if value is None else str(value)
+
+
+def _queue_counter_delta(target, group, value, amount):
+    """
+    Record a change to a counter, it's only applied once the session commits.
+
+    :param target: Model instance being flushed
+    :param group: Counter group name
+    :type group: str
+    :param value: Value being counted
+    :param amount: Amount to add
+    :type amount: int
+    :return: None
+    """
+    session = inspect(target).session
+    deltas = session.info.setdefault('dashboard_counter_deltas',
+                                     defaultdict(int))
+    deltas[(group, _counter_key(value))] += amount
+
+    return None
+
+
+def _loaded_or_default(target, field):
+    """
+    Get the value of a field without triggering a load. Server defaults are
+    only known to the database, so fall back to the column's server default.
+
+    :param target: Model instance
+    :param field: Field name
+    :type field: str
+    :return: Value of the field
+    """
+    value = inspect(target).dict.get(field)
+
+    if value is None:
+        server_default = target.__table__.columns[field].server_default
+        if server_default is not None:
+            value = server_default.arg
+
+    return value
+
+
+def _count_insert(mapper, connection, target):
+    for group, (model, field) in Dashboard.COUNTERS.items():
+        if isinstance(target, model):
+            _queue_counter_delta(target, group,
+                                 _loaded_or_default(target, field), 1)
+
+
+def _count_delete(mapper, connection, target):
+    for group, (model, field) in Dashboard.COUNTERS.items():
+        if isinstance(target, model):
+            _queue_counter_delta(target, group, getattr(target, field), -1)
+
+
+def _count_update(mapper, connection, target):
+    for group, (model, field) in Dashboard.COUNTERS.items():
+        if isinstance(target, model):
+            history = inspect(target).attrs[field].history
+
+            if history.added and history.deleted:
+                _queue_counter_delta(target, group, history.deleted[0], -1)
+                _queue_counter_delta(target, group, history.added[0], 1)
+
+
+def _keep_previous_value(target, value, oldvalue, initiator):
+    # Registered with active_history so an expired field's old value is loaded
+    # when it's set, otherwise updates can't tell which counter to decrement
+    return value
+
+
+def _apply_counter_deltas(session):
+    deltas = session.info.pop('dashboard_counter_deltas', None)
+
+    if not deltas:
+        return None
+
+    groups = defaultdict(dict)
+    for (group, value), amount in deltas.items():
+        if amount:
+            groups[group][value] = amount
+
+    for group, group_deltas in groups.items():
+        dashboard_counters.incr(group, group_deltas)
+
+
+def _discard_counter_deltas(session):
+    session.info.pop('dashboard_counter_deltas', None)
+
+
+for _model, _field in Dashboard.COUNTERS.values():
+    event.listen(getattr(_model, _field), 'set', _keep_previous_value,
+                 active_history=True, retval=True)
+    event.listen(_model, 'after_insert', _count_insert)
+    # Deletes are counted before the row is gone so the field can be loaded
+    event.listen(_model, 'before_delete', _count_delete)
+    event.listen(_model, 'after_update', _count_update)
+
+event.listen(db.session, 'after_commit', _apply_counter_deltas)
+event.listen(db.session, 'after_rollback', _discard_counter_deltas)
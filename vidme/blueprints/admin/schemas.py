@@ -1,5 +1,6 @@
 from marshmallow import fields, ValidationError, validate
 
+from lib.compiled_schema import CompiledSchema
 from vidme.extensions import marshmallow
 from vidme.blueprints.billing.schemas import (
     CreditCardSchema,
@@ -64,6 +65,7 @@ class BulkDeleteSchema(marshmallow.Schema):
 
 
 admin_edit_user_schema = AdminEditUserschema()
-users_schema = UserSchema(many=True)
-user_detail_schema = UserDetailSchema()
+# Dumped on every admin page, see lib.compiled_schema
+users_schema = CompiledSchema(UserSchema(many=True))
+user_detail_schema = CompiledSchema(UserDetailSchema())
 bulk_delete_schema = BulkDeleteSchema()
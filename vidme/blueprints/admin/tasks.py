@@ -1,16 +1,44 @@
 from vidme.app import create_celery_app
 from vidme.blueprints.user.models import User
+from vidme.blueprints.admin.models import Dashboard
 
 celery = create_celery_app()
 
 
+@celery.task(bind=True)
+def delete_users(self, ids):
+    """
+    Delete users and potentially cancel their subscription. Progress is
+    reported as a PROGRESS state after every batch, users whose subscription
+    couldn't be cancelled are listed under "failed".
+
+    :param ids: List of ids or a scope from User.bulk_action_scope()
+    :type ids: list or dict
+    :return: dict
+    """
+    result = {'total': 0, 'deleted': 0, 'failed': []}
+
+    def progress(deleted, failed_ids, total):
+        result['total'] = total
+        result['deleted'] = deleted
+        result['failed'] = list(failed_ids)
+
+        if self.request.id:
+            self.update_state(state='PROGRESS', meta=result)
+
+    User.bulk_delete(ids, progress=progress)
+
+    # Bulk deletes bypass the ORM events that keep the counters up to date
+    Dashboard.reconcile_counters()
+
+    return result
+
+
 @celery.task()
-def delete_users(ids):
+def reconcile_dashboard_counters():
     """
-    Delete users and potentially cancel their subscription.
+    Rebuild the dashboard's user and plan counters from the database.
 
-    :param ids: List of ids to be deleted
-    :type ids: list
-    :return: int
+    :return: dict
     """
-    return User.bulk_delete(ids)
+    return Dashboard.reconcile_counters()
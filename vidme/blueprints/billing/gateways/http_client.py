@@ -0,0 +1,216 @@
+import threading
+import time
+
+import requests
+import stripe
+from requests.adapters import HTTPAdapter
+from stripe.http_client import RequestsClient
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+from vidme.extensions import request_metrics
+
+
+class CircuitOpenError(stripe.error.APIConnectionError):
+    """
+    Raised instead of calling Stripe while the circuit breaker is open, it's
+    an APIConnectionError so it's handled like Stripe being unreachable.
+    """
+    def __init__(self, message='Stripe is unavailable, not sending request.'):
+        super(CircuitOpenError, self).__init__(message, should_retry=False)
+
+
+class CircuitBreaker(object):
+    """
+    Stop calling Stripe for reset_timeout seconds once threshold calls in a
+    row have failed. After that a single call is let through, if it succeeds
+    the breaker closes again otherwise it stays open for another period.
+    """
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_on = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_on is not None
+
+    def allow(self):
+        """
+        Determine if a call can be made.
+
+        :return: bool
+        """
+        with self._lock:
+            if self.opened_on is None:
+                return True
+
+            if time.monotonic() - self.opened_on >= self.reset_timeout:
+                # Let this call through as a trial, others keep failing fast
+                self.opened_on = time.monotonic()
+                return True
+
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_on = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+
+            if self.failures >= self.threshold:
+                self.opened_on = time.monotonic()
+
+
+class StripeHTTPClient(RequestsClient):
+    """
+    The HTTP client used for every Stripe call. Compared to the stripe
+    library's default client it:
+
+    - Keeps a pool of connections per gunicorn worker (per thread, as
+      requests sessions aren't thread safe)
+    - Uses separate timeouts for connecting, reads and writes
+    - Retries rate limits and server errors as well as connection errors,
+      with jittered exponential backoff (stripe.max_network_retries times).
+      Writes are only retried when they're idempotent, the stripe library
+      adds an Idempotency-Key to every POST and re-sends it on retries.
+      Other writes (DELETE) are only retried when they never reached
+      Stripe, a timeout could be a delete which went through.
+    - Fails fast with CircuitOpenError while Stripe is down
+    - Counts calls (and their time) per request, see lib.request_metrics
+    """
+    RETRY_STATUSES = (409, 429, 500, 502, 503, 504)
+    IDEMPOTENT_METHODS = ('get', 'post')
+
+    def __init__(self, connect_timeout=2, read_timeout=10, write_timeout=20,
+                 pool_size=10, retry_delay=0.5, max_retry_delay=5,
+                 breaker=None, **kwargs):
+        super(StripeHTTPClient, self).__init__(timeout=read_timeout,
+                                               **kwargs)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.write_timeout = write_timeout
+        self.pool_size = pool_size
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.breaker = breaker or CircuitBreaker()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Create a client from the Flask app's config.
+
+        :param config: Flask app config
+        :type config: dict
+        :return: StripeHTTPClient
+        """
+        breaker = CircuitBreaker(
+            threshold=config.get('STRIPE_CIRCUIT_BREAKER_THRESHOLD', 5),
+            reset_timeout=config.get('STRIPE_CIRCUIT_BREAKER_RESET_TIMEOUT',
+                                     30))
+
+        return cls(connect_timeout=config.get('STRIPE_CONNECT_TIMEOUT', 2),
+                   read_timeout=config.get('STRIPE_READ_TIMEOUT', 10),
+                   write_timeout=config.get('STRIPE_WRITE_TIMEOUT', 20),
+                   pool_size=config.get('STRIPE_POOL_SIZE', 10),
+                   retry_delay=config.get('STRIPE_RETRY_DELAY', 0.5),
+                   breaker=breaker)
+
+    @property
+    def _timeout(self):
+        return getattr(self._thread_local, 'timeout', None)
+
+    @_timeout.setter
+    def _timeout(self, value):
+        # Set by RequestsClient, timeouts are picked per request instead
+        pass
+
+    def _new_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+        return session
+
+    def request(self, method, url, headers, post_data=None):
+        if getattr(self._thread_local, 'session', None) is None:
+            self._thread_local.session = self._new_session()
+
+        read_timeout = self.read_timeout if method == 'get' \
+            else self.write_timeout
+        self._thread_local.timeout = (self.connect_timeout, read_timeout)
+
+        return super(StripeHTTPClient, self).request(method, url, headers,
+                                                     post_data=post_data)
+
+    def request_with_retries(self, method, url, headers, post_data=None):
+        if not self.breaker.allow():
+            raise CircuitOpenError()
+
+        self._thread_local.method = method
+        self._thread_local.sent = True
+        started_on = time.perf_counter()
+
+        try:
+            response = super(StripeHTTPClient, self).request_with_retries(
+                method, url, headers, post_data=post_data)
+        except stripe.error.APIConnectionError:
+            self.breaker.record_failure()
+            raise
+        finally:
+            # Retries are part of the same call
+            request_metrics.record('stripe', time.perf_counter() - started_on)
+
+        if response[1] >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+
+        return response
+
+    def _handle_request_error(self, e):
+        self._thread_local.sent = not _failed_to_connect(e)
+
+        return super(StripeHTTPClient, self)._handle_request_error(e)
+
+    def _should_retry(self, response, api_connection_error, num_retries):
+        # num_retries counts the first attempt too
+        if num_retries > self._max_network_retries():
+            return False
+
+        idempotent = self._thread_local.method in self.IDEMPOTENT_METHODS
+
+        if response is not None:
+            return response[1] in self.RETRY_STATUSES and idempotent
+
+        return api_connection_error.should_retry and \
+            (idempotent or not self._thread_local.sent)
+
+    def _sleep_time_seconds(self, num_retries):
+        delay = min(self.retry_delay * 2 ** (num_retries - 1),
+                    self.max_retry_delay)
+
+        return self._add_jitter_time(delay)
+
+
+def _failed_to_connect(error):
+    """
+    Determine if a request failed before it could be sent.
+
+    :param error: Error raised by requests
+    :type error: Exception
+    :return: bool
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+
+    if isinstance(error, requests.exceptions.ConnectionError) and \
+            error.args and isinstance(error.args[0], MaxRetryError):
+        return isinstance(error.args[0].reason, NewConnectionError)
+
+    return False
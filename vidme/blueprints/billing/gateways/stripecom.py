@@ -1,5 +1,13 @@
+import itertools
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import stripe
 
+from vidme.extensions import product_cache
+
 
 class Event(object):
     @classmethod
@@ -17,6 +25,32 @@ class Event(object):
         """
         return stripe.Event.retrieve(event_id)
 
+    @classmethod
+    def verify(cls, payload, signature, secret, tolerance=300):
+        """
+        Verify that an event was sent by stripe from the Stripe-Signature
+        header, without calling the API. Signatures older than the tolerance
+        are rejected so a captured request can't be replayed later on.
+
+        Docs: https://stripe.com/docs/webhooks/signatures
+
+        :param payload: Request body
+        :type payload: str
+        :param signature: Stripe-Signature header
+        :type signature: str
+        :param secret: Endpoint's signing secret
+        :type secret: str
+        :param tolerance: Max age of the signature in seconds
+        :type tolerance: int
+        :return: True, raises SignatureVerificationError otherwise
+        """
+        if not signature:
+            raise stripe.error.SignatureVerificationError(
+                'No signatures found', signature, payload)
+
+        return stripe.WebhookSignature.verify_header(payload, signature,
+                                                     secret, tolerance)
+
 
 class Subscription(object):
     @classmethod
@@ -39,15 +73,23 @@ class Subscription(object):
             'plan': plan
         }
 
-        return stripe.Customer.create(**params)
+        # Tokens can only be used once, so retrying with the same key can
+        # never subscribe (and charge) a customer twice
+        return stripe.Customer.create(
+            idempotency_key='customer-{0}'.format(token), **params)
 
     @classmethod
-    def update(cls, customer_id=None, plan=None):
+    def update(cls, customer_id=None, plan=None, subscription_id=None,
+               item_id=None):
         """
         Send a request to the stripe API to update an existing subscription
         without interupting the users access to our platform or requiring the
         user to re-enter their billing info.
 
+        With the subscription and subscription item IDs the subscription is
+        updated in a single request, otherwise it's looked up through the
+        customer first.
+
         :param customer_id: User's payment ID. initally set when user
         subscribes on our platform
         :type customer_id: str
@@ -55,8 +97,18 @@ class Subscription(object):
         :param plan: New plan to subscribe to
         :type plan: str
 
+        :param subscription_id: Stripe subscription ID
+        :type subscription_id: str
+
+        :param item_id: Stripe subscription item ID
+        :type item_id: str
+
         :return: Stripe subscription object
         """
+        if subscription_id and item_id:
+            return stripe.Subscription.modify(
+                subscription_id, items=[{'id': item_id, 'plan': plan}])
+
         customer = stripe.Customer.retrieve(customer_id)
         subscription_id = customer.subscriptions.data[0].id
         subscription = customer.subscriptions.retrieve(subscription_id)
@@ -65,21 +117,110 @@ class Subscription(object):
         return subscription.save()
 
     @classmethod
-    def cancel(cls, customer_id=None):
+    def cancel(cls, customer_id=None, subscription_id=None):
         """
         Send a request to the stripe API to cancel a user's subscription.
 
+        With the subscription ID the subscription is deleted in a single
+        request, otherwise it's looked up through the customer first. A
+        customer without a subscription raises an InvalidRequestError with a
+        404 status, like deleting a subscription that doesn't exist.
+
         :param customer_id: User's payment ID. initally set when user
         subscribes on our platform
         :type customer_id: str
 
+        :param subscription_id: Stripe subscription ID
+        :type subscription_id: str
+
         :return: Stripe subscription object
         """
+        if subscription_id:
+            return stripe.Subscription(subscription_id).delete()
+
         customer = stripe.Customer.retrieve(customer_id)
+        if not customer.subscriptions.data:
+            raise stripe.error.InvalidRequestError(
+                'No active subscription.', 'subscription', http_status=404)
+
         subscription_id = customer.subscriptions.data[0].id
 
         return customer.subscriptions.retrieve(subscription_id).delete()
 
+    @classmethod
+    def retrieve_for_customer(cls, customer_id):
+        """
+        Retrieve a customer's subscription.
+
+        API docs: https://stripe.com/docs/api/subscriptions/list
+
+        :param customer_id: User's payment ID
+        :type customer_id: str
+        :return: Stripe subscription or None
+        """
+        subscriptions = stripe.Subscription.list(customer=customer_id,
+                                                 limit=1)
+
+        return subscriptions.data[0] if subscriptions.data else None
+
+    @classmethod
+    def cancel_many(cls, customer_ids, subscription_ids=None, workers=8,
+                    retries=1, backoff=0.5):
+        """
+        Cancel the subscriptions of many customers concurrently. Each request
+        is already retried by the HTTP client, except for deletes which may
+        have reached stripe. Rate limits and connection/server errors that
+        get through are retried with exponential backoff, any other error is
+        given up on straight away. A failed attempt may still have cancelled
+        the subscription, so a retry which finds nothing left to cancel
+        counts as a success.
+
+        :param customer_ids: Users' payment IDs
+        :type customer_ids: list
+        :param subscription_ids: Stripe subscription ID of each customer, if
+                                 known
+        :type subscription_ids: dict
+        :param workers: Max number of concurrent requests
+        :type workers: int
+        :param retries: Max number of retries per customer
+        :type retries: int
+        :param backoff: Seconds to wait before the first retry
+        :type backoff: float
+        :return: dict of customer ID -> error for customers that failed
+        """
+        if not customer_ids:
+            return {}
+
+        subscription_ids = subscription_ids or {}
+        retryable = (stripe.error.RateLimitError,
+                     stripe.error.APIConnectionError,
+                     stripe.error.APIError)
+
+        def cancel(customer_id):
+            for attempt in range(retries + 1):
+                try:
+                    cls.cancel(
+                        customer_id=customer_id,
+                        subscription_id=subscription_ids.get(customer_id))
+                    return None
+                except retryable as e:
+                    if attempt == retries:
+                        return e
+                    time.sleep(backoff * 2 ** attempt)
+                except stripe.error.InvalidRequestError as e:
+                    if attempt and e.http_status == 404:
+                        return None
+                    return e
+                except stripe.error.StripeError as e:
+                    return e
+
+        with ThreadPoolExecutor(max_workers=min(workers,
+                                                len(customer_ids))) as pool:
+            errors = list(pool.map(cancel, customer_ids))
+
+        return {customer_id: error for customer_id, error
+                in zip(customer_ids, errors) if error is not None}
+
 
 class Invoice(object):
     @classmethod
@@ -95,6 +236,97 @@ class Invoice(object):
         """
         return stripe.Invoice.upcoming(customer=customer_id)
 
+    @classmethod
+    def list_for_customer(cls, customer_id, created=None, page_size=100):
+        """
+        Iterate over every invoice of a specific user, newest first. Pages
+        are only fetched as they're reached.
+
+        API docs: https://stripe.com/docs/api#list_invoices
+
+        :param customer_id: Customer's stripe ID
+        :type customer_id: str
+        :param created: Creation date filter such as {'gte': timestamp}
+        :type created: dict
+        :param page_size: Invoices per request
+        :type page_size: int
+        :return: Iterator of Stripe Invoices
+        """
+        params = {'customer': customer_id, 'limit': page_size}
+        if created:
+            params['created'] = created
+
+        return stripe.Invoice.list(**params).auto_paging_iter()
+
+    @classmethod
+    def list_many(cls, customer_ids, created=None, workers=8, page_size=100):
+        """
+        List the invoices of many customers concurrently. Each page of
+        invoices is yielded as it arrives, so a customer's history is never
+        held in memory all at once. Once a customer is done (None, error) is
+        yielded for them, errors are yielded instead of raised so 1 customer
+        doesn't stop the rest.
+
+        :param customer_ids: Customers' stripe IDs
+        :type customer_ids: list
+        :param created: Creation date filter such as {'gte': timestamp}
+        :type created: dict
+        :param workers: Max number of concurrent requests
+        :type workers: int
+        :param page_size: Invoices per request
+        :type page_size: int
+        :return: Iterator of (customer ID, list of invoices or None, error)
+                 tuples
+        """
+        if not customer_ids:
+            return
+
+        # Workers wait while the consumer catches up
+        results = queue.Queue(maxsize=workers * 2)
+        stop = threading.Event()
+
+        def list_invoices(customer_id):
+            error = None
+
+            try:
+                invoices = cls.list_for_customer(customer_id, created,
+                                                 page_size)
+                while not stop.is_set():
+                    page = list(itertools.islice(invoices, page_size))
+                    if not page:
+                        break
+                    results.put((customer_id, page, None))
+            except Exception as e:
+                error = e
+
+            results.put((customer_id, None, error))
+
+        with ThreadPoolExecutor(max_workers=min(workers,
+                                                len(customer_ids))) as pool:
+            futures = [pool.submit(list_invoices, customer_id)
+                       for customer_id in customer_ids]
+            finished = 0
+
+            try:
+                while finished < len(customer_ids):
+                    customer_id, invoices, error = results.get()
+
+                    if invoices is None:
+                        finished += 1
+                        if error is not None and not isinstance(
+                                error, stripe.error.StripeError):
+                            raise error
+
+                    yield customer_id, invoices, error
+            finally:
+                # Let workers blocked on a full queue finish
+                stop.set()
+                while not all(future.done() for future in futures):
+                    try:
+                        results.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+
 
 class Card(object):
     @classmethod
@@ -134,6 +366,74 @@ class Product(object):
         except stripe.error.StripeError as e:
             print(e)
 
+    @classmethod
+    def cached(cls, product):
+        """
+        Retrieve an existing product as a dict, from the product cache when
+        possible. Products only change when plans are synced so they're
+        cached for STRIPE_PRODUCT_CACHE_TTL seconds per worker and shared
+        between workers through Redis.
+
+        :param product: Product identifier
+        :type product: str
+
+        :return: dict or None
+        """
+        value = product_cache.get(product)
+
+        if value is None:
+            value = cls.retrieve(product)
+            if value is None:
+                return None
+
+            value = cls._to_dict(value)
+            product_cache.set(product, value)
+
+        return value
+
+    @classmethod
+    def warm_cache(cls):
+        """
+        Cache every product, so the first invoices parsed after plans are
+        synced don't need to call Stripe.
+
+        API docs: https://stripe.com/docs/api#list_products
+
+        :return: Number of products cached
+        """
+        count = 0
+
+        try:
+            for product in stripe.Product.list(limit=100).auto_paging_iter():
+                product_cache.set(product.id, cls._to_dict(product))
+                count += 1
+        except stripe.error.StripeError as e:
+            print(e)
+
+        return count
+
+    @classmethod
+    def invalidate(cls, *products):
+        """
+        Remove 1 or more products from the product cache.
+
+        :return: None
+        """
+        return product_cache.delete(*products)
+
+    @classmethod
+    def _to_dict(cls, product):
+        """
+        Stripe objects hold on to an API key, only cache their values.
+
+        :param product: Stripe product
+        :return: dict
+        """
+        if hasattr(product, 'to_dict_recursive'):
+            return product.to_dict_recursive()
+
+        return dict(product)
+
 
 class Plan(object):
     """
@@ -195,6 +495,8 @@ class Plan(object):
             product = Product.retrieve(product_id)
             product.name = name
             product.statement_descriptor = statement_descriptor
+            product.save()
+            Product.invalidate(product_id)
 
             return updated_plan
         except stripe.error.StripeError as e:
@@ -219,6 +521,7 @@ class Plan(object):
 
             product = Product.retrieve(product_id)
             product.delete()
+            Product.invalidate(product_id)
 
             return deleted_plan
         except stripe.error.StripeError as e:
@@ -2,7 +2,7 @@ import datetime
 
 from lib.util_datetime import timedelta_months
 from lib.util_sqlalchemy import ResourceMixin
-from vidme.extensions import db
+from vidme.extensions import db, identity_cache
 
 
 class CreditCard(ResourceMixin, db.Model):
@@ -26,6 +26,17 @@ class CreditCard(ResourceMixin, db.Model):
         # Call Flask-SQLAlchemy's constructor
         super(CreditCard, self).__init__(**kwargs)
 
+    def cache_keys(self):
+        """
+        Cards are part of their owner's identity cache snapshot.
+
+        :return: list
+        """
+        # "credit_card" is the backref to the User who owns this card
+        user = self.credit_card
+
+        return [user.username] if user else []
+
     @classmethod
     def is_expiring_soon(cls, compare_date=None, exp_date=None):
         """
@@ -77,4 +88,10 @@ class CreditCard(ResourceMixin, db.Model):
         CreditCard.query.filter(CreditCard.exp_date <= today_with_delta) \
             .update({CreditCard.is_expiring: True})
 
-        return db.session.commit()
+        result = db.session.commit()
+
+        # Cards are cached along with their owner, there's no telling which
+        # ones were just marked so start over
+        identity_cache.clear()
+
+        return result
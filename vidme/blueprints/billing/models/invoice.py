@@ -1,7 +1,14 @@
 import datetime
+import time
+from collections import OrderedDict
 
-from lib.util_sqlalchemy import ResourceMixin
-from vidme.extensions import db
+import pytz
+from flask import current_app
+from sqlalchemy.dialects.postgresql import insert
+
+from lib.util_datetime import timezone_aware_datetime
+from lib.util_sqlalchemy import ResourceMixin, AwareDateTime
+from vidme.extensions import db, upcoming_invoice_cache
 from vidme.blueprints.billing.gateways.stripecom import (
     Invoice as PaymentInvoice,
     Product as PaymentProduct
@@ -9,18 +16,32 @@ from vidme.blueprints.billing.gateways.stripecom import (
 
 
 class Invoice(ResourceMixin, db.Model):
+    # Fields of a parsed event which are stored as is
+    EVENT_FIELDS = ('plan', 'receipt_number', 'description', 'period_start_on',
+                    'period_end_on', 'currency', 'tax', 'tax_percent', 'total')
+
     __tablename__ = 'invoices'
+    __table_args__ = (
+        # Matches the order of billing_history, so a page is read straight
+        # from the index instead of sorting all of a user's invoices. It also
+        # serves lookups by user_id alone. Neither column can be NULL, so
+        # paginate_keyset doesn't add NULL handling the index can't serve
+        db.Index('ix_invoices_user_id_created_on_id', 'user_id',
+                 db.text('created_on DESC'), db.text('id DESC')),
+    )
     id = db.Column(db.Integer, primary_key=True)
+    created_on = db.Column(AwareDateTime(), nullable=False,
+                           default=timezone_aware_datetime)
 
     # Relationships
     user_id = db.Column(db.Integer, db.ForeignKey('users.id',
                                                   onupdate='CASCADE',
                                                   ondelete='CASCADE'),
-                        index=True, nullable=False)
+                        nullable=False)
 
     # Invoice details (provided by stripe)
     plan = db.Column(db.String(128), index=True)
-    receipt_number = db.Column(db.String(128), index=True)
+    receipt_number = db.Column(db.String(128), unique=True, index=True)
     description = db.Column(db.String(128))
     period_start_on = db.Column(db.Date)
     period_end_on = db.Column(db.Date)
@@ -50,7 +71,7 @@ class Invoice(ResourceMixin, db.Model):
         plan_info = payload['lines']['data'][0]['plan']
         date = datetime.datetime.utcfromtimestamp(payload['date'])
 
-        product = PaymentProduct.retrieve(plan_info['product'])
+        product = PaymentProduct.cached(plan_info['product'])
 
         invoice = {
             'plan': plan_info['nickname'],
@@ -63,18 +84,36 @@ class Invoice(ResourceMixin, db.Model):
         return invoice
 
     @classmethod
-    def billing_history(cls, user=None):
+    def billing_history(cls, user=None, cursor=None, per_page=12,
+                        period_start_on=None, period_end_on=None):
         """
-        Return the billing history for a specifc user.
+        Return a page of the billing history for a specifc user, newest
+        first. Raises a ValueError for an invalid cursor or date.
 
         :param user: User who's billing history is being retrieved
         :type user: User instance
-        :return: Invoices
+        :param cursor: Cursor from a previous page
+        :type cursor: str
+        :param per_page: Max number of invoices
+        :type per_page: int
+        :param period_start_on: Only invoices starting on or after this date
+        :type period_start_on: date or YYYY-MM-DD str
+        :param period_end_on: Only invoices ending on or before this date
+        :type period_end_on: date or YYYY-MM-DD str
+        :return: KeysetPagination
         """
-        invoices = Invoice.query.filter(Invoice.user_id == user.id) \
-            .order_by(Invoice.created_on.desc()).limit(12)
+        query = Invoice.query.filter(Invoice.user_id == user.id)
+
+        if period_start_on:
+            query = query.filter(
+                Invoice.period_start_on >= _parse_date(period_start_on))
+        if period_end_on:
+            query = query.filter(
+                Invoice.period_end_on <= _parse_date(period_end_on))
 
-        return invoices
+        return Invoice.paginate_keyset(
+            query, [(Invoice.__table__.c.created_on, 'desc')], cursor=cursor,
+            per_page=per_page)
 
     @classmethod
     def upcoming(cls, customer_id=None):
@@ -89,6 +128,68 @@ class Invoice(ResourceMixin, db.Model):
 
         return Invoice._parse_from_api(invoice)
 
+    @classmethod
+    def cached_upcoming(cls, customer_id=None):
+        """
+        Return the upcoming invoice for a specific user from the upcoming
+        invoice cache. Stale invoices (older than
+        UPCOMING_INVOICE_CACHE_FRESH_TTL seconds) are still returned, they
+        get refreshed in the background for the next request.
+
+        :param customer_id: Customer's stripe ID
+        :type customer_id: int
+        :return: Tuple of the upcoming invoice and when it was refreshed
+        """
+        entry = upcoming_invoice_cache.get(customer_id)
+        fresh_ttl = current_app.config.get('UPCOMING_INVOICE_CACHE_FRESH_TTL',
+                                           300)
+
+        if entry is None:
+            entry = Invoice.refresh_upcoming(customer_id)
+        elif time.time() - entry['checked_on'] > fresh_ttl:
+            # Mark it as checked so only 1 request schedules a refresh
+            entry['checked_on'] = time.time()
+            upcoming_invoice_cache.set(customer_id, entry)
+
+            from vidme.blueprints.billing.tasks import refresh_upcoming_invoice
+            refresh_upcoming_invoice.delay(customer_id)
+
+        refreshed_on = datetime.datetime.fromtimestamp(entry['refreshed_on'],
+                                                       pytz.utc)
+
+        return entry['invoice'], refreshed_on
+
+    @classmethod
+    def refresh_upcoming(cls, customer_id=None):
+        """
+        Retrieve the upcoming invoice for a specific user and cache it.
+
+        :param customer_id: Customer's stripe ID
+        :type customer_id: int
+        :return: dict
+        """
+        now = time.time()
+        entry = {
+            'invoice': Invoice.upcoming(customer_id),
+            'refreshed_on': now,
+            'checked_on': now
+        }
+        upcoming_invoice_cache.set(customer_id, entry)
+
+        return entry
+
+    @classmethod
+    def invalidate_upcoming(cls, customer_id=None):
+        """
+        Remove the upcoming invoice of a specific user from the cache, for
+        when their subscription changes.
+
+        :param customer_id: Customer's stripe ID
+        :type customer_id: int
+        :return: None
+        """
+        return upcoming_invoice_cache.delete(customer_id)
+
     @classmethod
     def parse_from_event(cls, payload):
         """
@@ -97,7 +198,18 @@ class Invoice(ResourceMixin, db.Model):
 
         :return: dict
         """
-        data = payload['data']['object']
+        return Invoice.parse_from_invoice(payload['data']['object'])
+
+    @classmethod
+    def parse_from_invoice(cls, data):
+        """
+        Parse and return all of the data needed to save an Invoice locally
+        from a Stripe invoice.
+
+        :param data: Stripe invoice
+        :type data: dict
+        :return: dict
+        """
         plan_info = data['lines']['data'][0]['plan']
 
         period_start_on = datetime.datetime.utcfromtimestamp(
@@ -106,7 +218,13 @@ class Invoice(ResourceMixin, db.Model):
             data['lines']['data'][0]['period']['end']).date()
 
         # product has certain data needed for an invoice
-        product = PaymentProduct.retrieve(plan_info['product'])
+        product = PaymentProduct.cached(plan_info['product'])
+
+        # Backfilled invoices keep their place in the billing history, older
+        # API versions only have a date
+        created = data.get('created') or data.get('date')
+        created_on = datetime.datetime.fromtimestamp(created, pytz.utc) \
+            if created else None
 
         invoice = {
             'payment_id': data['customer'],
@@ -118,35 +236,186 @@ class Invoice(ResourceMixin, db.Model):
             'currency': data['currency'],
             'tax': data['tax'],
             'tax_percent': data['tax_percent'],
-            'total': data['total']
+            'total': data['total'],
+            'created_on': created_on
         }
         return invoice
 
+    @classmethod
+    def sync(cls, customer_ids, created=None, workers=8, batch_size=100,
+             page_size=100):
+        """
+        Save the invoices of many customers from Stripe, for invoices whose
+        webhook never arrived. Customers are listed concurrently and their
+        invoices saved in batches as each page comes in.
+
+        Like the webhook, only invoices of customers who are still a user's
+        payment_id and have a credit card are saved. Cancelling clears both,
+        so the history of cancelled customers can't be backfilled.
+
+        :param customer_ids: Customers' stripe IDs
+        :type customer_ids: list
+        :param created: Creation date filter such as {'gte': timestamp}
+        :type created: dict
+        :param workers: Max number of concurrent requests
+        :type workers: int
+        :param batch_size: Invoices per upsert
+        :type batch_size: int
+        :param page_size: Invoices per request
+        :type page_size: int
+        :return: dict with the number of customers and invoices synced and
+                 the error of each customer that failed
+        """
+        result = {'customers': 0, 'invoices': 0, 'failed': {}}
+        pending = []
+
+        for customer_id, invoices, error in PaymentInvoice.list_many(
+                customer_ids, created, workers, page_size):
+            if invoices is None:
+                # The customer is done, their saved pages are kept even if a
+                # later one failed, saving them again is harmless
+                if error is not None:
+                    result['failed'][customer_id] = error
+                else:
+                    result['customers'] += 1
+                continue
+
+            for invoice in invoices:
+                lines = invoice['lines']['data']
+                # Only subscription invoices are kept
+                if lines and lines[0].get('plan'):
+                    pending.append(Invoice.parse_from_invoice(invoice))
+
+            if len(pending) >= batch_size:
+                Invoice.bulk_upsert(pending)
+                result['invoices'] += len(pending)
+                pending = []
+
+        if pending:
+            Invoice.bulk_upsert(pending)
+            result['invoices'] += len(pending)
+
+        return result
+
     @classmethod
     def prepare_and_save(cls, parsed_event):
         """
         Potentially save an invoice after the necessary fields have been
         parsed from the stripe webhook event "invoice.created".
+
         :param parsed_event: Invoice data to be saved
         :type parsed_event: dict
-        :return: User instance
+        :return: User id or None
+        """
+        saved = Invoice.bulk_upsert([parsed_event])
+
+        return saved.get(parsed_event.get('payment_id'))
+
+    @classmethod
+    def bulk_upsert(cls, parsed_events):
+        """
+        Save a batch of invoices parsed from stripe events. Invoices are only
+        saved for users with a credit card, which are looked up in 1 query.
+        Invoices are identified by their receipt number, so an invoice which
+        was already saved (stripe re-sent the event) is updated instead.
+
+        :param parsed_events: Invoices returned by parse_from_event
+        :type parsed_events: list
+        :return: dict of the user id for each customer with saved invoices
         """
         # Avoid circular imports
         from vidme.blueprints.user.models import User
+        from vidme.blueprints.billing.models.credit_card import CreditCard
+
+        payment_ids = {parsed_event.get('payment_id')
+                       for parsed_event in parsed_events}
+        payment_ids.discard(None)
+
+        if not payment_ids:
+            return {}
+
+        owners = db.session.query(User.payment_id, User.id, CreditCard.brand,
+                                  CreditCard.last4, CreditCard.exp_date) \
+            .join(CreditCard, CreditCard.user_id == User.id) \
+            .filter(User.payment_id.in_(payment_ids)) \
+            .order_by(CreditCard.id).all()
+        # The newest card wins when there are several
+        owners = {owner.payment_id: owner for owner in owners}
+
+        now = timezone_aware_datetime()
+        saved = {}
+        # Later events win when a batch has the same invoice more than once
+        rows = OrderedDict()
+
+        for i, parsed_event in enumerate(parsed_events):
+            owner = owners.get(parsed_event.get('payment_id'))
+            if owner is None:
+                continue
+
+            row = {field: parsed_event.get(field)
+                   for field in Invoice.EVENT_FIELDS}
+            row.update(user_id=owner.id, brand=owner.brand,
+                       last4=owner.last4, exp_date=owner.exp_date,
+                       created_on=parsed_event.get('created_on') or now,
+                       updated_on=now)
+
+            rows[row['receipt_number'] or i] = row
+            saved[owner.payment_id] = owner.id
+
+        if not rows:
+            return saved
+
+        # An invoice which was already saved keeps its user and the card it
+        # was billed to, only stripe's details are updated
+        updated_columns = [field for field in Invoice.EVENT_FIELDS
+                           if field != 'receipt_number'] + ['updated_on']
+
+        if db.session.bind.dialect.name == 'postgresql':
+            statement = insert(Invoice.__table__).values(list(rows.values()))
+            statement = statement.on_conflict_do_update(
+                index_elements=['receipt_number'],
+                set_={column: statement.excluded[column]
+                      for column in updated_columns})
+            db.session.execute(statement)
+        else:
+            receipt_numbers = [row['receipt_number'] for row in rows.values()
+                               if row['receipt_number']]
+            existing = dict(
+                db.session.query(Invoice.receipt_number, Invoice.id)
+                .filter(Invoice.receipt_number.in_(receipt_numbers)).all())
+
+            updates = []
+            inserts = []
+            for row in rows.values():
+                id = existing.get(row['receipt_number'])
+                if id:
+                    update = {column: row[column]
+                              for column in updated_columns}
+                    update['id'] = id
+                    updates.append(update)
+                else:
+                    inserts.append(row)
+
+            db.session.bulk_update_mappings(Invoice, updates)
+            db.session.bulk_insert_mappings(Invoice, inserts)
+
+        db.session.commit()
 
-        # Only save the invoice if the user is valid
-        id = parsed_event.get('payment_id')
-        user = User.query.filter((User.payment_id == id)).first()
+        return saved
 
-        if user and user.credit_card:
-            parsed_event['user_id'] = user.id
-            parsed_event['brand'] = user.credit_card.brand
-            parsed_event['last4'] = user.credit_card.last4
-            parsed_event['exp_date'] = user.credit_card.exp_date
 
-            del parsed_event['payment_id']
+def _parse_date(value):
+    """
+    Parse a date from a query string.
 
-            invoice = Invoice(**parsed_event)
-            invoice.save()
+    :param value: Date
+    :type value: date or YYYY-MM-DD str
+    :return: date
+    """
+    if isinstance(value, datetime.date):
+        return value
 
-        return user
+    try:
+        return datetime.date.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid date, use YYYY-MM-DD.')
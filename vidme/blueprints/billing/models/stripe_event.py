@@ -0,0 +1,334 @@
+import datetime
+import json
+from collections import OrderedDict
+
+import pytz
+import stripe
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
+
+from lib.util_sqlalchemy import ResourceMixin, AwareDateTime
+from vidme.extensions import db
+from vidme.blueprints.billing.models.invoice import Invoice
+from vidme.blueprints.billing.gateways.stripecom import Event as \
+    PaymentEvent
+
+
+class StripeEvent(ResourceMixin, db.Model):
+    """
+    Webhook events from Stripe, stored as they arrive so the webhook can be
+    acknowledged straight away and applied later by a celery task.
+
+    The customer and date of an event decide the order events are applied
+    in, so they're only taken from events which were signed or retrieved
+    from Stripe, never from an unsigned request body.
+    """
+    STATUS = OrderedDict([
+        ('pending', 'Pending'),
+        ('processed', 'Processed'),
+        ('ignored', 'Ignored'),
+        ('failed', 'Failed')
+    ])
+
+    # Errors which are worth trying again on the next run
+    TRANSIENT_ERRORS = (stripe.error.APIConnectionError,
+                        stripe.error.RateLimitError,
+                        stripe.error.APIError)
+
+    # Any number works, it only has to be the same for every consumer
+    CONSUMER_LOCK_ID = 7220
+
+    __tablename__ = 'stripe_events'
+    id = db.Column(db.Integer, primary_key=True)
+
+    # Event details (provided by stripe)
+    event_id = db.Column(db.String(128), unique=True, nullable=False)
+    type = db.Column(db.String(128))
+    customer_id = db.Column(db.String(128), index=True)
+    occurred_on = db.Column(AwareDateTime(), index=True)
+    payload = db.Column(db.Text())
+    # Signed payloads are used as is, others are retrieved from stripe
+    verified = db.Column(db.Boolean(), nullable=False, server_default='0')
+
+    # Processing
+    status = db.Column(db.Enum(*STATUS, name='stripe_event_statuses',
+                               native_enum=False),
+                       index=True, nullable=False, server_default='pending')
+    attempts = db.Column(db.Integer(), nullable=False, server_default='0')
+    error = db.Column(db.Text())
+
+    def __init__(self, **kwargs):
+        # Call Flask-SQLAlchemy's constructor
+        super(StripeEvent, self).__init__(**kwargs)
+
+    @classmethod
+    def ordering_fields(cls, safe_event):
+        """
+        Parse the customer and the date of an event, which decide the order
+        events are applied in.
+
+        :param safe_event: Event that was signed or retrieved from stripe
+        :type safe_event: dict
+        :return: dict
+        """
+        data = safe_event.get('data', {}).get('object', {})
+        customer_id = data.get('customer')
+        if customer_id is None and data.get('object') == 'customer':
+            customer_id = data.get('id')
+
+        occurred_on = None
+        if safe_event.get('created'):
+            occurred_on = datetime.datetime.fromtimestamp(
+                safe_event['created'], pytz.utc)
+
+        return {'type': safe_event.get('type'),
+                'customer_id': customer_id,
+                'occurred_on': occurred_on}
+
+    @classmethod
+    def enqueue(cls, payload, verified=False):
+        """
+        Store an event received by the webhook, events which were already
+        received (Stripe retries deliveries) are ignored. Nothing but the id
+        of an unverified event is used until it's retrieved from stripe.
+
+        :param payload: Event sent by stripe
+        :type payload: dict
+        :param verified: The event's signature has been verified
+        :type verified: bool
+        :return: bool, True if the event is new
+        """
+        if verified:
+            fields = StripeEvent.ordering_fields(payload)
+        else:
+            fields = {'type': None, 'customer_id': None, 'occurred_on': None}
+
+        values = dict(fields,
+                      event_id=payload['id'],
+                      payload=json.dumps(payload),
+                      verified=verified,
+                      status='pending',
+                      attempts=0)
+
+        if db.session.bind.dialect.name == 'postgresql':
+            statement = insert(StripeEvent.__table__).values(**values) \
+                .on_conflict_do_nothing(index_elements=['event_id'])
+            result = db.session.execute(statement)
+            db.session.commit()
+
+            return result.rowcount == 1
+
+        try:
+            db.session.add(StripeEvent(**values))
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return False
+
+        return True
+
+    @classmethod
+    def is_applicable(cls, safe_event):
+        """
+        Determine if an event is one that gets applied, currently that's
+        events about invoices.
+
+        :param safe_event: Event retrieved from stripe
+        :type safe_event: Stripe event
+        :return: bool
+        """
+        data = safe_event.get('data', {}).get('object', {})
+
+        return data.get('object') == 'invoice'
+
+    @classmethod
+    def apply(cls, safe_event):
+        """
+        Apply a verified event, currently that's saving invoices. Other events
+        are skipped.
+
+        :param safe_event: Event retrieved from stripe
+        :type safe_event: Stripe event
+        :return: User id or None
+        """
+        if not StripeEvent.is_applicable(safe_event):
+            return None
+
+        parsed_event = Invoice.parse_from_event(safe_event)
+        customer_id = parsed_event['payment_id']
+
+        user_id = Invoice.prepare_and_save(parsed_event)
+
+        if user_id:
+            # A new invoice means the upcoming one has changed
+            from vidme.blueprints.billing.tasks import \
+                refresh_upcoming_invoice
+            refresh_upcoming_invoice.delay(customer_id)
+
+        return user_id
+
+    @classmethod
+    def process_pending(cls, batch_size=100, max_attempts=10):
+        """
+        Verify and apply pending events, oldest first. Events of a customer
+        are applied in the order they happened. When an event fails with an
+        error worth retrying the rest of that customer's events wait for the
+        next run, so they're never applied out of order.
+
+        Unsigned events are retrieved from stripe first, which is where their
+        customer and date come from. Until every pending one of them has
+        been retrieved no events are applied, an event that's still
+        unverified could belong to any customer. Only verified events are
+        ever applied.
+
+        Only 1 consumer can run at a time (on Postgres), others return
+        straight away.
+
+        :param batch_size: Max number of events to process
+        :type batch_size: int
+        :param max_attempts: Give up on an event after this many attempts
+        :type max_attempts: int
+        :return: dict of the number of events per resulting status
+        """
+        counts = {'processed': 0, 'ignored': 0, 'failed': 0, 'pending': 0}
+
+        # The lock belongs to a connection, the session's connection goes
+        # back to the pool every time an event is committed
+        lock = None
+        if db.session.bind.dialect.name == 'postgresql':
+            lock = db.engine.connect()
+            if not lock.execute(text('SELECT pg_try_advisory_lock(:id)'),
+                                id=StripeEvent.CONSUMER_LOCK_ID).scalar():
+                lock.close()
+                return counts
+
+        try:
+            unverified = StripeEvent.query \
+                .filter(StripeEvent.status == 'pending',
+                        StripeEvent.verified.is_(False))
+
+            for event in unverified.order_by(StripeEvent.id) \
+                    .limit(batch_size).all():
+                StripeEvent._verify(event, max_attempts)
+                if event.status == 'failed':
+                    counts['failed'] += 1
+
+            # Including events beyond this batch, which wait for later runs
+            waiting = unverified.count()
+            if waiting:
+                counts['pending'] += waiting
+                return counts
+
+            events = StripeEvent.query \
+                .filter(StripeEvent.status == 'pending',
+                        StripeEvent.verified.is_(True)) \
+                .order_by(StripeEvent.occurred_on, StripeEvent.id) \
+                .limit(batch_size).all()
+
+            blocked_customers = set()
+
+            for event in events:
+                if event.customer_id and \
+                        event.customer_id in blocked_customers:
+                    counts['pending'] += 1
+                    continue
+
+                status = StripeEvent._process(event, max_attempts)
+                counts[status] += 1
+
+                if status == 'pending':
+                    blocked_customers.add(event.customer_id)
+        finally:
+            if lock is not None:
+                lock.execute(text('SELECT pg_advisory_unlock(:id)'),
+                             id=StripeEvent.CONSUMER_LOCK_ID)
+                lock.close()
+
+        return counts
+
+    @classmethod
+    def _verify(cls, event, max_attempts):
+        """
+        Replace an unsigned event with the one stripe has a record of, along
+        with its customer and date.
+
+        :param event: Event to verify
+        :type event: StripeEvent instance
+        :param max_attempts: Give up on the event after this many attempts
+        :type max_attempts: int
+        :return: None
+        """
+        try:
+            safe_event = PaymentEvent.retrieve(event.event_id)
+        except Exception as e:
+            StripeEvent._record_error(event, e, max_attempts)
+            return None
+
+        for field, value in StripeEvent.ordering_fields(safe_event).items():
+            setattr(event, field, value)
+        event.payload = json.dumps(safe_event)
+        event.verified = True
+        db.session.add(event)
+        db.session.commit()
+
+        return None
+
+    @classmethod
+    def _process(cls, event, max_attempts):
+        """
+        Apply a single verified event, recording the outcome.
+
+        :param event: Event to process
+        :type event: StripeEvent instance
+        :param max_attempts: Give up on the event after this many attempts
+        :type max_attempts: int
+        :return: str, the event's new status
+        """
+        safe_event = json.loads(event.payload)
+
+        if not StripeEvent.is_applicable(safe_event):
+            event.status = 'ignored'
+            db.session.add(event)
+            db.session.commit()
+            return event.status
+
+        try:
+            # The invoice is committed along with the event's status
+            event.attempts += 1
+            event.status = 'processed'
+            event.error = None
+            db.session.add(event)
+            StripeEvent.apply(safe_event)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            StripeEvent._record_error(event, e, max_attempts)
+
+        return event.status
+
+    @classmethod
+    def _record_error(cls, event, error, max_attempts):
+        """
+        Count a failed attempt, the event is tried again on the next run if
+        the error is worth retrying.
+
+        :param event: Event that failed
+        :type event: StripeEvent instance
+        :param error: Error raised by the attempt
+        :type error: Exception
+        :param max_attempts: Give up on the event after this many attempts
+        :type max_attempts: int
+        :return: None
+        """
+        attempts = event.attempts + 1
+        retry = isinstance(error, StripeEvent.TRANSIENT_ERRORS) and \
+            attempts < max_attempts
+
+        event.attempts = attempts
+        event.status = 'pending' if retry else 'failed'
+        event.error = str(error)
+        db.session.add(event)
+        db.session.commit()
+
+        return None
@@ -2,10 +2,10 @@ import datetime
 
 import pytz
 
-from config import settings
 from lib.util_sqlalchemy import ResourceMixin
-from vidme.extensions import db
+from vidme.extensions import db, identity_cache, plan_registry
 from vidme.blueprints.billing.models.credit_card import CreditCard
+from vidme.blueprints.billing.models.invoice import Invoice
 from vidme.blueprints.billing.gateways.stripecom import Card as PaymentCard
 from vidme.blueprints.billing.gateways.stripecom import \
     Subscription as PaymentSubscription
@@ -23,24 +23,51 @@ class Subscription(ResourceMixin, db.Model):
 
     # Subscription details
     plan = db.Column(db.String(128))
+    # Stripe's subscription and subscription item ids, so the subscription can
+    # be updated without looking it up through the customer first
+    payment_id = db.Column(db.String(128), index=True)
+    payment_item_id = db.Column(db.String(128))
 
     def __init__(self, **kwargs):
         # Call flask sql alchemy constructor
         super(Subscription, self).__init__(**kwargs)
 
+    def cache_keys(self):
+        """
+        Subscriptions are part of their owner's identity cache snapshot.
+
+        :return: list
+        """
+        # "subscription" is the backref to the User who owns this subscription
+        user = self.subscription
+
+        return [user.username] if user else []
+
+    @classmethod
+    def extract_subscription_params(cls, subscription):
+        """
+        Extract the subscription and subscription item ids from a payment
+        subscription object.
+
+        :param subscription: Payment subscription from stripe
+        :type subscription: Payment subscription
+        :return: dict
+        """
+        items = subscription['items']['data']
+
+        return {
+            'payment_id': subscription['id'],
+            'payment_item_id': items[0]['id'] if items else None
+        }
+
     @classmethod
     def get_all_plans(cls):
         """
-        Return a dict of all stripe plans in config.settings
+        Return a dict of all stripe plans in config.settings, by id
 
         :return: Dict
         """
-        stripe_plans = settings.STRIPE_PLANS
-        plans = {}
-        for key in stripe_plans:
-            plans[stripe_plans[key].get('id')] = stripe_plans[key]
-
-        return plans
+        return plan_registry.plans
 
     @classmethod
     def get_plan(cls, plan):
@@ -51,11 +78,7 @@ class Subscription(ResourceMixin, db.Model):
         :type plan: str
         :return: Dict or None
         """
-        for key, value in settings.STRIPE_PLANS.items():
-            if value.get('id') == plan:
-                return settings.STRIPE_PLANS[key]
-
-        return None
+        return plan_registry.get(plan)
 
     def cancel(self, user=None, discard_credit_card=True):
         """Delete a user's subscription and stop any future billing.
@@ -67,10 +90,17 @@ class Subscription(ResourceMixin, db.Model):
 
         :return: bool
         """
-        PaymentSubscription.cancel(customer_id=user.payment_id)
+        username = user.username
+        customer_id = user.payment_id
+        subscription_id = user.subscription.payment_id \
+            if user.subscription else None
+
+        PaymentSubscription.cancel(customer_id=customer_id,
+                                   subscription_id=subscription_id)
         # update the user model's billing info
         user.payment_id = None
         user.cancelled_subscription_on = datetime.datetime.now(pytz.utc)
+        user.bump_auth_version()
         db.session.add(user)
         # delete the related subscription model
         db.session.delete(user.subscription)
@@ -79,6 +109,8 @@ class Subscription(ResourceMixin, db.Model):
             db.session.delete(user.credit_card)
 
         db.session.commit()
+        identity_cache.delete(username)
+        Invoice.invalidate_upcoming(customer_id)
 
         return True
 
@@ -94,12 +126,21 @@ class Subscription(ResourceMixin, db.Model):
 
         :return: bool
         """
+        username = user.username
+
         # update the users sub plan on Stripe
-        PaymentSubscription.update(customer_id=user.payment_id, plan=plan)
+        PaymentSubscription.update(
+            customer_id=user.payment_id, plan=plan,
+            subscription_id=user.subscription.payment_id,
+            item_id=user.subscription.payment_item_id)
         # update the user's sub plan in our DB
         user.subscription.plan = plan
+        user.bump_auth_version()
+        db.session.add(user)
         db.session.add(user.subscription)
         db.session.commit()
+        identity_cache.delete(username)
+        Invoice.invalidate_upcoming(user.payment_id)
 
         return True
 
@@ -121,6 +162,8 @@ class Subscription(ResourceMixin, db.Model):
         if token is None:
             return False
 
+        username = user.username
+
         # use the stripe gateway to create a new subscription
         customer = PaymentSubscription.create(token=token,
                                               email=user.email,
@@ -130,10 +173,16 @@ class Subscription(ResourceMixin, db.Model):
         user.payment_id = customer.id
         user.name = name
         user.cancelled_subscription_on = None
+        user.bump_auth_version()
 
         self.user_id = user.id
         self.plan = plan
 
+        if customer.subscriptions.data:
+            for key, value in Subscription.extract_subscription_params(
+                    customer.subscriptions.data[0]).items():
+                setattr(self, key, value)
+
         # create the credit card model
         credit_card = CreditCard(user_id=user.id,
                                  **CreditCard.extract_card_params(customer))
@@ -143,6 +192,7 @@ class Subscription(ResourceMixin, db.Model):
         db.session.add(credit_card)
         db.session.add(self)
         db.session.commit()
+        identity_cache.delete(username)
 
         return True
 
@@ -164,6 +214,8 @@ class Subscription(ResourceMixin, db.Model):
         if token is None:
             return False
 
+        username = user.username
+
         # update the payment info on stripes API
         customer = PaymentCard.update(user.payment_id, token)
 
@@ -179,5 +231,6 @@ class Subscription(ResourceMixin, db.Model):
         db.session.add(user)
         db.session.add(credit_card)
         db.session.commit()
+        identity_cache.delete(username)
 
         return True
@@ -1,5 +1,6 @@
 from marshmallow import fields, validate
 
+from lib.compiled_schema import CompiledSchema
 from vidme.extensions import marshmallow
 
 
@@ -41,4 +42,4 @@ class InvoiceSchema(marshmallow.Schema):
 create_edit_subscription_schema = CreateEditSubscriptionSchema()
 credit_card_schema = CreditCardSchema()
 subscription_schema = SubscriptionSchema()
-invoices_schema = InvoiceSchema(many=True)
+invoices_schema = CompiledSchema(InvoiceSchema(many=True))
@@ -1,5 +1,7 @@
 from vidme.app import create_celery_app
 from vidme.blueprints.billing.models.credit_card import CreditCard
+from vidme.blueprints.billing.models.invoice import Invoice
+from vidme.blueprints.billing.models.stripe_event import StripeEvent
 
 celery = create_celery_app()
 
@@ -14,3 +16,32 @@ def mark_old_credit_cards():
     :return: Result of updating the records
     """
     return CreditCard.mark_old_credit_cards()
+
+
+@celery.task()
+def refresh_upcoming_invoice(customer_id):
+    """
+    Refresh the cached upcoming invoice of a customer.
+
+    :param customer_id: Customer's stripe ID
+    :type customer_id: str
+    :return: None
+    """
+    Invoice.refresh_upcoming(customer_id)
+
+    return None
+
+
+@celery.task()
+def process_stripe_events():
+    """
+    Apply webhook events received from stripe. This task is queued by the
+    webhook and also runs every STRIPE_WEBHOOK_INTERVAL seconds to pick up
+    events which are waiting to be retried. See config.settings
+    CELERYBEAT_SCHEDULE
+
+    :return: dict
+    """
+    return StripeEvent.process_pending(
+        batch_size=celery.conf.get('STRIPE_WEBHOOK_BATCH_SIZE', 100),
+        max_attempts=celery.conf.get('STRIPE_WEBHOOK_MAX_ATTEMPTS', 10))
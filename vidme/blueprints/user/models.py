@@ -3,15 +3,33 @@ from collections import OrderedDict
 
 import pytz
 from flask import current_app
-from werkzeug.security import generate_password_hash, check_password_hash
-from sqlalchemy import or_, text
+from sqlalchemy import (
+    DDL,
+    bindparam,
+    case,
+    event,
+    func,
+    inspect,
+    or_,
+    text
+)
+from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
 from itsdangerous import TimedJSONWebSignatureSerializer
 
+from lib.util_search import NgramIndex
 from lib.util_sqlalchemy import ResourceMixin, AwareDateTime
 from vidme.blueprints.billing.models.credit_card import CreditCard
 from vidme.blueprints.billing.models.subscription import Subscription
 from vidme.blueprints.billing.models.invoice import Invoice
-from vidme.extensions import db
+from vidme.blueprints.billing.gateways.stripecom import \
+    Subscription as PaymentSubscription
+from vidme.extensions import (
+    db,
+    identity_cache,
+    password_hasher,
+    activity_buffer
+)
 
 
 class User(ResourceMixin, db.Model):
@@ -21,6 +39,15 @@ class User(ResourceMixin, db.Model):
     ])
 
     __tablename__ = 'users'
+    __table_args__ = (
+        # Trigram indexes let Postgres serve ILIKE '%q%' searches (see
+        # User.search) without scanning the whole table
+        db.Index('ix_users_email_trgm', 'email', postgresql_using='gin',
+                 postgresql_ops={'email': 'gin_trgm_ops'}),
+        db.Index('ix_users_username_trgm', 'username',
+                 postgresql_using='gin',
+                 postgresql_ops={'username': 'gin_trgm_ops'}),
+    )
     id = db.Column(db.Integer, primary_key=True)
 
     # relationships
@@ -33,6 +60,12 @@ class User(ResourceMixin, db.Model):
     invoices = db.relationship(Invoice, backref='invoices',
                                passive_deletes=True)
 
+    EAGER_LOADS = {
+        'credit_card': joinedload,
+        'subscription': joinedload,
+        'invoices': selectinload
+    }
+
     # Auth
     role = db.Column(db.Enum(*ROLE, name='role_types', native_enum=False),
                      index=True, nullable=False, server_default='member')
@@ -42,6 +75,10 @@ class User(ResourceMixin, db.Model):
     password = db.Column(db.String(128), nullable=False, server_default='')
     active = db.Column('is_active', db.Boolean(), nullable=False,
                        server_default='0')
+    # Bumped whenever the role or subscription changes so that claims in
+    # previously issued access tokens can be detected as out of date
+    auth_version = db.Column(db.Integer, nullable=False, default=0,
+                             server_default='0')
 
     # Billing
     name = db.Column(db.String(255), index=True)
@@ -62,22 +99,84 @@ class User(ResourceMixin, db.Model):
         self.password = User.encrypt_password(kwargs.get('password', ''))
 
     @classmethod
-    def find_by_identity(cls, identity):
+    def find_by_identity(cls, identity, load=()):
         """
         Find a user by their e-mail or username.
 
         :param identity: Email or username
         :type identity" str
 
+        :param load: Relationships to eager load, see EAGER_LOADS
+        :type load: tuple
+
         :return: User instance
         """
-        return User.query.filter(
+        return User.query.options(*User.load_options(load)).filter(
             (User.email == identity) | (User.username == identity)).first()
 
+    @classmethod
+    def find_by_jwt_identity(cls, identity):
+        """
+        Find the user behind a JWT identity (their username) along with their
+        subscription and credit card. A snapshot is kept in the identity cache
+        so most protected endpoints never hit the database to load the user.
+
+        :param identity: Username
+        :type identity: str
+
+        :return: User instance
+        """
+        snapshot = identity_cache.get(identity)
+
+        if snapshot is not None:
+            return User.from_identity_snapshot(snapshot)
+
+        # Read before the query, a save committed in between changes it and
+        # the snapshot below isn't cached
+        version = identity_cache.version(identity)
+
+        user = User.query \
+            .options(*User.load_options(('subscription', 'credit_card'))) \
+            .filter(User.username == identity).first()
+
+        if user:
+            identity_cache.set(identity, user.to_identity_snapshot(),
+                               version=version)
+
+        return user
+
+    @classmethod
+    def from_identity_snapshot(cls, snapshot):
+        """
+        Re-create a user (and their subscription and credit card) from an
+        identity cache snapshot and attach it to the current session without
+        running any queries.
+
+        :param snapshot: Snapshot from to_identity_snapshot()
+        :type snapshot: dict
+
+        :return: User instance
+        """
+        user = User.from_snapshot(snapshot['user'])
+
+        subscription = snapshot['subscription']
+        if subscription is not None:
+            subscription = Subscription.from_snapshot(subscription)
+        set_committed_value(user, 'subscription', subscription)
+
+        credit_card = snapshot['credit_card']
+        if credit_card is not None:
+            credit_card = CreditCard.from_snapshot(credit_card)
+        set_committed_value(user, 'credit_card', credit_card)
+
+        return db.session.merge(user, load=False)
+
     @classmethod
     def encrypt_password(cls, plaintext_password):
         """
-        Hash a plaintext string using PBKDF2.
+        Hash a plaintext string using PASSWORD_HASH_METHOD (PBKDF2 by
+        default). Raises lib.password_hasher.PasswordHasherBusy if too many
+        passwords are being hashed.
 
         :param plaintext_password: Password in plain text
         :type plaintext_password: str
@@ -85,7 +184,7 @@ class User(ResourceMixin, db.Model):
         :return: str
         """
         if plaintext_password:
-            return generate_password_hash(plaintext_password)
+            return password_hasher.hash(plaintext_password)
 
         return None
 
@@ -119,13 +218,19 @@ class User(ResourceMixin, db.Model):
         """
         Search a resource by one or more fields.
 
+        On Postgres this is an ILIKE served by the trigram indexes, other
+        databases match against an in-memory n-gram index instead.
+
         :param query: Query to search by
         :type query: str
         :return: SQLAlchemy filter
         """
-        if query == '':
+        if not isinstance(query, str) or query == '':
             return text('')
 
+        if db.session.bind.dialect.name != 'postgresql':
+            return User.id.in_(User._search_index().search(query))
+
         search_query = '%{0}%'.format(query)  # %% partial words
         search_chain = (User.email.ilike(search_query),
                         User.username.ilike(search_query))
@@ -134,33 +239,111 @@ class User(ResourceMixin, db.Model):
         return or_(*search_chain)
 
     @classmethod
-    def bulk_delete(cls, ids):
+    def search_rank(cls, query):
         """
-        Override the bulk_deleted method on ResourceMixin because users need
-        to be deleted one at a time while also being deleted on stripe.
+        Order search results by how similar the email or username is to the
+        query, best matches first.
 
-        :param ids: List of ids to be deleted
-        :types ids: list
-        :return: int
+        :param query: Query to search by
+        :type query: str
+        :return: SQLAlchemy order by clause
         """
-        delete_count = 0
+        if db.session.bind.dialect.name != 'postgresql':
+            ids = User._search_index().search(query)
+            if not ids:
+                return User.id.asc()
 
-        for id in ids:
-            user = User.query.get(id)
+            return case({id: rank for rank, id in enumerate(ids)},
+                        value=User.id).asc()
 
-            if user is None:
-                continue
-            # see if user is currently subbed
-            if user.payment_id is None:
-                user.delete()
-            else:
-                subscription = Subscription()
-                cancelled = subscription.cancel(user=user)
-                # if cancelled sub on stripe successfully, delete locally
-                if cancelled:
-                    user.delete()
+        return func.greatest(func.similarity(User.email, query),
+                             func.similarity(User.username, query)).desc()
+
+    @classmethod
+    def _search_index(cls):
+        """
+        Return the in-memory search index, rebuilding it if users were added,
+        changed or removed since it was last built.
+
+        :return: NgramIndex
+        """
+        version = db.session.query(func.count(User.id),
+                                   func.max(User.updated_on)).one()
+
+        if _user_search_index.version != version:
+            users = db.session.query(User.id, User.email, User.username)
+            _user_search_index.build(((id, (email, username))
+                                      for id, email, username in users),
+                                     version=version)
+
+        return _user_search_index
 
-            delete_count += 1
+    @classmethod
+    def bulk_delete(cls, ids, progress=None):
+        """
+        Override the bulk_deleted method on ResourceMixin because subscribed
+        users need to have their subscription cancelled on stripe first.
+
+        Users are deleted in batches of USER_DELETE_BATCH_SIZE. The
+        subscriptions of a batch are cancelled concurrently and then every
+        user whose cancellation didn't fail is deleted in a single
+        transaction, users who failed are left alone so they can be retried.
+
+        :param ids: List of ids or a scope from bulk_action_scope()
+        :types ids: list or dict
+        :param progress: Called after each batch with the number of users
+                         deleted so far, ids that failed so far and the total
+        :type progress: Function
+        :return: int
+        """
+        config = current_app.config
+        batch_size = config.get('USER_DELETE_BATCH_SIZE', 500)
+
+        if not isinstance(ids, dict):
+            ids = User.bulk_action_scope('', ids)
+
+        total = User.count_bulk_action_ids(ids)
+        delete_count = 0
+        failed_ids = []
+
+        for batch_ids in User.iter_bulk_action_ids(ids, batch_size):
+            batch = db.session.query(
+                User.id, User.username, User.payment_id,
+                Subscription.payment_id.label('subscription_id')) \
+                .outerjoin(Subscription, Subscription.user_id == User.id) \
+                .filter(User.id.in_(batch_ids)).all()
+
+            subscribed = {user.payment_id: user.id for user in batch
+                          if user.payment_id}
+            errors = PaymentSubscription.cancel_many(
+                list(subscribed),
+                subscription_ids={user.payment_id: user.subscription_id
+                                  for user in batch if user.subscription_id},
+                workers=config.get('USER_DELETE_STRIPE_WORKERS', 8),
+                retries=config.get('USER_DELETE_STRIPE_RETRIES', 1))
+            batch_failed_ids = {subscribed[payment_id]
+                                for payment_id in errors}
+
+            deleted = [user for user in batch
+                       if user.id not in batch_failed_ids]
+            if deleted:
+                deleted_ids = [user.id for user in deleted]
+
+                # Invoices are removed by the database's ON DELETE CASCADE
+                for model in (Subscription, CreditCard):
+                    model.query.filter(model.user_id.in_(deleted_ids)) \
+                        .delete(synchronize_session=False)
+                User.query.filter(User.id.in_(deleted_ids)) \
+                    .delete(synchronize_session=False)
+                db.session.commit()
+
+                identity_cache.delete(*[user.username for user in deleted])
+
+            delete_count += len(deleted)
+            failed_ids.extend(sorted(batch_failed_ids))
+
+            if progress:
+                progress(delete_count, failed_ids, total)
 
         return delete_count
 
@@ -215,9 +398,97 @@ class User(ResourceMixin, db.Model):
         serializer = TimedJSONWebSignatureSerializer(private_key, expiration)
         return serializer.dumps({'user_email': self.email}).decode('utf-8')
 
+    def to_snapshot(self):
+        """
+        Dump the column values of a user, except for their password hash
+        which never ends up in a cache. It's loaded from the database if a
+        user from a snapshot needs it.
+
+        :return: dict
+        """
+        snapshot = super(User, self).to_snapshot()
+        del snapshot['password']
+
+        return snapshot
+
+    def to_identity_snapshot(self):
+        """
+        Dump the user, their subscription and their credit card so they can
+        be stored in the identity cache.
+
+        :return: dict
+        """
+        subscription = self.subscription
+        credit_card = self.credit_card
+
+        return {
+            'user': self.to_snapshot(),
+            'subscription': subscription.to_snapshot() if subscription
+            else None,
+            'credit_card': credit_card.to_snapshot() if credit_card else None
+        }
+
+    def jwt_claims(self):
+        """
+        Claims to add to this user's access tokens. With
+        JWT_CLAIMS_AUTHORIZATION enabled the subscription state and auth
+        version are included so the decorators in lib.decorators can
+        authorize requests without loading the user.
+
+        :return: dict
+        """
+        claims = {
+            'role': self.role
+        }
+
+        if current_app.config.get('JWT_CLAIMS_AUTHORIZATION'):
+            subscription = self.subscription
+
+            if subscription:
+                status = 'active'
+            elif self.cancelled_subscription_on:
+                status = 'cancelled'
+            else:
+                status = None
+
+            claims.update({
+                'plan': subscription.plan if subscription else None,
+                'subscription_status': status,
+                'version': self.auth_version
+            })
+
+        return claims
+
+    def bump_auth_version(self):
+        """
+        Mark the claims of every access token issued to this user so far as
+        out of date. Call it whenever their role or subscription changes.
+
+        :return: None
+        """
+        self.auth_version = (self.auth_version or 0) + 1
+
+        return None
+
+    def cache_keys(self):
+        """
+        The identity cache is keyed by username, evict the old one too in case
+        it's being changed.
+
+        :return: list
+        """
+        usernames = set(inspect(self).attrs.username.history.sum())
+        usernames.add(self.username)
+        usernames.discard(None)
+
+        return list(usernames)
+
     def authenticated(self, with_password=True, password=''):
         """
-        Ensure a user is authenticated, and optionally check their password
+        Ensure a user is authenticated, and optionally check their password.
+        Hashes made with an outdated method or cost are replaced. Raises
+        lib.password_hasher.PasswordHasherBusy if too many passwords are being
+        hashed.
 
         :param with_password: Optionally check user's password
         :type with_password: bool
@@ -228,7 +499,12 @@ class User(ResourceMixin, db.Model):
         :return: bool
         """
         if with_password:
-            return check_password_hash(self.password, password)
+            if not password_hasher.check(self.password, password):
+                return False
+
+            if password_hasher.needs_rehash(self.password):
+                self.password = User.encrypt_password(password)
+                self.save()
 
         return True
 
@@ -237,21 +513,143 @@ class User(ResourceMixin, db.Model):
         Update various fields on the user that's related to meta data on their
         account, such as sign_in_count and ip_address, etc...
 
+        The sign in is pushed onto the activity buffer and written later in
+        bulk by flush_activity_tracking, it's only saved right away if the
+        buffer is disabled or unavailable.
+
         :param ip_address: IP address
         :type ip_address: str
 
-        :return: SQLAlchemy commit results
+        :return: None
         """
+        signed_in_on = datetime.datetime.now(pytz.utc)
+
+        buffered = activity_buffer.push({
+            'user_id': self.id,
+            'ip_address': ip_address,
+            'signed_in_on': signed_in_on.isoformat()
+        })
+
+        if buffered:
+            return None
+
         self.sign_in_count += 1
 
         self.last_sign_in_on = self.current_sign_in_on
         self.last_sign_in_ip = self.current_sign_in_ip
 
-        self.current_sign_in_on = datetime.datetime.now(pytz.utc)
+        self.current_sign_in_on = signed_in_on
         self.current_sign_in_ip = ip_address
 
         return self.save()
 
+    @classmethod
+    def flush_activity_tracking(cls):
+        """
+        Drain the activity buffer and write it to the users table in batches.
+        A batch which fails to be written stays in the buffer.
+
+        :return: Number of sign ins written
+        """
+        activity_buffer.requeue_stale()
+        flushed = 0
+
+        while True:
+            with activity_buffer.drain() as sign_ins:
+                if not sign_ins:
+                    break
+
+                User.bulk_update_activity_tracking(sign_ins)
+
+            flushed += len(sign_ins)
+
+        return flushed
+
+    @classmethod
+    def bulk_update_activity_tracking(cls, sign_ins):
+        """
+        Apply a batch of sign ins with a single UPDATE. Several sign ins by
+        the same user are collapsed into one row, the same way calling
+        update_activity_tracking for each of them would have left it.
+
+        :param sign_ins: Sign ins from update_activity_tracking
+        :type sign_ins: list
+        :return: None
+        """
+        activity = OrderedDict()
+        sign_ins = sorted(sign_ins, key=lambda item: item['signed_in_on'])
+
+        for sign_in in sign_ins:
+            signed_in_on = datetime.datetime.fromisoformat(
+                sign_in['signed_in_on'])
+
+            row = activity.setdefault(sign_in['user_id'], {
+                'id': sign_in['user_id'],
+                'count': 0,
+                'current_on': None,
+                'current_ip': None,
+                'last_on': None,
+                'last_ip': None
+            })
+            row['count'] += 1
+            row['last_on'] = row['current_on']
+            row['last_ip'] = row['current_ip']
+            row['current_on'] = signed_in_on
+            row['current_ip'] = sign_in['ip_address']
+
+        rows = list(activity.values())
+
+        # When a user only signed in once their previous sign in is whatever
+        # is currently stored in the row
+        set_clause = """
+            sign_in_count = users.sign_in_count + {0}.count,
+            last_sign_in_on = CASE WHEN {0}.count > 1 THEN {0}.last_on
+                                   ELSE users.current_sign_in_on END,
+            last_sign_in_ip = CASE WHEN {0}.count > 1 THEN {0}.last_ip
+                                   ELSE users.current_sign_in_ip END,
+            current_sign_in_on = {0}.current_on,
+            current_sign_in_ip = {0}.current_ip
+        """
+
+        if db.session.bind.dialect.name == 'postgresql':
+            values = []
+            params = {}
+
+            for i, row in enumerate(rows):
+                values.append('(:id{0}, :count{0}, '
+                              'CAST(:current_on{0} AS timestamptz), '
+                              'CAST(:current_ip{0} AS varchar), '
+                              'CAST(:last_on{0} AS timestamptz), '
+                              'CAST(:last_ip{0} AS varchar))'.format(i))
+                params.update({'{0}{1}'.format(key, i): value
+                               for key, value in row.items()})
+
+            statement = text("""
+                UPDATE users SET {0}
+                FROM (VALUES {1}) AS activity (id, count, current_on,
+                                              current_ip, last_on, last_ip)
+                WHERE users.id = activity.id
+            """.format(set_clause.format('activity'), ', '.join(values)))
+
+            db.session.execute(statement, params)
+        else:
+            # Other databases (SQLite in tests) get a single executemany
+            statement = text("""
+                UPDATE users SET {0} WHERE users.id = :id
+            """.format(set_clause.replace('{0}.', ':'))).bindparams(
+                bindparam('current_on', type_=AwareDateTime()),
+                bindparam('last_on', type_=AwareDateTime()))
+
+            db.session.execute(statement, rows)
+
+        db.session.commit()
+
+        identity_cache.delete(*[username for username, in
+                                db.session.query(User.username).filter(
+                                    User.id.in_(activity.keys()))])
+
+        return None
+
     def is_active(self):
         """
         Return whether or not the user account is active
@@ -259,3 +657,12 @@ class User(ResourceMixin, db.Model):
         :return: bool
         """
         return self.active
+
+
+# Databases without pg_trgm search users with an in-memory index
+_user_search_index = NgramIndex()
+
+# The trigram indexes need the pg_trgm extension
+event.listen(User.__table__, 'before_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+             .execute_if(dialect='postgresql'))
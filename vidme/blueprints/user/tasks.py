@@ -28,3 +28,15 @@ def deliver_verification_email(user_id, activation_token):
                           template='mail/user/verify_email', ctx=ctx)
 
     return None
+
+
+@celery.task()
+def flush_activity_tracking():
+    """
+    Write buffered sign ins to the users table. This task is run every
+    ACTIVITY_BUFFER_FLUSH_INTERVAL seconds. See config.settings
+    CELERYBEAT_SCHEDULE
+
+    :return: Number of sign ins written
+    """
+    return User.flush_activity_tracking()
@@ -6,7 +6,23 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_marshmallow import Marshmallow
 from flask_mail import Mail
 
+from lib.counter_store import CounterStore
+from lib.password_hasher import PasswordHasher
+from lib.plan_registry import PlanRegistry
+from lib.request_metrics import RequestMetrics
+from lib.util_cache import TieredCache
+from lib.write_buffer import WriteBuffer
+
 jwt = JWTManager()
 db = SQLAlchemy()
 marshmallow = Marshmallow()
 mail = Mail()
+identity_cache = TieredCache('IDENTITY_CACHE', versioned=True)
+password_hasher = PasswordHasher()
+activity_buffer = WriteBuffer('ACTIVITY_BUFFER')
+dashboard_counters = CounterStore('DASHBOARD_COUNTERS')
+product_cache = TieredCache('STRIPE_PRODUCT_CACHE')
+upcoming_invoice_cache = TieredCache('UPCOMING_INVOICE_CACHE')
+webhook_replay_cache = TieredCache('STRIPE_WEBHOOK_REPLAY_CACHE')
+plan_registry = PlanRegistry()
+request_metrics = RequestMetrics()
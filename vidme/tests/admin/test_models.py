@@ -0,0 +1,48 @@
+import pytest
+
+from vidme.blueprints.admin.models import Dashboard
+from vidme.blueprints.user.models import User
+from vidme.extensions import dashboard_counters
+
+
+@pytest.fixture(scope='function')
+def counters():
+    """
+    Keep dashboard counters in-process for the duration of a test.
+
+    :return: CounterStore
+    """
+    enabled, client = dashboard_counters.enabled, dashboard_counters.client
+    dashboard_counters.enabled, dashboard_counters.client = True, None
+    dashboard_counters._groups = {}
+
+    yield dashboard_counters
+
+    dashboard_counters.enabled, dashboard_counters.client = enabled, client
+    dashboard_counters._groups = {}
+
+
+class TestDashboardCounters(object):
+    def test_counters_match_group_by(self, db, counters):
+        """Materialized counts match a group by on the users table"""
+        assert Dashboard.group_and_count_users()['total'] == User.query.count()
+        assert counters.get('users') is not None
+
+    def test_counters_follow_commits(self, db, counters):
+        """Counters change once a user is committed, not before"""
+        Dashboard.reconcile_counters()
+        before = counters.get('users')
+        members, admins = before.get('member', 0), before.get('admin', 0)
+
+        user = User(email='counted@local.host', username='counted1',
+                    password='password')
+        user.save()
+        assert counters.get('users')['member'] == members + 1
+
+        user.role = 'admin'
+        user.save()
+        assert counters.get('users')['member'] == members
+        assert counters.get('users')['admin'] == admins + 1
+
+        user.delete()
+        assert counters.get('users')['admin'] == admins
@@ -0,0 +1,90 @@
+import stripe
+
+from vidme.blueprints.admin.tasks import delete_users
+from vidme.blueprints.billing.gateways.stripecom import \
+    Subscription as PaymentSubscription
+from vidme.blueprints.billing.models.subscription import Subscription
+from vidme.blueprints.user.models import User
+
+# mock_stripe replaces cancel for the rest of the session, keep the real one
+cancel = PaymentSubscription.__dict__['cancel']
+
+
+class TestDeleteUsers(object):
+    def test_delete_users(self, subscriptions, mock_stripe):
+        """Subscribed users are cancelled on stripe and deleted"""
+        user = User.find_by_identity('firstSub1')
+        user_id = user.id
+
+        result = delete_users([user_id, 9999])
+
+        assert result == {'total': 2, 'deleted': 1, 'failed': []}
+        assert User.query.get(user_id) is None
+        assert Subscription.query.filter_by(user_id=user_id).count() == 0
+
+    def test_failed_cancellation_keeps_user(self, subscriptions, mock_stripe):
+        """Users whose subscription can't be cancelled are reported"""
+        user_id = User.find_by_identity('firstSub1').id
+
+        PaymentSubscription.cancel.side_effect = stripe.error.CardError(
+            'Declined', None, 'card_declined')
+        try:
+            result = delete_users([user_id])
+        finally:
+            PaymentSubscription.cancel.side_effect = None
+
+        assert result == {'total': 1, 'deleted': 0, 'failed': [user_id]}
+        assert User.query.get(user_id) is not None
+
+    def test_cancel_many_retries(self, mock_stripe):
+        """Connection errors are retried before giving up"""
+        PaymentSubscription.cancel.reset_mock()
+        PaymentSubscription.cancel.side_effect = [
+            stripe.error.APIConnectionError('Timed out'), {}]
+        try:
+            errors = PaymentSubscription.cancel_many(['cus_000'], backoff=0)
+        finally:
+            PaymentSubscription.cancel.side_effect = None
+
+        assert errors == {}
+        assert PaymentSubscription.cancel.call_count == 2
+
+    def test_cancel_many_gives_up(self, mock_stripe):
+        """A cancellation is only retried once on top of the HTTP client"""
+        PaymentSubscription.cancel.reset_mock()
+        PaymentSubscription.cancel.side_effect = \
+            stripe.error.APIConnectionError('Timed out')
+        try:
+            errors = PaymentSubscription.cancel_many(['cus_000'], backoff=0)
+        finally:
+            PaymentSubscription.cancel.side_effect = None
+
+        assert isinstance(errors['cus_000'], stripe.error.APIConnectionError)
+        assert PaymentSubscription.cancel.call_count == 2
+
+    def test_cancel_many_retried_delete_went_through(self, mock_stripe):
+        """A retry that finds the subscription already gone succeeds"""
+        PaymentSubscription.cancel.side_effect = [
+            stripe.error.APIConnectionError('Timed out'),
+            stripe.error.InvalidRequestError('No such subscription', None,
+                                             http_status=404)]
+        try:
+            errors = PaymentSubscription.cancel_many(['cus_000'], backoff=0)
+        finally:
+            PaymentSubscription.cancel.side_effect = None
+
+        assert errors == {}
+
+    def test_cancel_many_by_customer(self, fake_stripe, monkeypatch):
+        """A customer without a subscription is cancelled on a retry only"""
+        monkeypatch.setattr(PaymentSubscription, 'cancel', cancel)
+        stripe.max_network_retries = 0
+        retried = fake_stripe.add_customer()['id']
+        unsubscribed = fake_stripe.add_customer()['id']
+
+        fake_stripe.fail(1, status=500)
+        errors = PaymentSubscription.cancel_many([retried], backoff=0)
+        assert errors == {}
+
+        errors = PaymentSubscription.cancel_many([unsubscribed], backoff=0)
+        assert errors[unsubscribed].http_status == 404
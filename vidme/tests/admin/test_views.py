@@ -1,10 +1,26 @@
+import base64
+import csv
 import datetime
+import io
+import json
+import logging
 
+import pytest
 import pytz
 from flask import url_for
 
-from lib.tests import ViewTestMixin
+from lib.compiled_schema import CompiledSchema
+from lib.tests import ViewTestMixin, assert_max_queries
+from vidme.blueprints.admin.schemas import (
+    UserSchema,
+    user_detail_schema,
+    users_schema
+)
+from vidme.blueprints.billing.models.credit_card import CreditCard
+from vidme.blueprints.billing.models.invoice import Invoice
+from vidme.blueprints.billing.schemas import invoices_schema
 from vidme.blueprints.user.models import User
+from vidme.extensions import request_metrics
 
 
 class TestDashboardView(ViewTestMixin):
@@ -31,6 +47,30 @@ class TestDashboardView(ViewTestMixin):
         assert users_group['query'][1][1] == 'member'
         assert users_group['total'] == 2
 
+    def test_no_cache_policy(self, subscriptions, mock_stripe):
+        """A view's cache policy doesn't carry over to the next request"""
+        self.authenticate()
+        response = self.client.get(url_for('AdminView:get_user',
+                                           username='firstSub1'))
+        assert 'ETag' in response.headers
+
+        response = self.client.get(url_for('AdminView:index'))
+        assert 'ETag' not in response.headers
+
+
+class TestClaimsAuthorization(ViewTestMixin):
+    def test_out_of_date_claims(self, subscriptions):
+        """Claims are re-checked against the DB once the version changes"""
+        self.authenticate(identity='firstSub1')
+
+        user = User.find_by_identity('firstSub1')
+        user.role = 'admin'
+        user.bump_auth_version()
+        user.save()
+
+        response = self.client.get(url_for('AdminView:index'))
+        assert response.status_code == 200
+
 
 class TestCancelSubscription(ViewTestMixin):
     def test_user_not_found(self):
@@ -194,6 +234,20 @@ class TestGetUser(ViewTestMixin):
         assert upcoming_invoice['description'] == 'GOLD MONTHLY'
         assert upcoming_invoice['plan'] == 'Gold'
 
+    def test_get_user_queries(self, subscriptions, invoices):
+        """
+        The user's credit card and subscription are loaded along with the
+        user, so the detail view runs a fixed number of queries: the admin,
+        the user and a page of invoices
+        """
+        self.authenticate()
+        with assert_max_queries(3):
+            response = self.client.get(url_for('AdminView:get_user',
+                                               username='firstSub1'))
+
+        assert response.status_code == 200
+        assert response.get_json()['data']['user']['credit_card'] is not None
+
     def test_get_user_no_subscription(self, invoices):
         """
         Return the user's data including invoices(billing) data, even if
@@ -224,6 +278,42 @@ class TestGetUser(ViewTestMixin):
         assert 'current_sign_in_on' in user
 
 
+class TestRequestMetrics(ViewTestMixin):
+    def test_server_timing(self, subscriptions):
+        """Responses say how many queries were run for them"""
+        self.authenticate()
+        with assert_max_queries(3):
+            response = self.client.get(url_for('AdminView:get_user',
+                                               username='firstSub1'))
+
+        server_timing = response.headers['Server-Timing']
+        assert 'sql;desc="3 queries"' in server_timing
+        assert 'stripe;desc="0 calls"' in server_timing
+        assert 'app;dur=' in server_timing
+
+    def test_log(self, monkeypatch, caplog):
+        """The metrics can be logged along with the endpoint"""
+        monkeypatch.setattr(request_metrics, 'log', True)
+        self.authenticate()
+
+        with caplog.at_level(logging.INFO):
+            self.client.get(url_for('AdminView:users'))
+
+        fields = caplog.records[-1].request_metrics
+        assert fields['endpoint'] == 'AdminView:users'
+        assert fields['status'] == 200
+        assert fields['sql_queries'] > 0
+
+    def test_unfinished_request(self, app):
+        """A request that never finished doesn't count later queries"""
+        with app.test_request_context():
+            app.preprocess_request()
+
+        User.query.count()
+
+        assert request_metrics.current() is None
+
+
 class TestGetUsers(ViewTestMixin):
     def test_get_users(self):
         """Return a list of users in the DB"""
@@ -260,6 +350,145 @@ class TestGetUsers(ViewTestMixin):
         assert data['next_num'] is None
         assert data['prev_num'] is None
 
+    def test_search_relevance(self, users):
+        """AdminView:users can sort search results by relevance"""
+        self.authenticate()
+        args = {'q': 'member', 'sort': 'relevance'}
+        response = self.client.get(url_for('AdminView:users'),
+                                   query_string=args)
+        users = response.get_json()['data']['users']
+
+        assert response.status_code == 200
+        assert [user['username'] for user in users] == ['userMember']
+
+    def test_cursor_pagination(self, users):
+        """AdminView:users can walk every user with cursors, both ways"""
+        self.authenticate()
+        args = {'pagination': 'cursor', 'page_size': 1, 'sort': 'email',
+                'direction': 'asc', 'count': 'exact'}
+
+        usernames = []
+        pages = []
+        while True:
+            response = self.client.get(url_for('AdminView:users'),
+                                       query_string=args)
+            data = response.get_json()['data']
+            assert response.status_code == 200
+            assert data['total'] == User.query.count()
+
+            usernames.append(data['users'][0]['username'])
+            pages.append(data)
+            if not data['has_next']:
+                break
+            args['cursor'] = data['next_cursor']
+
+        assert len(usernames) == len(set(usernames)) == User.query.count()
+
+        args['cursor'] = pages[-1]['prev_cursor']
+        response = self.client.get(url_for('AdminView:users'),
+                                   query_string=args)
+        data = response.get_json()['data']
+        assert data['users'][0]['username'] == usernames[-2]
+
+    def test_invalid_cursor(self):
+        """Return a 400 for a cursor that has been tampered with"""
+        self.authenticate()
+        args = {'cursor': 'notACursor'}
+        response = self.client.get(url_for('AdminView:users'),
+                                   query_string=args)
+        assert response.status_code == 400
+        assert response.get_json()['error'] == 'Invalid cursor.'
+
+    def test_tampered_cursor_values(self):
+        """Cursors with values of the wrong shape or type are a 400 too"""
+        self.authenticate()
+        payloads = [
+            {'v': 5, 'd': 'next'},
+            {'v': ['member', 'cus_000', [1, 2], 1], 'd': 'next'},
+            {'v': ['member', 'cus_000', 'not a date', 1], 'd': 'next'},
+            {'v': ['member', 'cus_000', None, 'one'], 'd': 'next'},
+            ['member', 'next']
+        ]
+
+        for payload in payloads:
+            cursor = base64.urlsafe_b64encode(
+                json.dumps(payload).encode('utf-8')).decode('utf-8')
+            response = self.client.get(url_for('AdminView:users'),
+                                       query_string={'cursor': cursor})
+
+            assert response.status_code == 400
+            assert response.get_json()['error'] == 'Invalid cursor.'
+
+    def test_invalid_page_size(self):
+        """A page needs at least 1 user"""
+        self.authenticate()
+        for args in ({'page_size': 0}, {'page_size': -1,
+                                        'pagination': 'cursor'}):
+            response = self.client.get(url_for('AdminView:users'),
+                                       query_string=args)
+            assert response.status_code == 400
+
+
+class TestExport(ViewTestMixin):
+    def test_export_users(self, subscriptions):
+        """Every user is streamed as NDJSON, with subscriptions and cards"""
+        self.authenticate()
+        response = self.client.get(url_for('AdminView:export_users'))
+        rows = [json.loads(line) for line in response.data.splitlines()]
+        subscribers = [row for row in rows if row['username'] == 'firstSub1']
+
+        assert response.status_code == 200
+        assert response.mimetype == 'application/x-ndjson'
+        assert len(rows) == User.query.count()
+        assert subscribers[0]['plan'] == 'gold'
+        assert subscribers[0]['last4'] == '4242'
+        assert 'password' not in rows[0]
+
+    def test_export_users_csv(self, users):
+        """Users can be exported as CSV, filtered like AdminView:users"""
+        self.authenticate()
+        args = {'format': 'csv', 'q': 'member', 'sort': 'relevance'}
+        response = self.client.get(url_for('AdminView:export_users'),
+                                   query_string=args)
+        rows = list(csv.DictReader(io.StringIO(response.data.decode())))
+
+        assert response.status_code == 200
+        assert response.mimetype == 'text/csv'
+        assert 'users.csv' in response.headers['Content-Disposition']
+        assert [row['username'] for row in rows] == ['userMember']
+        assert rows[0]['plan'] == ''
+
+    def test_export_no_results_csv(self):
+        """The CSV header is sent even without any rows"""
+        self.authenticate()
+        args = {'format': 'csv', 'q': 'noResultsUsername'}
+        response = self.client.get(url_for('AdminView:export_users'),
+                                   query_string=args)
+
+        assert response.data.decode().splitlines()[0].startswith('id,')
+        assert len(response.data.decode().splitlines()) == 1
+
+    def test_export_invoices(self, invoices):
+        """Invoices are streamed newest first, with their user"""
+        self.authenticate()
+        response = self.client.get(url_for('AdminView:export_invoices'))
+        rows = [json.loads(line) for line in response.data.splitlines()]
+
+        assert response.status_code == 200
+        assert [row['receipt_number'] for row in rows] == ['0010000',
+                                                           '0009000']
+        assert rows[0]['username'] == 'testAdmin1'
+        assert rows[0]['period_end_on'] == '2019-06-15'
+
+    def test_invalid_format(self):
+        """Return a 400 for a format which isn't supported"""
+        self.authenticate()
+        args = {'format': 'xml'}
+        response = self.client.get(url_for('AdminView:export_invoices'),
+                                   query_string=args)
+
+        assert response.status_code == 400
+
 
 class TestBulkDeleteUsers(ViewTestMixin):
     def test_invalid_data(self):
@@ -302,3 +531,59 @@ class TestBulkDeleteUsers(ViewTestMixin):
                                         ' deleted.')
         new_count = User.query.count()
         assert old_count == new_count
+
+
+class TestCompiledSchema(object):
+    now = datetime.datetime(2019, 6, 1, 12, 30, tzinfo=pytz.utc)
+
+    def test_users_same_as_marshmallow(self):
+        """Compiled dumps match the schema's own, None included"""
+        users = [User(id=1, username='one', email='one@local.host',
+                      role='admin', sign_in_count=3, created_on=self.now,
+                      last_sign_in_on=self.now, payment_id='cus_000001'),
+                 User(id=2, email='two@local.host', role='member')]
+
+        assert users_schema.dump(users) == users_schema.schema.dump(users)
+
+    def test_user_detail_same_as_marshmallow(self):
+        """Nested schemas are dumped inline, or as None"""
+        card = CreditCard(id=1, brand='Visa', last4='4242',
+                          exp_date=datetime.date(2021, 6, 1))
+        user = User(email='one@local.host', role='member',
+                    created_on=self.now, updated_on=self.now,
+                    current_sign_in_ip='127.0.0.1', credit_card=card)
+
+        dumped = user_detail_schema.dump(user)
+        assert dumped == user_detail_schema.schema.dump(user)
+        assert dumped['credit_card']['last4'] == '4242'
+        assert dumped['subscription'] is None
+
+    def test_invoices_same_as_marshmallow(self):
+        """Dates and datetimes are dumped as ISO 8601"""
+        invoices = [Invoice(id=1, created_on=self.now, plan='Gold',
+                            period_start_on=datetime.date(2019, 5, 1),
+                            total=999, last4='4242')]
+
+        dumped = invoices_schema.dump(invoices)
+        assert dumped == invoices_schema.schema.dump(invoices)
+        assert dumped[0]['created_on'] == '2019-06-01T12:30:00+00:00'
+        assert dumped[0]['period_start_on'] == '2019-05-01'
+
+    def test_many_override(self):
+        """A schema with many=True can still dump 1 object"""
+        user = User(id=1, email='one@local.host')
+
+        assert users_schema.dump(user, many=False) == \
+            UserSchema().dump(user)
+
+    def test_dump_hooks_not_compiled(self):
+        """Schemas with dump hooks are left to marshmallow"""
+        from marshmallow import post_dump
+
+        class HookSchema(UserSchema):
+            @post_dump
+            def strip(self, data, **kwargs):
+                return data
+
+        with pytest.raises(ValueError):
+            CompiledSchema(HookSchema())
@@ -1,6 +1,10 @@
 from flask import url_for
+from flask_jwt_extended import decode_token
+from werkzeug.security import generate_password_hash
 
 from lib.tests import ViewTestMixin, assert_status_with_message
+from vidme.blueprints.user.models import User
+from vidme.extensions import password_hasher
 
 
 class TestAuthenticate(ViewTestMixin):
@@ -67,3 +71,35 @@ class TestAuthenticate(ViewTestMixin):
 
         assert response.status_code == 200
         assert 'access_token' in json_data
+
+    def test_access_token_claims(self, subscriptions):
+        """Subscription state and auth version are added to the claims"""
+        data = {
+            'identity': 'firstSub1',
+            'password': 'password'
+        }
+        response = self.client.post(url_for('AuthView:post'), json=data)
+        token = response.get_json()['data']['access_token']
+        claims = decode_token(token)['user_claims']
+
+        assert claims['role'] == 'member'
+        assert claims['plan'] == 'gold'
+        assert claims['subscription_status'] == 'active'
+        assert claims['version'] == 0
+
+    def test_rehash_legacy_password(self):
+        """A password hashed with an old method is re-hashed on login"""
+        user = User.find_by_identity('testAdmin1')
+        user.password = generate_password_hash('password', 'pbkdf2:sha1:1000')
+        user.save()
+
+        data = {
+            'identity': 'testAdmin1',
+            'password': 'password'
+        }
+        response = self.client.post(url_for('AuthView:post'), json=data)
+        assert response.status_code == 200
+
+        user = User.find_by_identity('testAdmin1')
+        assert not password_hasher.needs_rehash(user.password)
+        assert user.authenticated(password='password')
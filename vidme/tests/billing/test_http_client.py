@@ -0,0 +1,111 @@
+import pytest
+import stripe
+
+from vidme.blueprints.billing.gateways.http_client import (
+    CircuitBreaker,
+    CircuitOpenError
+)
+from vidme.extensions import request_metrics
+
+
+class TestStripeHTTPClient(object):
+    def test_retry_server_errors(self, fake_stripe):
+        """Reads are retried after a server error"""
+        customer = fake_stripe.add_customer(plan='gold')
+        fake_stripe.fail(1, status=500)
+
+        subscriptions = stripe.Subscription.list(customer=customer['id'])
+
+        assert len(subscriptions.data) == 1
+        assert len(fake_stripe.requests) == 2
+
+    def test_retried_writes_keep_idempotency_key(self, fake_stripe):
+        """Writes are retried with the same idempotency key"""
+        customer = fake_stripe.add_customer(plan='gold')
+        subscription = customer['subscriptions']['data'][0]
+        fake_stripe.fail(1, status=503)
+
+        updated = stripe.Subscription.modify(
+            subscription['id'],
+            items=[{'id': subscription['items']['data'][0]['id'],
+                    'plan': 'bronze'}])
+
+        keys = [request['idempotency_key'] for request
+                in fake_stripe.requests]
+        assert updated.plan.id == 'bronze'
+        assert len(keys) == 2
+        assert keys[0] is not None and keys[0] == keys[1]
+
+    def test_deletes_are_not_retried(self, fake_stripe):
+        """Deletes have no idempotency key so server errors aren't retried"""
+        customer = fake_stripe.add_customer(plan='gold')
+        subscription_id = customer['subscriptions']['data'][0]['id']
+        fake_stripe.fail(1, status=500)
+
+        with pytest.raises(stripe.error.APIError):
+            stripe.Subscription(subscription_id).delete()
+
+        assert len(fake_stripe.requests) == 1
+
+    def test_timed_out_deletes_are_not_retried(self, fake_stripe):
+        """A delete which timed out may have gone through, it's not resent"""
+        customer = fake_stripe.add_customer(plan='gold')
+        subscription_id = customer['subscriptions']['data'][0]['id']
+        stripe.default_http_client.write_timeout = 0.05
+        fake_stripe.delay = 0.2
+
+        with pytest.raises(stripe.error.APIConnectionError):
+            stripe.Subscription(subscription_id).delete()
+
+        assert len(fake_stripe.requests) == 1
+
+    def test_request_metrics(self, app, fake_stripe):
+        """Calls are counted per request, retries are part of the call"""
+        customer = fake_stripe.add_customer(plan='gold')
+        fake_stripe.fail(1, status=500)
+
+        with app.test_request_context():
+            app.preprocess_request()
+            stripe.Customer.retrieve(customer['id'])
+            count, seconds = request_metrics.current()['stripe']
+
+        assert count == 1
+        assert seconds > 0
+        assert len(fake_stripe.requests) == 2
+
+    def test_timeout(self, fake_stripe):
+        """Slow responses time out rather than blocking the worker"""
+        stripe.default_http_client.read_timeout = 0.05
+        fake_stripe.delay = 0.2
+
+        with pytest.raises(stripe.error.APIConnectionError):
+            stripe.Customer.retrieve('cus_000000')
+
+        assert len(fake_stripe.requests) == 3
+
+    def test_circuit_breaker(self, fake_stripe):
+        """Once the breaker opens calls fail without reaching Stripe"""
+        stripe.default_http_client.breaker = CircuitBreaker(threshold=1,
+                                                            reset_timeout=60)
+        fake_stripe.fail(3, status=500)
+
+        with pytest.raises(stripe.error.APIError):
+            stripe.Customer.retrieve('cus_000000')
+
+        with pytest.raises(CircuitOpenError):
+            stripe.Customer.retrieve('cus_000000')
+
+        assert len(fake_stripe.requests) == 3
+
+    def test_circuit_breaker_closes(self):
+        """A successful trial call closes the breaker"""
+        breaker = CircuitBreaker(threshold=2, reset_timeout=0)
+        breaker.record_failure()
+        assert breaker.allow() and not breaker.is_open
+
+        breaker.record_failure()
+        assert breaker.is_open
+
+        assert breaker.allow()
+        breaker.record_success()
+        assert not breaker.is_open
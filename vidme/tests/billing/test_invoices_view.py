@@ -1,6 +1,13 @@
+import datetime
+import decimal
+import json
+import uuid
+
+import pytz
 from flask import url_for
 
 from lib.tests import ViewTestMixin
+from lib.util_json import ENCODERS, dumps
 
 
 class TestInvoicesView(ViewTestMixin):
@@ -17,3 +24,77 @@ class TestInvoicesView(ViewTestMixin):
         assert response.status_code == 200
         assert data['upcoming_invoice'] is None
         assert len(invoice_history) == 2
+
+    def test_get_invoices_by_page(self, invoices):
+        """Walk the billing history with cursors, newest first"""
+        self.authenticate()
+        args = {'page_size': 1}
+
+        response = self.client.get(url_for('InvoicesView:index', **args))
+        first = response.get_json()['data']
+
+        assert first['has_next'] is True
+        assert first['invoices'][0]['receipt_number'] == '0010000'
+
+        args['cursor'] = first['next_cursor']
+        response = self.client.get(url_for('InvoicesView:index', **args))
+        second = response.get_json()['data']
+
+        assert second['has_next'] is False
+        assert second['has_prev'] is True
+        assert second['invoices'][0]['receipt_number'] == '0009000'
+
+    def test_get_invoices_by_period(self, invoices):
+        """Filter the billing history by billing period"""
+        self.authenticate()
+        response = self.client.get(url_for('InvoicesView:index',
+                                           period_start_on='2019-05-15'))
+        invoice_history = response.get_json()['data']['invoices']
+
+        assert len(invoice_history) == 1
+        assert invoice_history[0]['receipt_number'] == '0010000'
+
+        response = self.client.get(url_for('InvoicesView:index',
+                                           period_end_on='May 15'))
+
+        assert response.status_code == 400
+
+    def test_get_invoices_not_modified(self, invoices):
+        """Answer a request for an unchanged billing history with a 304"""
+        self.authenticate()
+        response = self.client.get(url_for('InvoicesView:index'))
+        etag = response.headers['ETag']
+
+        assert 'no-cache' in response.headers['Cache-Control']
+
+        response = self.client.get(url_for('InvoicesView:index'),
+                                   headers={'If-None-Match': etag})
+        assert response.status_code == 304
+
+        response = self.client.get(url_for('InvoicesView:index',
+                                           page_size=1),
+                                   headers={'If-None-Match': etag})
+        assert response.status_code == 200
+
+
+class TestJSONEncoder(object):
+    def test_encoders_agree(self):
+        """Every JSON encoder serializes invoice data the same way"""
+        data = {
+            'period_start_on': datetime.date(2019, 5, 1),
+            'refreshed_on': datetime.datetime(2019, 5, 1, 12, 30, 15, 500,
+                                              tzinfo=pytz.utc),
+            'total': decimal.Decimal('9.99'),
+            'id': uuid.UUID('12345678123456781234567812345678'),
+            1: None
+        }
+        expected = {
+            'period_start_on': '2019-05-01',
+            'refreshed_on': '2019-05-01T12:30:15.000500+00:00',
+            'total': '9.99',
+            'id': '12345678-1234-5678-1234-567812345678',
+            '1': None
+        }
+
+        for encoder in ENCODERS:
+            assert json.loads(dumps(data, encoder)) == expected
@@ -1,7 +1,24 @@
 import datetime
 
+import pytest
+import pytz
+import stripe
+from mock import Mock
+from sqlalchemy import event
+
+from vidme.blueprints.billing.gateways.stripecom import (
+    Event as PaymentEvent,
+    Invoice as PaymentInvoice,
+    Product as PaymentProduct,
+    Subscription as PaymentSubscription
+)
 from vidme.blueprints.billing.models.credit_card import CreditCard
 from vidme.blueprints.billing.models.invoice import Invoice
+from vidme.blueprints.billing.models.stripe_event import StripeEvent
+from vidme.blueprints.billing.models.subscription import Subscription
+from vidme.blueprints.user.models import User
+from vidme.blueprints.billing import tasks
+from vidme.extensions import db, product_cache, upcoming_invoice_cache
 
 
 class TestCreditCard(object):
@@ -152,6 +169,122 @@ class TestInvoice(object):
         assert parsed_payload['tax'] is None
         assert parsed_payload['tax_percent'] is None
         assert parsed_payload['total'] == 500
+        assert parsed_payload['created_on'] == datetime.datetime(
+            2015, 5, 30, 20, 46, 10, tzinfo=pytz.utc)
+
+    def test_bulk_upsert(self, subscriptions):
+        """Invoices are saved once per receipt number for users with cards"""
+        subscriptions.session.query(Invoice).delete()
+        subscriptions.session.commit()
+
+        invoice = {
+            'payment_id': 'cus_000',
+            'plan': 'Gold',
+            'receipt_number': '0009000',
+            'description': 'GOLD MONTHLY',
+            'period_start_on': datetime.date(2015, 6, 1),
+            'period_end_on': datetime.date(2015, 6, 15),
+            'currency': 'usd',
+            'tax': None,
+            'tax_percent': None,
+            'total': 500
+        }
+        unknown = dict(invoice, payment_id='cus_999', receipt_number='0009001')
+
+        saved = Invoice.bulk_upsert([invoice, unknown])
+        assert list(saved) == ['cus_000']
+
+        # The user changed their card before stripe re-sent the event
+        card = CreditCard.query.filter(
+            CreditCard.user_id == saved['cus_000']).first()
+        card.last4 = '1111'
+        subscriptions.session.commit()
+
+        # Stripe re-sent the event with a new total
+        saved = Invoice.bulk_upsert([dict(invoice, total=700)])
+        assert list(saved) == ['cus_000']
+
+        invoices = Invoice.query.all()
+        assert len(invoices) == 1
+        assert invoices[0].user_id == saved['cus_000']
+        assert invoices[0].total == 700
+        assert invoices[0].last4 == '4242'
+
+    def test_billing_history_uses_index(self, session, invoices):
+        """Pages of the billing history are read in order from the index"""
+        user = User.query.get(1)
+        first = Invoice.billing_history(user, per_page=1)
+
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context,
+                    executemany):
+            statements.append((statement, parameters))
+
+        event.listen(db.engine, 'before_cursor_execute', capture)
+        try:
+            Invoice.billing_history(user, cursor=first.next_cursor,
+                                    per_page=1)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', capture)
+
+        statement, parameters = statements[-1]
+        cursor = session.connection().connection.cursor()
+
+        if session.bind.dialect.name == 'postgresql':
+            # The table is too small for the planner to pick an index
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute('EXPLAIN ' + statement, parameters)
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+            assert 'Sort' not in plan
+            # The cursor is a range of the index, not a filter on its rows
+            assert 'ROW(created_on, id) <' in plan
+        else:
+            cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+            plan = '\n'.join(row[-1] for row in cursor.fetchall())
+            assert 'TEMP B-TREE' not in plan
+            assert 'created_on<?' in plan
+
+        assert 'ix_invoices_user_id_created_on_id' in plan
+
+    def test_sync(self, subscriptions, mock_stripe, fake_stripe):
+        """Invoices are listed page by page within the date window"""
+        subscriptions.session.query(Invoice).delete()
+        subscriptions.session.commit()
+
+        for i, created in enumerate((1433018770, 1435610770, 1438289170)):
+            fake_stripe.add_invoice('cus_000', 'gold', created,
+                                    receipt_number='000900{0}'.format(i))
+        fake_stripe.add_invoice('cus_000', 'gold', 1500000000,
+                                receipt_number='0009009')
+
+        result = Invoice.sync(['cus_000'], created={'lt': 1500000000},
+                              page_size=2)
+
+        assert result == {'customers': 1, 'invoices': 3, 'failed': {}}
+        assert len(fake_stripe.requests) == 2
+        assert sorted(invoice.receipt_number for invoice
+                      in Invoice.query.all()) == ['0009000', '0009001',
+                                                  '0009002']
+        # Backfilled invoices are dated by stripe, not by the sync
+        assert Invoice.query.filter_by(receipt_number='0009000').one() \
+            .created_on == datetime.datetime(2015, 5, 30, 20, 46, 10,
+                                             tzinfo=pytz.utc)
+
+    def test_list_many_yields_pages(self, fake_stripe):
+        """Each page of invoices is yielded as it arrives"""
+        for created in (1433018770, 1435610770, 1438289170):
+            fake_stripe.add_invoice('cus_000', 'gold', created)
+
+        results = list(PaymentInvoice.list_many(['cus_000', 'cus_001'],
+                                                page_size=2))
+        pages = [len(invoices) if invoices is not None else None
+                 for customer_id, invoices, _ in results
+                 if customer_id == 'cus_000']
+
+        # The customer is done once None is yielded
+        assert pages == [2, 1, None]
+        assert ('cus_001', None, None) in results
 
     def test_invoice_upcoming(self, mock_stripe):
         """Parse the correct data from a Stripe invoice payload"""
@@ -163,3 +296,208 @@ class TestInvoice(object):
         assert parsed_payload['next_bill_on'] == next_bill_on
         assert parsed_payload['amount_due'] == 500
         assert parsed_payload['interval'] == 'month'
+
+    def test_product_cache(self, mock_stripe):
+        """Products are only retrieved from Stripe once until invalidated"""
+        product_cache.enabled = True
+        product_cache.local.clear()
+        try:
+            calls = PaymentProduct.retrieve.call_count
+
+            Invoice.upcoming('cus_000')
+            Invoice.upcoming('cus_000')
+            assert PaymentProduct.retrieve.call_count == calls + 1
+
+            PaymentProduct.invalidate('prod_000')
+            parsed_payload = Invoice.upcoming('cus_000')
+            assert PaymentProduct.retrieve.call_count == calls + 2
+            assert parsed_payload['description'] == 'GOLD MONTHLY'
+        finally:
+            product_cache.enabled = False
+            product_cache.local.clear()
+
+    def test_cached_upcoming_invoice(self, app, mock_stripe, monkeypatch):
+        """Stale upcoming invoices are served while they're refreshed"""
+        refresh = Mock()
+        monkeypatch.setattr(tasks.refresh_upcoming_invoice, 'delay', refresh)
+        monkeypatch.setitem(app.config, 'UPCOMING_INVOICE_CACHE_FRESH_TTL', 0)
+        upcoming_invoice_cache.enabled = True
+        upcoming_invoice_cache.local.clear()
+        try:
+            calls = PaymentInvoice.upcoming.call_count
+
+            invoice, refreshed_on = Invoice.cached_upcoming('cus_000')
+            assert invoice['plan'] == 'Gold'
+            assert PaymentInvoice.upcoming.call_count == calls + 1
+            refresh.assert_not_called()
+
+            stale, stale_refreshed_on = Invoice.cached_upcoming('cus_000')
+            assert stale == invoice
+            assert stale_refreshed_on == refreshed_on
+            assert PaymentInvoice.upcoming.call_count == calls + 1
+            refresh.assert_called_once_with('cus_000')
+
+            Invoice.invalidate_upcoming('cus_000')
+            Invoice.cached_upcoming('cus_000')
+            assert PaymentInvoice.upcoming.call_count == calls + 2
+        finally:
+            upcoming_invoice_cache.enabled = False
+            upcoming_invoice_cache.local.clear()
+
+
+class TestSubscription(object):
+    def test_get_plan(self):
+        """Plans are looked up by id and can't be changed"""
+        plan = Subscription.get_plan('gold')
+
+        assert plan['amount'] == 999
+        assert Subscription.get_plan('diamond') is None
+        assert sorted(Subscription.get_all_plans()) == ['bronze', 'gold',
+                                                        'platinum']
+
+        with pytest.raises(TypeError):
+            plan['amount'] = 0
+        with pytest.raises(TypeError):
+            plan['metadata']['recommended'] = False
+
+    def test_extract_subscription_params(self):
+        """Parse the subscription and item ids from a Stripe subscription"""
+        payment_subscription = {
+            'id': 'sub_000',
+            'items': {'data': [{'id': 'si_000'}]}
+        }
+
+        params = Subscription.extract_subscription_params(payment_subscription)
+
+        assert params == {'payment_id': 'sub_000',
+                          'payment_item_id': 'si_000'}
+
+    def test_update_by_subscription_id(self, subscriptions, mock_stripe):
+        """Stored subscription ids are passed to the gateway"""
+        user = User.find_by_identity('firstSub1')
+        user.subscription.payment_id = 'sub_000'
+        user.subscription.payment_item_id = 'si_000'
+
+        Subscription().update(user=user, plan='bronze')
+
+        _, kwargs = PaymentSubscription.update.call_args
+        assert kwargs['subscription_id'] == 'sub_000'
+        assert kwargs['item_id'] == 'si_000'
+        assert kwargs['plan'] == 'bronze'
+
+
+class TestStripeEvent(object):
+    @staticmethod
+    def event(id, customer, created, object='invoice'):
+        return {'id': id, 'type': '{0}.created'.format(object),
+                'created': created,
+                'data': {'object': {'object': object, 'customer': customer}}}
+
+    def test_process_pending_in_order(self, db, mock_stripe, monkeypatch):
+        """A customer's events wait for earlier events to be applied"""
+        db.session.query(StripeEvent).delete()
+        db.session.commit()
+
+        for id, customer, created in (('evt_1', 'cus_a', 1),
+                                      ('evt_2', 'cus_a', 2),
+                                      ('evt_3', 'cus_b', 3)):
+            StripeEvent.enqueue(self.event(id, customer, created),
+                                verified=True)
+
+        applied = []
+
+        def apply(safe_event):
+            if not applied and safe_event['id'] == 'evt_1':
+                applied.append(None)
+                raise stripe.error.APIConnectionError('Timed out')
+            applied.append(safe_event['id'])
+
+        monkeypatch.setattr(StripeEvent, 'apply', apply)
+
+        counts = StripeEvent.process_pending()
+
+        assert counts == {'processed': 1, 'ignored': 0, 'failed': 0,
+                          'pending': 2}
+        assert applied == [None, 'evt_3']
+
+        counts = StripeEvent.process_pending()
+
+        assert counts == {'processed': 2, 'ignored': 0, 'failed': 0,
+                          'pending': 0}
+        assert applied == [None, 'evt_3', 'evt_1', 'evt_2']
+        assert StripeEvent.query.filter_by(event_id='evt_1').first() \
+            .attempts == 2
+
+    def test_unsigned_events_are_ordered_by_stripe(self, db, mock_stripe,
+                                                   monkeypatch):
+        """The customer and date of unsigned events come from stripe"""
+        db.session.query(StripeEvent).delete()
+        db.session.commit()
+
+        # The body claims another customer and an earlier date
+        StripeEvent.enqueue(self.event('evt_1', 'cus_a', 1))
+        StripeEvent.enqueue(self.event('evt_2', 'cus_b', 2), verified=True)
+        StripeEvent.enqueue(self.event('evt_3', 'cus_b', 3, 'customer'),
+                            verified=True)
+
+        stored = StripeEvent.query.filter_by(event_id='evt_1').one()
+        assert stored.customer_id is None
+        assert stored.occurred_on is None
+
+        applied = []
+        monkeypatch.setattr(StripeEvent, 'apply',
+                            lambda safe_event: applied.append(
+                                safe_event['id']))
+        monkeypatch.setattr(PaymentEvent, 'retrieve', Mock(
+            side_effect=stripe.error.APIConnectionError('Timed out')))
+
+        counts = StripeEvent.process_pending()
+
+        # Nothing is applied until every event's customer is known
+        assert counts == {'processed': 0, 'ignored': 0, 'failed': 0,
+                          'pending': 1}
+        assert applied == []
+
+        monkeypatch.setattr(PaymentEvent, 'retrieve', Mock(
+            return_value=self.event('evt_1', 'cus_b', 4)))
+
+        counts = StripeEvent.process_pending()
+
+        assert counts == {'processed': 2, 'ignored': 1, 'failed': 0,
+                          'pending': 0}
+        assert applied == ['evt_2', 'evt_1']
+
+        stored = StripeEvent.query.filter_by(event_id='evt_1').one()
+        assert stored.customer_id == 'cus_b'
+        assert stored.verified is True
+        assert StripeEvent.query.filter_by(event_id='evt_3').one() \
+            .status == 'ignored'
+
+    def test_unsigned_events_beyond_batch_are_not_applied(self, db,
+                                                          mock_stripe,
+                                                          monkeypatch):
+        """Unsigned events are never applied from their request body"""
+        db.session.query(StripeEvent).delete()
+        db.session.commit()
+
+        for i in range(3):
+            StripeEvent.enqueue(self.event('evt_{0}'.format(i), 'cus_a', i))
+
+        applied = []
+        monkeypatch.setattr(StripeEvent, 'apply',
+                            lambda safe_event: applied.append(
+                                safe_event['id']))
+        monkeypatch.setattr(PaymentEvent, 'retrieve', Mock(
+            side_effect=stripe.error.InvalidRequestError('No such event',
+                                                         'id')))
+
+        counts = StripeEvent.process_pending(batch_size=2)
+
+        assert counts == {'processed': 0, 'ignored': 0, 'failed': 2,
+                          'pending': 1}
+
+        counts = StripeEvent.process_pending(batch_size=2)
+
+        assert counts == {'processed': 0, 'ignored': 0, 'failed': 1,
+                          'pending': 0}
+        assert applied == []
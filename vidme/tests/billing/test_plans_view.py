@@ -24,3 +24,19 @@ class TestGetPlans(ViewTestMixin):
         assert plans['platinum']['amount'] == 1299
         assert plans['platinum']['currency'] == 'usd'
         assert plans['platinum']['statement_descriptor'] == 'VIDME PLATINUM'
+
+    def test_get_plans_not_modified(self):
+        """Answer a request for plans the client already has with a 304"""
+        response = self.client.get(url_for('PlansView:index'))
+        etag = response.headers['ETag']
+
+        assert 'public' in response.headers['Cache-Control']
+
+        response = self.client.get(url_for('PlansView:index'),
+                                   headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.data == b''
+
+        response = self.client.get(url_for('PlansView:index'),
+                                   headers={'If-None-Match': '"outdated"'})
+        assert response.status_code == 200
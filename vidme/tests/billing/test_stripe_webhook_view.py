@@ -0,0 +1,137 @@
+import hashlib
+import hmac
+import json
+import time
+
+import pytest
+from flask import url_for
+from mock import Mock
+
+from vidme.blueprints.billing import tasks
+from vidme.blueprints.billing.models.stripe_event import StripeEvent
+from vidme.extensions import webhook_replay_cache
+
+
+@pytest.fixture(scope='function')
+def process_stripe_events(db, monkeypatch):
+    """
+    Start without stored events and record queued tasks instead of running
+    them.
+
+    :return: Mock
+    """
+    db.session.query(StripeEvent).delete()
+    db.session.commit()
+
+    delay = Mock()
+    monkeypatch.setattr(tasks.process_stripe_events, 'delay', delay)
+
+    return delay
+
+
+@pytest.yield_fixture(scope='function')
+def signed_webhook(app, monkeypatch):
+    """
+    Configure a webhook signing secret and an in-process replay cache, so
+    nothing is left behind for the next run.
+
+    :return: Function which posts a signed event
+    """
+    secret = 'whsec_test'
+    monkeypatch.setitem(app.config, 'STRIPE_WEBHOOK_SECRET', secret)
+    monkeypatch.setattr(webhook_replay_cache, 'shared', None)
+    webhook_replay_cache.enabled = True
+    webhook_replay_cache.local.clear()
+
+    def post(client, event, timestamp=None, secret=secret):
+        payload = json.dumps(event)
+        timestamp = int(timestamp or time.time())
+        signature = hmac.new(
+            secret.encode('utf-8'),
+            '{0}.{1}'.format(timestamp, payload).encode('utf-8'),
+            hashlib.sha256).hexdigest()
+
+        return client.post(url_for('StripeWebhookView:post'), data=payload,
+                           content_type='application/json',
+                           headers={'Stripe-Signature': 't={0},v1={1}'
+                                    .format(timestamp, signature)})
+
+    yield post
+
+    webhook_replay_cache.enabled = False
+    webhook_replay_cache.local.clear()
+
+
+class TestStripeWebhookView(object):
+    def test_event_is_queued_once(self, client, process_stripe_events):
+        """Events are stored and acknowledged, duplicates are ignored"""
+        event = {
+            'id': 'evt_000',
+            'type': 'invoice.created',
+            'created': 1433018770,
+            'data': {'object': {'object': 'invoice', 'customer': 'cus_000'}}
+        }
+
+        for _ in range(2):
+            response = client.post(url_for('StripeWebhookView:post'),
+                                   json=event)
+            assert response.status_code == 200
+
+        stored = StripeEvent.query.filter_by(event_id='evt_000').all()
+        assert len(stored) == 1
+        assert stored[0].status == 'pending'
+        # Only trusted once it's been retrieved from stripe
+        assert stored[0].verified is False
+        assert stored[0].customer_id is None
+        process_stripe_events.assert_called_once_with()
+
+    def test_invalid_event(self, client, process_stripe_events):
+        """Events without an id are rejected"""
+        response = client.post(url_for('StripeWebhookView:post'),
+                               json={'type': 'invoice.created'})
+
+        assert response.status_code == 400
+        assert StripeEvent.query.count() == 0
+
+    def test_signed_event_is_verified(self, client, process_stripe_events,
+                                      signed_webhook):
+        """Signed events are stored as verified and only accepted once"""
+        event = {
+            'id': 'evt_001',
+            'type': 'invoice.created',
+            'created': 1433018770,
+            'data': {'object': {'object': 'invoice', 'customer': 'cus_000'}}
+        }
+
+        response = signed_webhook(client, event)
+        assert response.status_code == 200
+
+        stored = StripeEvent.query.filter_by(event_id='evt_001').one()
+        assert stored.verified is True
+
+        # Replaying the request is acknowledged without being stored again,
+        # even once the stored event is gone
+        StripeEvent.query.delete()
+        StripeEvent.query.session.commit()
+
+        response = signed_webhook(client, event)
+        assert response.status_code == 200
+        assert StripeEvent.query.count() == 0
+        process_stripe_events.assert_called_once_with()
+
+    def test_invalid_signature(self, client, process_stripe_events,
+                               signed_webhook):
+        """Unsigned, badly signed and expired events are rejected"""
+        event = {'id': 'evt_002', 'type': 'invoice.created'}
+
+        response = client.post(url_for('StripeWebhookView:post'), json=event)
+        assert response.status_code == 400
+
+        response = signed_webhook(client, event, secret='whsec_wrong')
+        assert response.status_code == 400
+
+        response = signed_webhook(client, event,
+                                  timestamp=time.time() - 3600)
+        assert response.status_code == 400
+
+        assert StripeEvent.query.count() == 0
@@ -1,6 +1,9 @@
 from flask import url_for
 
 from lib.tests import ViewTestMixin, assert_status_with_message
+from lib.util_datetime import timezone_aware_datetime
+from vidme.blueprints.billing.models.credit_card import CreditCard
+from vidme.blueprints.user.models import User
 
 
 class TestCreateSubscription(ViewTestMixin):
@@ -119,6 +122,29 @@ class TestGetSubscription(ViewTestMixin):
         assert 'updated_on' in card
         assert 'created_on' in card
 
+    def test_billing_info_not_modified(self, subscriptions):
+        """Answer with a 304 until the credit card or subscription changes"""
+        self.authenticate(identity='subscriber@local.host')
+        response = self.client.get(url_for('SubscriptionsView:index'))
+        etag = response.headers['ETag']
+
+        assert response.headers['Last-Modified']
+
+        response = self.client.get(url_for('SubscriptionsView:index'),
+                                   headers={'If-None-Match': etag})
+        assert response.status_code == 304
+
+        user_id = self.session.query(User.id) \
+            .filter(User.email == 'subscriber@local.host').scalar()
+        CreditCard.query.filter(CreditCard.user_id == user_id) \
+            .update({'updated_on': timezone_aware_datetime()})
+        self.session.commit()
+
+        response = self.client.get(url_for('SubscriptionsView:index'),
+                                   headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etag
+
 
 class TestCancelSubscription(ViewTestMixin):
     def test_no_active_subscription(self):
@@ -2,9 +2,11 @@ import datetime
 
 import pytest
 import pytz
+import stripe
 from mock import Mock
 
 from config import settings
+from lib.fake_stripe import FakeStripe
 from vidme.app import create_app
 from vidme.extensions import db as _db
 from lib.util_datetime import timedelta_months
@@ -12,6 +14,7 @@ from vidme.blueprints.user.models import User
 from vidme.blueprints.billing.models.credit_card import CreditCard
 from vidme.blueprints.billing.models.subscription import Subscription
 from vidme.blueprints.billing.models.invoice import Invoice
+from vidme.blueprints.billing.gateways.http_client import StripeHTTPClient
 from vidme.blueprints.billing.gateways.stripecom import (
     Event as PaymentEvent,
     Card as PaymentCard,
@@ -34,6 +37,16 @@ def app():
         'DEBUG': False,
         'TESTING': True,
         'JWT_COOKIE_CSRF_PROTECT': False,
+        # tests roll back their transactions which the cache wouldn't see
+        'IDENTITY_CACHE_ENABLED': False,
+        'ACTIVITY_BUFFER_ENABLED': False,
+        'DASHBOARD_COUNTERS_ENABLED': False,
+        'STRIPE_PRODUCT_CACHE_ENABLED': False,
+        'UPCOMING_INVOICE_CACHE_ENABLED': False,
+        'STRIPE_WEBHOOK_REPLAY_CACHE_ENABLED': False,
+        'REQUEST_METRICS_ENABLED': True,
+        # count running hashes in-process
+        'PASSWORD_HASH_REDIS_URL': None,
         'SQLALCHEMY_DATABASE_URI': db_uri
     }
 
@@ -388,3 +401,43 @@ def mock_stripe():
         'receipt_number': None
     }
     PaymentInvoice.upcoming = Mock(return_value=upcoming_invoice_api)
+
+
+@pytest.yield_fixture(scope='session')
+def fake_stripe_server():
+    """
+    Start a local fake Stripe server, this only gets executed once.
+
+    :return: FakeStripe
+    """
+    server = FakeStripe().start()
+
+    yield server
+
+    server.stop()
+
+
+@pytest.yield_fixture(scope='function')
+def fake_stripe(app, fake_stripe_server):
+    """
+    Send real Stripe calls to the fake Stripe server, with a new HTTP client
+    that doesn't wait between retries.
+
+    :param app: Pytest fixture
+    :param fake_stripe_server: Pytest fixture
+    :return: FakeStripe
+    """
+    previous = (stripe.api_key, stripe.api_base, stripe.max_network_retries,
+                stripe.default_http_client)
+
+    fake_stripe_server.reset()
+    stripe.api_key = 'sk_test_fake'
+    stripe.api_base = fake_stripe_server.url
+    stripe.max_network_retries = 2
+    stripe.default_http_client = StripeHTTPClient.from_config(
+        dict(app.config, STRIPE_RETRY_DELAY=0))
+
+    yield fake_stripe_server
+
+    (stripe.api_key, stripe.api_base, stripe.max_network_retries,
+     stripe.default_http_client) = previous
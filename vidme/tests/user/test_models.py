@@ -1,4 +1,19 @@
+import datetime
+import threading
+
+import pytest
+import pytz
+from sqlalchemy.dialects import postgresql
+from werkzeug.security import generate_password_hash
+
+from lib.password_hasher import PasswordHasher, PasswordHasherBusy
+from lib.tests import assert_max_queries
+from lib.util_cache import LRUCache, TieredCache
+from lib.util_search import NgramIndex
+from lib.util_sqlalchemy import Explain
+from vidme.blueprints.billing.models.invoice import Invoice
 from vidme.blueprints.user.models import User
+from vidme.extensions import activity_buffer
 
 
 class TestUser(object):
@@ -22,3 +37,247 @@ class TestUser(object):
     def test_is_active(self):
         user = User.find_by_identity('testAdmin@local.host')
         assert user.is_active() is True
+
+    def test_find_by_identity_eager_load(self, session, subscriptions):
+        """Relationships passed to load don't need a query of their own"""
+        user = User.find_by_identity('firstSub1',
+                                     load=('credit_card', 'subscription',
+                                           'invoices'))
+
+        with assert_max_queries(0):
+            assert user.credit_card.last4 == '4242'
+            assert user.subscription.plan == 'gold'
+            invoices = len(user.invoices)
+
+        assert invoices == Invoice.query.filter_by(user_id=user.id).count()
+
+    def test_find_by_identity_unknown_load(self):
+        """Only relationships in EAGER_LOADS can be eager loaded"""
+        with pytest.raises(ValueError):
+            User.find_by_identity('testAdmin1', load=('password',))
+
+
+class TestIdentityCache(object):
+    def test_lru_cache_evicts_least_recently_used(self):
+        """LRUCache drops the least recently used entry once it's full"""
+        cache = LRUCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        assert cache.get('a') == 1
+        assert cache.get('b') is None
+        assert cache.get('c') == 3
+
+    def test_lru_cache_expires_entries(self):
+        """LRUCache doesn't return entries past their TTL"""
+        cache = LRUCache(maxsize=2, ttl=0)
+        cache.set('a', 1)
+
+        assert cache.get('a') is None
+
+    def test_versioned_cache_refuses_stale_writes(self):
+        """A value read before a delete isn't cached after it"""
+        cache = TieredCache('TEST_CACHE', versioned=True)
+        cache.enabled = True
+        cache.local = LRUCache(maxsize=2, ttl=60)
+
+        version = cache.version('a')
+        cache.delete('a')
+        cache.set('a', 'old', version=version)
+
+        assert cache.get('a') is None
+
+        cache.set('a', 'new', version=cache.version('a'))
+        assert cache.get('a') == 'new'
+
+        cache.clear()
+        assert cache.get('a') is None
+
+    def test_identity_snapshot_excludes_password(self, session):
+        """Password hashes never end up in the identity cache"""
+        user = User.find_by_identity('testAdmin1')
+
+        assert 'password' not in user.to_identity_snapshot()['user']
+
+    def test_identity_snapshot(self, session, subscriptions):
+        """A user is re-created from a snapshot with their subscription"""
+        user = User.find_by_identity('firstSub1')
+        snapshot = user.to_identity_snapshot()
+        session.expunge_all()
+
+        cached_user = User.from_identity_snapshot(snapshot)
+
+        assert cached_user.username == 'firstSub1'
+        assert cached_user.subscription.plan == 'gold'
+        assert cached_user.credit_card.last4 == '4242'
+        assert cached_user.authenticated(password='password')
+
+    def test_cache_keys_include_old_username(self, session):
+        """Changing a username evicts the old and new username"""
+        user = User.find_by_identity('testAdmin1')
+        user.username = 'renamedAdmin1'
+
+        assert sorted(user.cache_keys()) == ['renamedAdmin1', 'testAdmin1']
+
+
+class TestPasswordHasher(object):
+    def test_needs_rehash(self):
+        """Hashes made with another method or salt length need a rehash"""
+        hasher = PasswordHasher()
+
+        assert not hasher.needs_rehash(hasher.hash('password'))
+        assert hasher.needs_rehash(
+            generate_password_hash('password', 'pbkdf2:sha1:1000'))
+        assert hasher.needs_rehash(
+            generate_password_hash('password', hasher.method, 16))
+
+    def test_needs_rehash_default_iterations(self):
+        """A method without an iteration count matches werkzeug's default"""
+        hasher = PasswordHasher()
+        hasher.method = 'pbkdf2:sha256'
+
+        assert hasher.hash('password').startswith('pbkdf2:sha256:150000$')
+        assert not hasher.needs_rehash(hasher.hash('password'))
+        assert hasher.needs_rehash(
+            generate_password_hash('password', 'pbkdf2:sha256:1000'))
+
+    def test_pool(self):
+        """Passwords are hashed and checked in the worker pool"""
+        hasher = PasswordHasher()
+        hasher.workers = 1
+        hasher.concurrency = 1
+
+        try:
+            assert hasher.check(hasher.hash('password'), 'password')
+            assert not hasher.check(hasher.hash('password'), 'wrong')
+            assert hasher._pool is not None
+        finally:
+            hasher._pool.shutdown()
+
+    def test_busy(self, monkeypatch):
+        """PasswordHasherBusy is raised while every slot is hashing"""
+        hashing = threading.Event()
+        release = threading.Event()
+
+        def slow_hash(*args):
+            hashing.set()
+            release.wait(5)
+            return generate_password_hash(*args)
+
+        monkeypatch.setattr('lib.password_hasher.generate_password_hash',
+                            slow_hash)
+        hasher = PasswordHasher()
+        hasher.concurrency = 1
+
+        thread = threading.Thread(target=hasher.hash, args=('password',))
+        thread.start()
+        hashing.wait(5)
+
+        try:
+            with pytest.raises(PasswordHasherBusy):
+                hasher.check(generate_password_hash('password'), 'password')
+        finally:
+            release.set()
+            thread.join()
+
+        # The slot is free again
+        assert hasher.check(hasher.hash('password'), 'password')
+
+
+class TestActivityTracking(object):
+    def test_unbuffered_without_redis(self, session, users, monkeypatch):
+        """Sign ins are saved right away when there's no Redis to buffer"""
+        monkeypatch.setattr(activity_buffer, 'enabled', True)
+        monkeypatch.setattr(activity_buffer, 'client', None)
+        user = User.find_by_identity('userMember')
+        sign_in_count = user.sign_in_count
+
+        user.update_activity_tracking('10.0.0.3')
+
+        assert len(activity_buffer) == 0
+        assert User.find_by_identity('userMember').sign_in_count == \
+            sign_in_count + 1
+
+    def test_bulk_update_activity_tracking(self, session, users):
+        """Several buffered sign ins by a user are collapsed into one update"""
+        user = User.find_by_identity('userMember')
+        sign_ins = [
+            {
+                'user_id': user.id,
+                'ip_address': '10.0.0.2',
+                'signed_in_on': '2019-06-02T00:00:00+00:00'
+            },
+            {
+                'user_id': user.id,
+                'ip_address': '10.0.0.1',
+                'signed_in_on': '2019-06-01T00:00:00+00:00'
+            }
+        ]
+
+        User.bulk_update_activity_tracking(sign_ins)
+
+        user = User.find_by_identity('userMember')
+        assert user.sign_in_count == 2
+        assert user.current_sign_in_ip == '10.0.0.2'
+        assert user.current_sign_in_on == datetime.datetime(2019, 6, 2,
+                                                            tzinfo=pytz.utc)
+        assert user.last_sign_in_ip == '10.0.0.1'
+        assert user.last_sign_in_on == datetime.datetime(2019, 6, 1,
+                                                         tzinfo=pytz.utc)
+
+
+class TestSearch(object):
+    def test_ngram_index(self):
+        """NgramIndex finds partial matches, most similar first"""
+        index = NgramIndex()
+        index.build([
+            (1, ('jane@local.host', 'janeSmith')),
+            (2, ('jan@local.host', 'jan')),
+            (3, ('bob@local.host', 'bobby'))
+        ])
+
+        assert index.search('jan') == [2, 1]
+        assert index.search('SMITH') == [1]
+        assert index.search('nobody') == []
+
+    def test_search(self, session, users):
+        """User.search matches part of an email or username"""
+        users = User.query.filter(User.search('ember@local')).all()
+
+        assert [user.username for user in users] == ['userMember']
+
+    def test_explain_keeps_bind_parameters(self):
+        """Search strings are passed to EXPLAIN as parameters, not SQL"""
+        statement = User.query.filter(User.email.ilike('%a :b%')).statement
+        compiled = Explain(statement).compile(dialect=postgresql.dialect())
+
+        assert str(compiled).startswith('EXPLAIN (FORMAT JSON) SELECT')
+        assert ':b' not in str(compiled)
+        assert '%a :b%' in compiled.params.values()
+
+
+class TestBulkActions(object):
+    def test_bulk_action_scope(self):
+        """Search scopes keep the query instead of resolving every id"""
+        selection = User.bulk_action_scope('all_search_results', [1, 2],
+                                           omit_ids=['1'], query='local')
+
+        assert selection == {'omit_ids': [1], 'query': 'local'}
+
+    def test_iter_bulk_action_ids(self, session, users):
+        """Search results are streamed in chunks without omitted ids"""
+        admin = User.find_by_identity('testAdmin1')
+        selection = User.bulk_action_scope('all_search_results', [],
+                                           omit_ids=[admin.id],
+                                           query='local.host')
+
+        chunks = list(User.iter_bulk_action_ids(selection, chunk_size=1))
+        ids = [id for chunk in chunks for id in chunk]
+
+        assert all(len(chunk) == 1 for chunk in chunks)
+        assert admin.id not in ids
+        assert ids == sorted(ids)
+        assert len(ids) == User.count_bulk_action_ids(selection)
+        assert len(ids) == User.query.count() - 1